@@ -0,0 +1,335 @@
+"""
+Check the fastcsv parsers against each other and measure how fast they are
+
+Usage::
+
+    python benchmark.py parity [ROWS]
+    python benchmark.py throughput [MB]
+    python benchmark.py suite [SIZES] [BITS] > results.json
+
+``parity`` writes a CSV file of random rows, including the unusual
+constructs the ``lex_file()`` state machine warns about and recovers from,
+and checks that ``lex_blocks()`` and ``lex_mmap()`` with each available
+``scan_rows()`` backend produce exactly the same rows, values, end
+positions and warnings as ``lex_file()`` when started at every row and at
+random positions, both for whole rows and for a selection of ``cols``.
+
+``throughput`` writes a CSV file of about ``MB`` megabytes (10 by default)
+and reports how many megabytes a second each parser gets through it.
+
+``suite`` writes sorted, padded files of each of the comma separated
+``SIZES`` in megabytes (``1,10`` by default) with each of the comma
+separated block size exponents ``BITS`` (``12,16,22`` by default) and
+measures, with each ``scan_rows()`` backend:
+
+* the ``BlockWriter`` and ``repad()`` throughput in MB/s
+* the ``lex()`` throughput in MB/s
+* the p50, p99 and mean ``find_row()`` latency in milliseconds for keys
+  that are found, keys that aren't, and keys in the first and last blocks
+
+Each measurement runs in a fresh process so that its peak RSS can be
+reported too. The results are printed as JSON so that runs can be compared
+to catch regressions; progress goes to stderr.
+"""
+import os
+import sys
+import mmap
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import tempfile
+import multiprocessing
+from StringIO import StringIO
+
+import fastcsv
+
+PLAIN = ['', 'a', 'hello world', 'comma, inside', 'quote " inside', 'new\r\nline', u'\xfcnicode'.encode('utf8')]
+UNUSUAL = [
+    'unquoted,"b"\r\n',
+    '"padded"   \r\n',
+    '   "leading padding"\r\n',
+    '"a" ,"b"\r\n',
+    ',"starts with a comma"\r\n',
+    '"just a newline"\n',
+    '\r\n',
+    'unquoted last\r\n',
+    '   unquoted,"after padding"\r\n',
+    '   ,"padding then a comma"\r\n',
+    '    \r\n',
+    # The space left by deleted rows
+    ' '*5000 + 'after,"deleted rows"\r\n',
+]
+
+def random_csv(rows, seed=1):
+    random.seed(seed)
+    lines = [fastcsv.encode_row(['key', 'value', 'other'])]
+    for i in range(rows):
+        if random.random() < 0.05:
+            lines.append(random.choice(UNUSUAL))
+        else:
+            lines.append(fastcsv.encode_row(['k%08d'%i] + [random.choice(PLAIN) for j in range(random.randint(1, 4))]))
+    return ''.join(lines)
+
+def collect(parser, source, pos, rows, stop_after, cols=None):
+    """
+    Run ``parser`` capturing everything it reports, including warnings
+    """
+    found = []
+    values = []
+    def row_callback(row, end_pos):
+        found.append((row, end_pos))
+        return stop_after is None or len(found) < stop_after
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        try:
+            result = parser(source, pos, row_callback, values.append, rows, cols)
+        except Exception, e:
+            result = repr(e)
+        return result, found, values, sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+def parity(rows=2000, backends=None):
+    data = random_csv(rows)
+    fp = tempfile.TemporaryFile()
+    fp.write(data)
+    fp.flush()
+    mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    starts = [0] + [end_pos+1 for row, end_pos in collect(fastcsv.lex_file, fp, 0, None, None)[1]]
+    starts += random.sample(xrange(len(data)), min(len(data), 200))
+    if backends is None:
+        backends = ['python']
+        if fastcsv._fastcsv is not None:
+            backends.append('c')
+    original = fastcsv.backend
+    failures = 0
+    try:
+        for backend in backends:
+            fastcsv.use_backend(backend)
+            checked = 0
+            parsers = [
+                ('lex_mmap', fastcsv.lex_mmap, mapped),
+                ('lex_blocks', fastcsv.lex_blocks, fp),
+                # Tiny chunks so that lots of rows are cut off by the end of one
+                ('lex_blocks(chunk_size=64)', lambda *args: fastcsv.lex_blocks(*args, chunk_size=64), fp),
+            ]
+            for pos in starts:
+                for rows, stop_after, cols in [(None, None, None), (1, None, None), (3, None, None), (None, 2, None), (None, None, [0]), (3, None, [1, 3])]:
+                    expected = collect(fastcsv.lex_file, fp, pos, rows, stop_after, cols)
+                    for name, parser, source in parsers:
+                        actual = collect(parser, source, pos, rows, stop_after, cols)
+                        checked += 1
+                        if expected != actual:
+                            failures += 1
+                            print 'MISMATCH %s with %s backend at %s (rows=%r, stop_after=%r, cols=%r)'%(name, backend, pos, rows, stop_after, cols)
+                            print '    lex_file: %r'%(expected[:2],)
+                            print '    %s: %r'%(name, actual[:2],)
+            print '%s backend: %s checks'%(backend, checked)
+    finally:
+        fastcsv.use_backend(original)
+        mapped.close()
+        fp.close()
+    return failures
+
+def throughput(mb=10):
+    random.seed(2)
+    fp = tempfile.TemporaryFile()
+    rows = 0
+    while fp.tell() < mb*1024*1024:
+        fp.write(''.join([
+            fastcsv.encode_row(['k%08d'%(rows+i)] + [random.choice(PLAIN) for j in range(random.randint(1, 4))])
+            for i in range(1000)
+        ]))
+        rows += 1000
+    fp.flush()
+    size = fp.tell()
+    mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    backends = ['python']
+    if fastcsv._fastcsv is not None:
+        backends.append('c')
+    original = fastcsv.backend
+    results = []
+    try:
+        for backend in [None] + backends:
+            if backend is None:
+                parsers = [('lex_file', fastcsv.lex_file, fp)]
+            else:
+                fastcsv.use_backend(backend)
+                parsers = [
+                    ('lex_blocks', fastcsv.lex_blocks, fp),
+                    ('lex_mmap', fastcsv.lex_mmap, mapped),
+                ]
+            for name, parser, source in parsers:
+                start = time.time()
+                end_pos, found = parser(source, 0, None, None, None)
+                seconds = time.time() - start
+                assert len(found) == rows
+                if backend is not None:
+                    name = '%s (%s)'%(name, backend)
+                results.append((name, seconds, size/1024.0/1024.0/seconds))
+                print '%-22s %8.3fs %8.2f MB/s'%results[-1]
+    finally:
+        fastcsv.use_backend(original)
+        mapped.close()
+        fp.close()
+    return results
+
+def isolated(function, *args):
+    """
+    Run ``function(*args)`` in a child process, returning its result and
+    the child's peak RSS in kilobytes
+    """
+    queue = multiprocessing.Queue()
+    def run():
+        try:
+            result = function(*args)
+        except Exception, e:
+            queue.put((None, repr(e)))
+            raise
+        queue.put((result, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    process = multiprocessing.Process(target=run)
+    process.start()
+    result, peak_rss = queue.get()
+    process.join()
+    if result is None:
+        raise Exception('Benchmark failed: %s'%(peak_rss,))
+    return result, peak_rss
+
+def suite_row(i):
+    # Only even numbers are used so that odd ones make keys that are missing
+    return ['k%010d'%(i*2)] + [random.choice(PLAIN) for j in range(random.randint(1, 4))]
+
+def write_suite_file(filename, mb):
+    random.seed(3)
+    start = time.time()
+    rows = 0
+    with fastcsv.BlockWriter(filename, ['key', 'value', 'other']) as writer:
+        while writer.pos < mb*1024*1024:
+            writer.write(suite_row(rows))
+            rows += 1
+    seconds = time.time() - start
+    size = os.stat(filename).st_size
+    return {'rows': rows, 'bytes': size, 'seconds': seconds, 'mb_per_s': size/1024.0/1024.0/seconds}
+
+def repad_suite_file(filename, tmp, block_size):
+    stats = fastcsv.repad(filename, tmp, block_size)
+    os.remove(tmp)
+    return stats
+
+def lex_suite_file(filename, backend, rows):
+    fastcsv.use_backend(backend)
+    start = time.time()
+    end_pos, found = fastcsv.lex(filename, 0, None, None, None)
+    seconds = time.time() - start
+    assert len(found) == rows+1
+    size = os.stat(filename).st_size
+    return {'seconds': seconds, 'mb_per_s': size/1024.0/1024.0/seconds}
+
+def percentile(times, fraction):
+    return times[min(int(len(times)*fraction), len(times)-1)]
+
+def find_row_latency(filename, backend, rows, lookups=200):
+    fastcsv.use_backend(backend)
+    random.seed(4)
+    with fastcsv.FastCSVFile(filename) as csvfile:
+        block_size = csvfile.block_size
+        first_rows = []
+        last_rows = []
+        # The rows whose end is in the first and last blocks
+        def row_callback(row, end_pos):
+            if end_pos < block_size:
+                first_rows.append(int(row[0][1:])/2)
+            elif end_pos >= csvfile.last_block*block_size:
+                last_rows.append(int(row[0][1:])/2)
+            return True
+        csvfile.lex(csvfile.block_start(0), row_callback, rows=None, cols=[0])
+        kinds = [
+            ('hit', lambda: random.randrange(rows)*2),
+            ('miss', lambda: random.randrange(rows)*2+1),
+            ('first_block', lambda: random.choice(first_rows)*2),
+            ('last_block', lambda: random.choice(last_rows)*2),
+        ]
+        results = {}
+        for kind, number in kinds:
+            times = []
+            for i in range(lookups):
+                key = [u'k%010d'%(number(),)]
+                start = time.time()
+                try:
+                    csvfile.find_row(key)
+                except KeyError:
+                    assert kind == 'miss'
+                times.append((time.time() - start)*1000)
+            times.sort()
+            results[kind] = {
+                'p50_ms': percentile(times, 0.5),
+                'p99_ms': percentile(times, 0.99),
+                'mean_ms': sum(times)/len(times),
+                'lookups': lookups,
+            }
+        return results
+
+def suite(sizes=(1, 10), bits_list=(12, 16, 22)):
+    backends = ['python']
+    if fastcsv._fastcsv is not None:
+        backends.append('c')
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'backends': backends,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'runs': [],
+    }
+    directory = tempfile.mkdtemp(prefix='fastcsv-benchmark-')
+    try:
+        for mb in sizes:
+            for bits in bits_list:
+                filename = os.path.join(directory, 'suite.%s.csv'%(bits,))
+                print >> sys.stderr, 'Writing %sMB with blocks of 2**%s'%(mb, bits)
+                run = {'mb': mb, 'bits': bits}
+                run['write'], run['write']['peak_rss_kb'] = isolated(write_suite_file, filename, mb)
+                rows = run['write']['rows']
+                run['repad'], run['repad']['peak_rss_kb'] = isolated(repad_suite_file, filename, filename+'.repad', 2**bits)
+                run['lex'] = {}
+                run['find_row'] = {}
+                for backend in backends:
+                    print >> sys.stderr, 'Measuring the %s backend'%(backend,)
+                    run['lex'][backend], run['lex'][backend]['peak_rss_kb'] = isolated(lex_suite_file, filename, backend, rows)
+                    run['find_row'][backend], peak_rss = isolated(find_row_latency, filename, backend, rows)
+                    run['find_row'][backend]['peak_rss_kb'] = peak_rss
+                results['runs'].append(run)
+                os.remove(filename)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ['parity', 'throughput', 'suite']:
+        print __doc__
+        sys.exit(1)
+    if sys.argv[1] == 'parity':
+        rows = 2000
+        if len(sys.argv) > 2:
+            rows = int(sys.argv[2])
+        failures = parity(rows)
+        if failures:
+            print '%s mismatches'%(failures,)
+            sys.exit(1)
+        print 'All the parsers agree'
+    elif sys.argv[1] == 'throughput':
+        mb = 10
+        if len(sys.argv) > 2:
+            mb = int(sys.argv[2])
+        throughput(mb)
+    elif sys.argv[1] == 'suite':
+        sizes = (1, 10)
+        bits_list = (12, 16, 22)
+        if len(sys.argv) > 2:
+            sizes = [float(mb) for mb in sys.argv[2].split(',')]
+        if len(sys.argv) > 3:
+            bits_list = [int(bits) for bits in sys.argv[3].split(',')]
+        print json.dumps(suite(sizes, bits_list), indent=2, sort_keys=True)
@@ -1,3 +1,6 @@
+#ifdef FASTCSV_EXTENSION
+#include <Python.h>
+#endif
 #include <stdio.h>
 #include <sys/types.h>
 #include <sys/stat.h>
@@ -452,6 +455,218 @@ fclose ( pFile );
     return res;
 }
 
+#ifdef FASTCSV_EXTENSION
+
+// The ``_fastcsv`` CPython extension, built by setup.py. It implements
+// ``scan_rows()`` with the same behaviour as the pure Python ``parse_row()``
+// loop in fastcsv.py so that ``lex_mmap()`` can hand it whole batches of
+// rows rather than calling back into Python for every value.
+
+// Return a new string for the value between ``start`` and ``end`` (the
+// closing quote), collapsing any ``""`` escapes, or NULL on error.
+static PyObject *quoted_value(const char *start, const char *end, int escaped) {
+    PyObject *value;
+    char *out;
+    const char *cur;
+    if (!escaped) {
+        return PyString_FromStringAndSize(start, end-start);
+    }
+    value = PyString_FromStringAndSize(NULL, end-start);
+    if (value == NULL) {
+        return NULL;
+    }
+    out = PyString_AS_STRING(value);
+    for (cur = start; cur < end; cur++) {
+        *out++ = *cur;
+        if (*cur == '"') {
+            // Skip the second quote of the pair
+            cur++;
+        }
+    }
+    if (_PyString_Resize(&value, out-PyString_AS_STRING(value)) < 0) {
+        return NULL;
+    }
+    return value;
+}
+
+// Parse the row starting at ``pos``, appending its values to ``row``.
+// If ``keep`` isn't NULL only the values of the columns whose byte in
+// ``keep`` is 1 are appended, the others are skipped without being copied.
+// Returns the position of the ``\n`` ending the row, -1 if the row isn't a
+// plain one that can be parsed here, or -2 on a Python error.
+static Py_ssize_t scan_row(const char *buf, Py_ssize_t pos, Py_ssize_t size, PyObject *row, const char *keep, Py_ssize_t keep_len) {
+    Py_ssize_t i = pos;
+    Py_ssize_t start;
+    Py_ssize_t col = 0;
+    int escaped;
+    int wanted;
+    PyObject *value;
+    if (i < size && buf[i] == ' ') {
+        // Padding left by an append or a delete before the row starts
+        while (i < size && buf[i] == ' ') {
+            i++;
+        }
+        if (i >= size || buf[i] != '"') {
+            return -1;
+        }
+    } else if (i < size && buf[i] == ',') {
+        return -1;
+    }
+    while (i < size) {
+        wanted = keep == NULL || (col < keep_len && keep[col] == 1);
+        value = NULL;
+        switch (buf[i]) {
+            case '"':
+                start = i+1;
+                escaped = 0;
+                for (i = start; ; i++) {
+                    if (i >= size) {
+                        return -1;
+                    }
+                    if (buf[i] == '"') {
+                        if (i+1 < size && buf[i+1] == '"') {
+                            escaped = 1;
+                            i++;
+                        } else {
+                            break;
+                        }
+                    }
+                }
+                if (wanted) {
+                    value = quoted_value(buf+start, buf+i, escaped);
+                }
+                i++;
+                if (i < size && buf[i] == ' ') {
+                    while (i < size && buf[i] == ' ') {
+                        i++;
+                    }
+                    if (i >= size || buf[i] != '\r') {
+                        Py_XDECREF(value);
+                        return -1;
+                    }
+                }
+                break;
+            case '\r':
+            case ',':
+                // An empty value
+                if (wanted) {
+                    value = PyString_FromStringAndSize(NULL, 0);
+                }
+                break;
+            case ' ':
+            case '\n':
+                return -1;
+            default:
+                start = i;
+                while (i < size && buf[i] != ',') {
+                    if (buf[i] == '"' || buf[i] == ' ' || buf[i] == '\r' || buf[i] == '\n') {
+                        return -1;
+                    }
+                    i++;
+                }
+                if (i >= size) {
+                    return -1;
+                }
+                if (wanted) {
+                    value = PyString_FromStringAndSize(buf+start, i-start);
+                }
+                break;
+        }
+        if (wanted) {
+            if (value == NULL) {
+                return -2;
+            }
+            if (PyList_Append(row, value) < 0) {
+                Py_DECREF(value);
+                return -2;
+            }
+            Py_DECREF(value);
+        }
+        col++;
+        if (i < size && buf[i] == ',') {
+            i++;
+        } else if (i+1 < size && buf[i] == '\r' && buf[i+1] == '\n') {
+            return i+1;
+        } else {
+            return -1;
+        }
+    }
+    return -1;
+}
+
+static char scan_rows_doc[] =
+"scan_rows(buf, pos, max_rows, keep=None) -> (rows, ends, pos)\n"
+"\n"
+"Parse up to ``max_rows`` rows (all of them if it is negative) from ``buf``\n"
+"starting at ``pos``, stopping early at the first row that isn't a plain\n"
+"one or at the end of the buffer. Returns the rows as lists of strings, the\n"
+"position of the ``\\n`` ending each row and the position of the first row\n"
+"not parsed.\n"
+"\n"
+"If ``keep`` is a string from ``column_mask()`` only the values of the\n"
+"columns it marks are returned.";
+
+static PyObject *scan_rows(PyObject *self, PyObject *args) {
+    Py_buffer view;
+    Py_ssize_t pos, max_rows, end, count = 0;
+    PyObject *keep_obj = Py_None;
+    char *keep = NULL;
+    Py_ssize_t keep_len = 0;
+    PyObject *rows = NULL, *ends = NULL, *row = NULL, *end_obj, *result = NULL;
+    if (!PyArg_ParseTuple(args, "s*nn|O", &view, &pos, &max_rows, &keep_obj)) {
+        return NULL;
+    }
+    if (keep_obj != Py_None && PyString_AsStringAndSize(keep_obj, &keep, &keep_len) < 0) {
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    rows = PyList_New(0);
+    ends = PyList_New(0);
+    if (rows == NULL || ends == NULL) {
+        goto done;
+    }
+    while (pos < view.len && (max_rows < 0 || count < max_rows)) {
+        row = PyList_New(0);
+        if (row == NULL) {
+            goto done;
+        }
+        end = scan_row((const char *)view.buf, pos, view.len, row, keep, keep_len);
+        if (end == -2) {
+            goto done;
+        }
+        if (end == -1) {
+            break;
+        }
+        end_obj = PyInt_FromSsize_t(end);
+        if (end_obj == NULL || PyList_Append(ends, end_obj) < 0 || PyList_Append(rows, row) < 0) {
+            Py_XDECREF(end_obj);
+            goto done;
+        }
+        Py_DECREF(end_obj);
+        Py_CLEAR(row);
+        pos = end+1;
+        count++;
+    }
+    result = Py_BuildValue("(OOn)", rows, ends, pos);
+done:
+    Py_XDECREF(row);
+    Py_XDECREF(rows);
+    Py_XDECREF(ends);
+    PyBuffer_Release(&view);
+    return result;
+}
+
+static PyMethodDef fastcsv_methods[] = {
+    {"scan_rows", scan_rows, METH_VARARGS, scan_rows_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+PyMODINIT_FUNC init_fastcsv(void) {
+    Py_InitModule3("_fastcsv", fastcsv_methods, "C implementation of the fastcsv row scanner");
+}
+
+#else
+
 int main(int argc, char **argv){
     int res;
     clock_t start = clock(), diff;
@@ -462,3 +677,5 @@ int main(int argc, char **argv){
     printf("[INFO] Time taken %d seconds %d milliseconds\n", msec/1000, msec%1000);
     return res;
 }
+
+#endif
@@ -19,21 +19,35 @@ Potential Drawbacks
 
 * Random insertion of new rows are not allowed, as they would be very slow, requiring the re-writing of the whole CSV file after them.
 * Row updates can only be preformed if the row contains less than or eqaul the length of encoded data it did to start with.
-* Row deletes do not free up space unless the very last row is deleted.
+* Row deletes do not free up space unless the very last row is deleted or the file is compacted with ``compact()``.
 
 Coping Strategies
 =================
 
 Never delete rows, just have a column that takes a status code of "ACTIVE" or "DELTED". When you want to update a row, just write it to the end of the file, set the old row to DELTED and keep a pointer somewhere else to say where the new file is.
 
-
-Todo
-====
-
-* Implement update, delete, insert
-
 """
 import os
+import atexit
+import re
+import csv
+import mmap
+import heapq
+import shutil
+import struct
+import hashlib
+import marshal
+import cPickle
+import math
+import time
+import fcntl
+import Queue
+import array
+import datetime
+import tempfile
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from collections import OrderedDict
 
 def debug(msg):
@@ -41,8 +55,90 @@ def debug(msg):
     print '[DEBUG]   %s'%(msg,)
 
 def warn(msg):
+    counters.add('warnings')
+    stats = getattr(tracing, 'stats', None)
+    if stats is not None:
+        stats.warnings += 1
     print '[WARNING] %s'%(msg,)
 
+class Counters(object):
+    """\
+    Totals kept for the whole process, for exporting to a metrics system.
+
+    ``lookups``, ``missing`` and ``warnings`` are always counted. The other
+    totals are the sums of the ``LookupStats`` of every traced lookup.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + amount
+
+    def record(self, stats):
+        with self.lock:
+            for name, value in stats.totals().items():
+                self.values[name] = self.values.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        Return a copy of the totals so far
+        """
+        with self.lock:
+            return dict(self.values)
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+class LookupStats(object):
+    """\
+    What a single traced ``find_row()`` or ``find_rows()`` call did: the
+    blocks probed while bisecting, the bytes read or (for a memory-mapped
+    file) parsed, the rows parsed, the values decoded, the time spent in
+    ``lex()`` and overall, the warnings from recovering from badly formatted
+    rows and the number of rows found.
+    """
+    def __init__(self, method, key):
+        self.method = method
+        self.key = key
+        self.blocks_probed = 0
+        self.bytes_read = 0
+        self.rows_lexed = 0
+        self.values_decoded = 0
+        self.lex_seconds = 0.0
+        self.warnings = 0
+        self.seconds = 0.0
+        self.rows_found = 0
+
+    def totals(self):
+        return {
+            'traced_lookups': 1,
+            'blocks_probed': self.blocks_probed,
+            'bytes_read': self.bytes_read,
+            'rows_lexed': self.rows_lexed,
+            'values_decoded': self.values_decoded,
+            'lex_seconds': self.lex_seconds,
+            'traced_seconds': self.seconds,
+        }
+
+    def describe_key(self, shown=3):
+        """
+        Return the key looked up, or for ``find_rows()`` the first ``shown``
+        keys and how many there were, for ``repr()``
+        """
+        if self.method != 'find_rows' or len(self.key) <= shown:
+            return repr(self.key)
+        return '[%s, ... %s keys]'%(', '.join([repr(key) for key in self.key[:shown]]), len(self.key))
+
+    def __repr__(self):
+        return '<LookupStats %s(%s) %s>'%(self.method, self.describe_key(), ' '.join(['%s=%s'%item for item in sorted(self.totals().items()) if item[0] != 'traced_lookups']+['warnings=%s'%(self.warnings,), 'rows_found=%s'%(self.rows_found,)]))
+
+counters = Counters()
+# The stats of the lookup being traced in each thread, for warn()
+tracing = threading.local()
+
 # State types
 ROW_START=    0
 PRE_PADDING=  1
@@ -78,175 +174,1299 @@ def parse_filename(path):
     size = 2**bits
     return size, parts[0], parts[1], parts[2]
 
-def repad(path, tmp, size):
+# Characters that mean a value has to be quoted
+needs_quoting = re.compile(r'[", \r\n]').search
+# The same, apart from commas
+needs_quoting_apart_from_commas = re.compile(r'[" \r\n]').search
+
+match_spaces = re.compile(' *').match
+
+def encode_row(row):
+    """\
+    Encode a row of unicode or UTF-8 encoded values as a line of the CSV file.
+
+    Values are only quoted when they have to be for ``lex()`` to read them
+    back: if they contain a quote, comma, space or newline, if they are the
+    last non-empty value in the row (an unquoted last value would run on into
+    the ``\\r\\n``), or if the first value is empty.
+    """
+    if len(row) > 1 and row[0]:
+        # Most rows only need their last value quoting, so try joining the
+        # others in one go and checking the result.
+        try:
+            head = ','.join(row[:-1])
+            if head.count(',') == len(row)-2 and not needs_quoting_apart_from_commas(head):
+                last = row[-1]
+                if last:
+                    last = '"'+last.replace('"', '""')+'"'
+                line = head+','+last+'\r\n'
+                if isinstance(line, unicode):
+                    line = line.encode('utf8')
+                return line
+        except UnicodeDecodeError:
+            # UTF-8 encoded values mixed with unicode ones
+            pass
+    values = []
+    last = len(row)-1
+    for i in range(len(row)):
+        value = row[i]
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        if not value:
+            if i == 0:
+                value = '""'
+        elif i == last or needs_quoting(value):
+            value = '"'+value.replace('"', '""')+'"'
+        values.append(value)
+    return ','.join(values)+'\r\n'
+
+def decode_str(value):
+    return value.decode('utf8')
+
+def decode_bytes(value):
+    return value
+
+def decode_int(value):
+    if not value:
+        return None
+    return int(value)
+
+def decode_float(value):
+    if not value:
+        return None
+    return float(value)
+
+def decode_date(value):
+    if not value:
+        return None
+    year, month, day = value.split('-')
+    return datetime.date(int(year), int(month), int(day))
+
+column_decoders = {
+    'str': decode_str,
+    'bytes': decode_bytes,
+    'int': decode_int,
+    'float': decode_float,
+    'date': decode_date,
+}
+
+# What the decoded values of each type are compared with in keys
+key_types = {
+    'str': unicode,
+    'bytes': str,
+    'int': (int, long),
+    'float': (float, int, long),
+    'date': datetime.date,
+}
+
+# Values that sort in the same order as the decoded ones but that marshal
+# can write, for sorting runs in ingest(). ISO dates and UTF-8 encoded text
+# already sort correctly as bytes.
+sort_decoders = dict(column_decoders, str=decode_bytes, date=decode_bytes)
+
+def encode_value(value):
     """
-    Repad the file with the new blocksize, renaming it if neccessary
+    Encode a decoded value of any of the ``Schema`` types as bytes
     """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value)
 
-    #size = parse_filename(path)
-    pos = [0]
-    block = [0]
-    fp = open(tmp, 'wb')
-    def row_callback(row, end_pos):
-        new_row = ''
-        for value in row:
-            new_row += '"'+value.replace('"','""')+'",'
-        new_row += '\r\n'
-        if pos[0]+len(new_row) > size:
-            fp.write(' '*(size-pos[0]))
-            block[0] += 1
-            pos[0] = 0
-        else:
-            fp.write(new_row)
-            pos[0] += len(new_row)
-        return True
-    #def value_callback(value):
-    #    pass #print "Value: %r" % (value,)
-    #print lex('page/data.csv', 0, row_callback, value_callback, rows=10)
-    #step('Completed Python, my version ...', type='test')
-    count, r =  lex(test_csv, 0, row_callback,  rows=None)
-    fp.close()
+class Schema(object):
+    """\
+    The types the values in each column are decoded to, given as a dictionary
+    mapping header names to one of:
+
+    ``'str'``
+        ``unicode`` (the ``default`` for columns that aren't named)
+    ``'bytes'``
+        the UTF-8 encoded bytes, as they are in the file
+    ``'int'``, ``'float'``
+        numbers, or ``None`` for an empty value
+    ``'date'``
+        a ``datetime.date`` from ``YYYY-MM-DD``, or ``None`` for an empty value
 
-def find_row(filename, key):
+    Keys are given and compared as decoded values, so ``int`` key columns
+    sort numerically rather than as text. A file read with a schema must
+    have been sorted with it too, which ``BlockWriter`` and ``ingest()`` do
+    when passed the same schema.
+    """
+    def __init__(self, types, default='str'):
+        self.types = {}
+        for name, type in types.items():
+            if type not in column_decoders:
+                raise Exception('Unknown type %r for column %r'%(type, name))
+            if isinstance(name, str):
+                name = name.decode('utf8')
+            self.types[name] = type
+        if default not in column_decoders:
+            raise Exception('Unknown default type %r'%(default,))
+        self.default = default
+
+    def column_types(self, headers):
+        """
+        Return the type of each column named in ``headers``
+        """
+        headers = [isinstance(name, str) and name.decode('utf8') or name for name in headers]
+        for name in self.types:
+            if name not in headers:
+                raise Exception('The schema names a column %r that is not in the headers'%(name,))
+        return [self.types.get(name, self.default) for name in headers]
+
+class BlockWriter(object):
     """\
-    Our naive algorithm (which turns out to be very fast) is to:
+    Write sorted rows to a new padded CSV file in one pass.
+
+    Each row is followed by ``\\r\\n``. When a row (and its ``\\r\\n``) won't
+    fit in what is left of the current block, spaces are written before the
+    previous row's ``\\r\\n`` so that the ``\\r\\n`` ends exactly at the block
+    boundary and the new row starts on it, which is where ``find_row()``
+    expects it.
 
-    * Parse the first two rows in the file
+    The first ``key_columns`` values of each row are checked to be no less
+    than the previous row's. Output is collected into ``buffer_size`` chunks
+    before being written, so memory use doesn't depend on the size of the
+    file.
 
-    Check the number of headers matches the number of values in each of the rows we have managed to parse.
-    If the value is in one of the already parsed rows, our job is done.
+    If ``headers`` is ``None`` no header row is written, which is useful for
+    writing part of a file that will be joined on to the end of another.
+    With ``write_headers=False`` the ``headers`` are only used to apply the
+    ``schema`` and aren't written either.
 
-    * Parse the last block in the file
-    * The last block tells us if the file is correctly padded
+    With ``row_offsets=True`` the start position of each row is written to a
+    ``.rows`` file alongside, for ``RowOffsets``.
 
-    If the rows aren't at a block boundary we re-pad the file and repeat try again.
+    With ``bloom_columns`` set, a ``BloomFilter`` of the first
+    ``bloom_columns`` values of each row is written to a ``.bloom`` file
+    alongside when the writer is closed, with a false positive rate of
+    ``bloom_error_rate``.
 
-    Check the number of headers matches the number of values in each of the rows we have managed to parse.
-    If the value is in one of the already parsed rows, our job is done.
+    With a ``Schema`` as ``schema``, rows may contain values of its types and
+    the keys are checked to be in the order of their decoded values, so that
+    ``int`` keys are expected to be sorted numerically.
 
-    If the value we are looking for is greater than the last block or less than the first, we return None
-    
-    Now we need to iterate:
+    ::
 
-        We choose the block in the middle of the blocks we've already found and read the first row.
-        Check the number of headers matches the number of values in each of the rows we have managed to parse.
-        If the value we are looking for is in the first row our job is done.
-        Otherwise we iterate using this block as the new lower bound if the value is higher than the value of the middle block and using it as the upper bound if the value is lower.
-        If the number of blocks between the lower and upper bound is 5 or less, we just parse them all to find the value.
-        If the value is not found we return None.
+        with BlockWriter('data.22.csv', headers) as writer:
+            for row in sorted_rows:
+                writer.write(row)
     """
-    first_block = 1
-    for value in key:
-        if not isinstance(value, unicode):
-            raise Exception('Key contains non-unicode values: %r'%(key,))
-    header_end_pos, header_rows = lex(filename, rows=1)
-    if not len(header_rows)>0:
-        raise Exception('No header in CSV')
-    headers = header_rows[0]
-    if len(headers) < len(key):
-        raise Exception('Key being asked for is longer than the number of columns')
-    end_pos, rows = lex(filename, pos=header_end_pos+1, rows=1)
-    if not len(rows)>0:
-        # No rows in the CSV file
-        raise KeyError('No rows for key %r'%(key, ))
-    if len(rows[0]) != len(headers):
-        debug('The number of columns in the first row does not match the number of headers')
-    first_block_row_key = [value.decode('utf8') for value in rows[0][:len(key)]]
-    debug("First block key: %r"%(first_block_row_key,))
-    if key == first_block_row_key:
-        return return_rows_from(filename, key, end_pos+1, [[value.decode('utf8') for value in rows[0]]])
-    block_size, a, b, c = parse_filename(filename)
-    last_block = calculate_last_block(filename, block_size)
-    if last_block <= first_block:
-        return iterate_until_finding(filename, key, header_end_pos+1)
-    end_pos, rows = lex(filename, pos=last_block*block_size, rows=1)
-    if len(rows[0]) != len(headers):
-        debug('The number of columns in the last block\'s first row does not match the number of headers')
-    last_block_row_key = [value.decode('utf8') for value in rows[0][:len(key)]]
-    debug("Last block key: %r"%(last_block_row_key,))
-    if key == last_block_row_key:
-        return return_rows_from(filename, key, end_pos+1, [[value.decode('utf8') for value in rows[0]]])
-    # If it is in the last block:
-    if key > last_block_row_key:
-        result = return_rows_from(filename, key, end_pos+1)
-        if not result:
-            raise KeyError('No rows for key %r'%(key, ))
-        return result
-    # At this point we have the headers, first row key and last row key, and the key is between the two
-    while True:
-        debug("Looping between %s and %s"%(first_block, last_block))
-        if last_block - first_block <= 1:
-            # Just search the blocks
-            debug("Searching the blocks directly")
-            return iterate_until_finding(filename, key, first_block*block_size, (last_block+1)*block_size)
-        else:
-            next_block = int((last_block + first_block)/2)
-            debug("Next block is %s"%(next_block))
-            end_pos, rows = lex(filename, pos=next_block*block_size, rows=1)
-            next_block_row_key = [value.decode('utf8') for value in rows[0][:len(key)]]
-            if key == next_block_row_key:
-                return return_rows_from(filename, key, end_pos, [value.decode('utf8') for value in rows[0]])
-            elif key > next_block_row_key:
-                first_block = next_block
-            else:
-                last_block = next_block
-    return rows[0], header_length
+    def __init__(self, filename, headers, block_size=None, key_columns=1, buffer_size=1024*1024, row_offsets=False, schema=None, bloom_columns=None, bloom_error_rate=0.01, write_headers=True):
+        self.filename = filename
+        if block_size is None:
+            block_size = parse_filename(filename)[0]
+        self.block_size = block_size
+        self.key_columns = key_columns
+        self.key_decoders = None
+        self.bloom_decoders = None
+        if schema is not None:
+            if headers is None:
+                raise Exception('The headers are needed to apply a schema')
+            self.key_decoders = [column_decoders[type] for type in schema.column_types(headers)[:key_columns]]
+            if bloom_columns:
+                self.bloom_decoders = [column_decoders[type] for type in schema.column_types(headers)[:bloom_columns]]
+        self.buffer_size = buffer_size
+        self.fp = open(filename, 'wb')
+        self.buffer = []
+        self.buffered = 0
+        # The position the next row would start at, before any padding
+        self.pos = 0
+        self.rows = 0
+        self.last_key = None
+        self.offsets_fp = None
+        self.offsets = []
+        if row_offsets:
+            self.offsets_fp = open(filename+'.rows', 'wb')
+        self.bloom_columns = bloom_columns
+        self.bloom_error_rate = bloom_error_rate
+        # The two hashes of each row's key, added to the filter on close()
+        self.bloom_hashes = (array.array('I'), array.array('I'))
+        if headers is not None and write_headers:
+            self.write_line(encode_row(headers))
 
-def iterate_until_finding(filename, key, start_pos, max_pos=None):
-    rows = []
-    def row_callback(row, end_pos):
-        if max_pos is not None and end_pos > max_pos:
-            debug("Reached %s, past the maximum of %s"%(end_pos, max_pos))
-            return False
-        pyrow = [x.decode('utf8') for x in row]
-        if pyrow[:len(key)] == key:
-            rows.append(pyrow)
-            debug("Found a row")
+    def write_line(self, line):
+        """
+        Write an encoded row, padding first if needed, and return the
+        position it starts at
+        """
+        length = len(line)
+        if length > self.block_size:
+            raise Exception('Row of %s bytes is too long for blocks of %s bytes'%(length, self.block_size))
+        if self.pos % self.block_size + length > self.block_size:
+            self.pad_block()
+        start = self.pos
+        self.buffer.append(line)
+        self.buffered += length
+        self.pos += length
+        if self.buffered >= self.buffer_size:
+            self.flush(keep_last=True)
+        return start
+
+    def write(self, row):
+        """
+        Append a row, which must not sort before the previous one, returning
+        the position it starts at
+        """
+        if self.key_decoders is not None:
+            row = [encode_value(value) for value in row]
+            key = [decode(value) for decode, value in zip(self.key_decoders, row)]
+        elif self.key_columns:
+            key = [isinstance(value, unicode) and value.encode('utf8') or value for value in row[:self.key_columns]]
+        if self.key_columns:
+            if self.last_key is not None and key < self.last_key:
+                raise Exception('Row %r sorts before the previous row %r'%(row, self.last_key))
+            self.last_key = key
+        self.rows += 1
+        start = self.write_line(encode_row(row))
+        if self.offsets_fp is not None:
+            self.offsets.append(start)
+        if self.bloom_columns:
+            values = row[:self.bloom_columns]
+            if self.bloom_decoders is not None:
+                values = [decode(value) for decode, value in zip(self.bloom_decoders, values)]
+            h1, h2 = BloomFilter.key_hashes(values)
+            self.bloom_hashes[0].append(h1)
+            self.bloom_hashes[1].append(h2)
+        return start
+
+    def write_block(self, data):
+        """
+        Write the raw bytes of a block copied from another padded file with
+        the same block size, returning the position it starts at
+        """
+        if self.pos % self.block_size:
+            self.pad_block()
+        start = self.pos
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.pos += len(data)
+        if self.buffered >= self.buffer_size:
+            self.flush(keep_last=True)
+        return start
+
+    def pad_block(self):
+        """
+        Pad the last row written so that the next one starts on a block
+        boundary
+        """
+        offset = self.pos % self.block_size
+        if offset:
+            # The previous row's \r\n is the last thing buffered
+            padding = self.block_size - offset
+            self.buffer[-1] = self.buffer[-1][:-2]+' '*padding+'\r\n'
+            self.buffered += padding
+            self.pos += padding
+
+    def flush(self, keep_last=False):
+        """
+        Write out the buffer. With ``keep_last`` the last row is kept back in
+        case padding has to be added before its ``\\r\\n``.
+        """
+        last = None
+        if keep_last and self.buffer:
+            last = self.buffer.pop()
+        self.fp.write(''.join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+        if self.offsets:
+            self.offsets_fp.write(pack_offsets(self.offsets))
+            self.offsets = []
+        if last is not None:
+            self.buffer.append(last)
+            self.buffered = len(last)
+
+    def close(self):
+        if not self.fp.closed:
+            self.flush()
+            self.fp.close()
+            if self.offsets_fp is not None:
+                self.offsets_fp.close()
+            if self.bloom_columns:
+                bloom = BloomFilter(self.filename+'.bloom', self.bloom_columns, len(self.bloom_hashes[0]), self.bloom_error_rate)
+                for h1, h2 in zip(*self.bloom_hashes):
+                    bloom.add_hashes(h1, h2)
+                bloom.count = len(self.bloom_hashes[0])
+                bloom.end = self.pos
+                bloom.save()
+                self.bloom_hashes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# The timer threads of the appenders that may still be running
+commit_timers = set()
+commit_timers_lock = threading.Lock()
+
+def cancel_commit_timers():
+    """\
+    Stop the timers of any appenders that weren't closed, so that their
+    threads have finished by the time the interpreter shuts down
+    """
+    with commit_timers_lock:
+        timers = list(commit_timers)
+        commit_timers.clear()
+    for timer in timers:
+        timer.cancel()
+        timer.join()
+
+atexit.register(cancel_commit_timers)
+
+class Appender(object):
+    """\
+    Append rows to the end of a padded CSV file while it is being read.
+
+    The position of the end of the file and the key of its last row are
+    worked out once when the appender is opened, rather than by re-reading
+    the last block for every row. Each row written is checked against the
+    last key and kept until ``commit()`` writes all the waiting rows with a
+    single ``write()``, followed by an ``fsync()`` if ``sync`` is true. A
+    commit happens automatically once ``commit_rows`` rows are waiting, and
+    on ``close()``. Rows are also committed from a timer thread once
+    ``commit_interval`` seconds have passed since the first of them was
+    written, even if nothing else is written, so an error from that commit
+    is raised by the next call to ``write()``, ``commit()`` or ``close()``.
+
+    When a row won't fit in what is left of the last block, spaces are
+    appended first so that the row starts on the next block boundary. Unlike
+    ``BlockWriter``, which pads before the previous row's ``\\r\\n``,
+    nothing already in the file is changed. ``lex()`` reads the spaces as
+    padding at the start of the next row. Since each commit is one write of
+    whole rows, a reader never sees padding without the row after it or half
+    a row.
+
+    The file is locked with ``flock()`` for each commit. If another process
+    has appended to the file since the last commit, or it has been replaced
+    by ``compact()``, its end and last key are worked out again before the
+    waiting rows are written.
+
+    If the file is empty, ``headers`` are written first. ``key_columns`` and
+    ``schema`` are as for ``BlockWriter``.
+
+    ::
+
+        with Appender('data.22.csv') as appender:
+            for row in new_rows:
+                appender.write(row)
+    """
+    def __init__(self, filename, headers=None, block_size=None, key_columns=1, commit_rows=1000, commit_interval=1.0, sync=True, schema=None):
+        self.filename = filename
+        if block_size is None:
+            block_size = parse_filename(filename)[0]
+        self.block_size = block_size
+        self.key_columns = key_columns
+        self.commit_rows = commit_rows
+        self.commit_interval = commit_interval
+        self.sync = sync
+        self.schema = schema
+        self.key_decoders = None
+        self.pending = []
+        # The bytes of the rows waiting, not counting any padding they need
+        self.pending_bytes = 0
+        self.pending_first_key = None
+        self.pending_last_key = None
+        self.rows = 0
+        self.commits = 0
+        self.lock = threading.RLock()
+        self.timer = None
+        self.error = None
+        self.fd = os.open(filename, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0666)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if not os.fstat(self.fd).st_size:
+                if headers is None:
+                    raise Exception('No header in CSV')
+                self.write_data(encode_row(headers))
+            self.read_tail()
+        except:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            raise
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def read_tail(self):
+        """
+        Find the end of the file and the key of the last row in it by parsing
+        the last block
+        """
+        self.pos = os.fstat(self.fd).st_size
+        self.last_key = None
+        with FastCSVFile(self.filename, self.block_size) as csvfile:
+            if self.schema is not None and self.key_decoders is None:
+                types = self.schema.column_types(csvfile.headers()[0])
+                self.key_decoders = [column_decoders[type] for type in types[:self.key_columns]]
+            last = None
+            for row, end_pos in csvfile.iter_raw_rows(csvfile.block_start(csvfile.last_block)):
+                last = row
+        if last is not None:
+            self.last_key = self.key(last)
+        debug("Appending at %s after the key %r"%(self.pos, self.last_key))
+
+    def key(self, row):
+        """
+        Return the key of an encoded row, as it is compared
+        """
+        if self.key_decoders is not None:
+            return [decode(value) for decode, value in zip(self.key_decoders, row)]
+        return row[:self.key_columns]
+
+    def write(self, row):
+        """
+        Add a row, which must not sort before the last one, to be written at
+        the next commit
+        """
+        row = [encode_value(value) for value in row]
+        line = encode_row(row)
+        if len(line) > self.block_size:
+            raise Exception('Row of %s bytes is too long for blocks of %s bytes'%(len(line), self.block_size))
+        with self.lock:
+            self.raise_error()
+            if self.key_columns:
+                key = self.key(row)
+                last_key = self.pending and self.pending_last_key or self.last_key
+                if last_key is not None and key < last_key:
+                    raise Exception('Row %r sorts before the previous row %r'%(row, last_key))
+                if not self.pending:
+                    self.pending_first_key = key
+                self.pending_last_key = key
+            self.pending.append(line)
+            self.pending_bytes += len(line)
+            if len(self.pending) >= self.commit_rows:
+                self.commit()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.commit_interval, self.timed_commit)
+                self.timer.daemon = True
+                with commit_timers_lock:
+                    for timer in list(commit_timers):
+                        if not timer.is_alive():
+                            commit_timers.discard(timer)
+                    commit_timers.add(self.timer)
+                self.timer.start()
+
+    def timed_commit(self):
+        """
+        Commit from the timer thread, keeping any error for the next call
+        """
+        with self.lock:
+            self.timer = None
+            if self.fd is None or self.error is not None:
+                return
+            try:
+                self.commit()
+            except Exception, e:
+                self.error = e
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def commit(self):
+        """
+        Write all the rows waiting, with any padding they need, in one go
+        """
+        with self.lock:
+            self.raise_error()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.pending:
+                self.write_pending()
+
+    def write_pending(self):
+        """
+        Append the waiting rows while holding the ``flock()`` on the file
+        """
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_ino != os.stat(self.filename).st_ino:
+                debug("The file has been replaced, by compact() say")
+                fd = os.open(self.filename, os.O_RDWR | os.O_APPEND)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                os.close(self.fd)
+                self.fd = fd
+            if os.fstat(self.fd).st_size != self.pos:
+                debug("The file has been appended to by something else")
+                self.read_tail()
+                if self.key_columns and self.last_key is not None and self.pending_first_key < self.last_key:
+                    raise Exception('Rows waiting to be appended sort before the row %r appended since'%(self.last_key,))
+            chunks = []
+            pos = self.pos
+            for line in self.pending:
+                offset = pos % self.block_size
+                if offset and offset + len(line) > self.block_size:
+                    chunks.append(' '*(self.block_size - offset))
+                    pos += self.block_size - offset
+                chunks.append(line)
+                pos += len(line)
+            self.write_data(''.join(chunks))
+            self.pos = pos
+            if self.key_columns:
+                self.last_key = self.pending_last_key
+            self.rows += len(self.pending)
+            self.commits += 1
+            self.pending = []
+            self.pending_bytes = 0
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def write_data(self, data):
+        while data:
+            data = data[os.write(self.fd, data):]
+        if self.sync:
+            os.fsync(self.fd)
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                try:
+                    self.commit()
+                finally:
+                    os.close(self.fd)
+                    self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def repad_chunk(path, start, end, tmp, size, headers=None, pad=True, schema=None, write_headers=True):
+    """\
+    Write the rows from the part of ``path`` between the positions ``start``
+    and ``end`` (or the end of the file if ``end`` is ``None``) to ``tmp``
+    padded for blocks of ``size`` bytes. Rows end in the chunk they start in.
+    With a ``schema``, the keys are checked in the order of their decoded
+    values, which needs the ``headers`` even when ``write_headers`` is false.
+
+    Unless ``pad`` is false, the last block is padded out completely so that
+    another chunk's output can be joined on to the end.
+
+    Returns the number of rows written and the first and last row keys, so
+    that the order can be checked across chunks. Used by ``repad()``,
+    possibly in another process.
+    """
+    with BlockWriter(tmp, headers, block_size=size, schema=schema, write_headers=write_headers) as writer:
+        first = []
+        def row_callback(row, end_pos):
+            if end is not None and end_pos >= end:
+                return False
+            writer.write(row)
+            if not first:
+                first.append(writer.last_key)
             return True
-        elif rows:
-            # We've stopped finding our key
-            debug("Finished finding key")
-            return False
-        # Not one we want yet, keep looking
-        return True
-    lex(filename, start_pos, row_callback, rows=None)
-    if not rows:
-        raise KeyError('No rows for key %r'%(key, ))
-    return rows
+        lex(path, start, row_callback, rows=None)
+        if pad:
+            writer.pad_block()
+    return writer.rows, first and first[0] or None, writer.last_key
 
-def return_rows_from(filename, key, pos, start_rows=None):
-    if start_rows:
-        rows = start_rows[:]
+def repad(path, tmp, size, processes=None, chunk_blocks=None, schema=None):
+    """\
+    Write the rows of ``path`` to ``tmp`` padded for the new block size.
+    You can then rename ``tmp`` to have the new block size in its name.
+    A file written with a ``Schema`` has to be re-padded with the same one,
+    since its keys are sorted by their decoded values.
+
+    With ``processes`` greater than one, the source file is split into
+    chunks of ``chunk_blocks`` of its own blocks (by default enough for four
+    chunks per process) and the chunks are parsed and re-padded in a pool of
+    that many processes. This is possible because a row always starts on
+    each block boundary of the source. Each chunk's output is padded out to a
+    whole number of blocks before the chunks are joined together, so each
+    seam wastes up to one block. How far this can be split depends on the
+    source's block size: a ``data.32.csv`` file smaller than 4GB only has one
+    block and so is re-padded in a single process.
+
+    Returns a dictionary of the rows and bytes processed, the time taken and
+    the throughput in MB/s.
+    """
+    started = time.time()
+    source_block_size = parse_filename(path)[0]
+    source_size = os.stat(path).st_size
+    headers, header_end_pos = headers_from_csv(path)
+    last_block = last_block_for_size(source_size, source_block_size)
+    if processes is None or processes < 2:
+        chunks = [(header_end_pos+1, None)]
     else:
-        rows = []
-    def row_callback(row, end_pos):
-        new_row = [x.decode('utf8') for x in row[:len(key)]]
-        if new_row != key:
-            return False
-        else:
-            rows.append(new_row+[x.decode('utf8') for x in row[len(key):]])
-            return True
-    lex(filename, pos, row_callback, rows=None)
-    return rows
+        if chunk_blocks is None:
+            chunk_blocks = max(int((last_block+1)/(processes*4)), 1)
+        chunks = []
+        for block in range(0, last_block+1, chunk_blocks):
+            chunks.append((block*source_block_size, (block+chunk_blocks)*source_block_size))
+        chunks[0] = (header_end_pos+1, chunks[0][1])
+        chunks[-1] = (chunks[-1][0], None)
+    if len(chunks) == 1:
+        rows = repad_chunk(path, chunks[0][0], None, tmp, size, headers, pad=False, schema=schema)[0]
+    else:
+        chunk_dir = tempfile.mkdtemp(prefix='fastcsv-', dir=os.path.dirname(os.path.abspath(tmp)))
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = []
+            for i in range(len(chunks)):
+                start, end = chunks[i]
+                results.append(pool.apply_async(repad_chunk, (
+                    path,
+                    start,
+                    end,
+                    os.path.join(chunk_dir, 'chunk-%06d'%(i,)),
+                    size,
+                    headers,
+                    i < len(chunks)-1,
+                    schema,
+                    i == 0,
+                )))
+            rows = 0
+            previous_key = None
+            with open(tmp, 'wb') as fp:
+                for i in range(len(results)):
+                    chunk_rows, first_key, last_key = results[i].get()
+                    if first_key is not None:
+                        if previous_key is not None and first_key < previous_key:
+                            raise Exception('Row with key %r sorts before the previous row %r'%(first_key, previous_key))
+                        previous_key = last_key
+                    rows += chunk_rows
+                    chunk_path = os.path.join(chunk_dir, 'chunk-%06d'%(i,))
+                    with open(chunk_path, 'rb') as chunk:
+                        shutil.copyfileobj(chunk, fp, 1024*1024)
+                    os.remove(chunk_path)
+        finally:
+            pool.terminate()
+            shutil.rmtree(chunk_dir)
+    seconds = time.time() - started
+    stats = {
+        'rows': rows,
+        'bytes': source_size,
+        'chunks': len(chunks),
+        'seconds': seconds,
+        'mb_per_second': seconds and source_size/seconds/1024/1024 or None,
+    }
+    debug("Repadded %(rows)s rows from %(bytes)s bytes in %(chunks)s chunks in %(seconds)0.2fs"%stats)
+    return stats
+
+def sort_run(rows, path):
+    """
+    Sort ``rows`` and write them to ``path`` for ``merge_runs()``. Used by
+    ``ingest()``, possibly in another process. With a schema the rows are
+    ``(key, row)`` pairs so that they sort by their decoded keys.
+    """
+    rows.sort()
+    with open(path, 'wb') as fp:
+        for row in rows:
+            marshal.dump(row, fp)
+    return path
+
+def read_run(path):
+    with open(path, 'rb') as fp:
+        while True:
+            try:
+                yield marshal.load(fp)
+            except EOFError:
+                return
+
+def merge_runs(paths):
+    """
+    Merge the sorted runs written by ``sort_run()`` into one sorted iterator
+    """
+    return heapq.merge(*[read_run(path) for path in paths])
+
+def ingest(source, name, key_columns, bits, run_rows=100000, processes=None, tmp_dir=None, schema=None, bloom_columns=None):
+    """\
+    Turn an unsorted CSV file into a padded, sorted ``name.<bits>.csv`` file
+    that ``find_row()`` can read, returning its filename.
+
+    ``key_columns`` is a list of header names or column numbers to sort on.
+    The key columns are moved to the front of each row, in the order given,
+    because lookups match the first values of a row. The other columns follow
+    in their original order.
+
+    The source is read with the ``csv`` module, since it doesn't have to be
+    in the padded format (and so can end rows with unquoted values, which
+    ``lex()`` doesn't support). Rows are sorted in runs of ``run_rows`` which
+    are written to temporary files in ``tmp_dir``, so memory use is bounded
+    by the run size. With ``processes`` greater than one the runs are sorted
+    in a pool of that many processes while the next runs are being read.
+    The sorted runs are then merged into a ``BlockWriter``.
+
+    With a ``Schema`` as ``schema`` the rows are sorted by their decoded
+    keys, so ``int`` key columns are sorted numerically.
+
+    ``bloom_columns`` is passed on to ``BlockWriter`` to write a
+    ``BloomFilter`` too.
+    """
+    with open(source, 'rb') as fp:
+        reader = csv.reader(fp)
+        try:
+            headers = reader.next()
+        except StopIteration:
+            raise Exception('No header in CSV')
+        key_positions = []
+        for column in key_columns:
+            if not isinstance(column, int):
+                if column not in headers:
+                    raise Exception('No column named %r in %r'%(column, source))
+                column = headers.index(column)
+            key_positions.append(column)
+        order = key_positions+[i for i in range(len(headers)) if i not in key_positions]
+        key_decoders = None
+        if schema is not None:
+            types = schema.column_types(headers)
+            key_decoders = [sort_decoders[types[i]] for i in key_positions]
+        run_dir = tempfile.mkdtemp(prefix='fastcsv-', dir=tmp_dir)
+        pool = None
+        if processes is not None and processes > 1:
+            pool = multiprocessing.Pool(processes)
+        try:
+            paths = []
+            pending = []
+            rows = []
+            def sort(rows):
+                path = os.path.join(run_dir, 'run-%06d'%(len(paths)+len(pending),))
+                if pool is None:
+                    paths.append(sort_run(rows, path))
+                    return
+                # Don't read further ahead than the pool can sort
+                if len(pending) >= processes:
+                    paths.append(pending.pop(0).get())
+                pending.append(pool.apply_async(sort_run, (rows, path)))
+            for row in reader:
+                if not row:
+                    continue
+                row = [row[i] for i in order]
+                if key_decoders is not None:
+                    row = [decode(value) for decode, value in zip(key_decoders, row)], row
+                rows.append(row)
+                if len(rows) >= run_rows:
+                    sort(rows)
+                    rows = []
+            if rows:
+                sort(rows)
+            for result in pending:
+                paths.append(result.get())
+            debug("Merging %s runs"%(len(paths),))
+            filename = '%s.%s.csv'%(name, bits)
+            with BlockWriter(filename, [headers[i] for i in order], block_size=2**bits, key_columns=len(key_positions), schema=schema, bloom_columns=bloom_columns) as writer:
+                for row in merge_runs(paths):
+                    if key_decoders is not None:
+                        row = row[1]
+                    writer.write(row)
+            return filename
+        finally:
+            if pool is not None:
+                pool.terminate()
+            shutil.rmtree(run_dir)
+
+def find_row(filename, key, cache=None):
+    """\
+    Find all the rows whose first ``len(key)`` values match ``key``.
+
+    This opens a ``FastCSVFile`` for the one lookup. If you are doing more
+    than one lookup, keep a ``FastCSVFile`` open yourself and call its
+    ``find_row()`` method so that the file isn't re-opened each time, or
+    pass the same ``BlockCache`` as ``cache`` to each call.
+    """
+    with FastCSVFile(filename, cache=cache) as csvfile:
+        return csvfile.find_row(key)
+
+lookup_pools = {}
+lookup_pools_lock = threading.Lock()
+
+def lookup_pool(filename, threads=4):
+    """\
+    Return the ``LookupPool`` for ``filename``, starting one with ``threads``
+    threads the first time it is needed
+    """
+    name = os.path.abspath(filename)
+    with lookup_pools_lock:
+        if name not in lookup_pools:
+            lookup_pools[name] = LookupPool(filename, threads)
+        return lookup_pools[name]
+
+def close_lookup_pools():
+    with lookup_pools_lock:
+        while lookup_pools:
+            lookup_pools.popitem()[1].close()
+
+def afind_row(filename, key, callback=None):
+    """\
+    Like ``find_row()`` but returns an ``AsyncResult`` straight away, with the
+    lookup done by the file's shared ``LookupPool``
+    """
+    return lookup_pool(filename).afind_row(key, callback)
+
+def afind_rows(filename, keys, callback=None):
+    """\
+    Like ``find_rows()`` but returns an ``AsyncResult`` straight away, with
+    the lookup done by the file's shared ``LookupPool``
+    """
+    return lookup_pool(filename).afind_rows(keys, callback)
+
+def iter_rows(filename, start_key=None, end_key=None, prefix=None, cache=None):
+    """\
+    Generate the decoded rows with keys from ``start_key`` up to but not
+    including ``end_key``, or with the key ``prefix``. See
+    ``FastCSVFile.iter_rows()``.
+    """
+    with FastCSVFile(filename, cache=cache) as csvfile:
+        for row in csvfile.iter_rows(start_key, end_key, prefix):
+            yield row
+
+def find_rows(filename, keys, cache=None):
+    """\
+    Find the rows for many keys of the same length in one pass over the file,
+    returning a dictionary mapping each key, as a tuple, to its list of rows
+    (which is empty if there are none)
+    """
+    with FastCSVFile(filename, cache=cache) as csvfile:
+        return csvfile.find_rows(keys)
+
+def find_by(filename, column, value):
+    with FastCSVFile(filename, secondary_columns=[column]) as csvfile:
+        return csvfile.find_by(column, value)
+
+def iterate_until_finding(filename, key, start_pos, max_pos=None, cache=None):
+    with FastCSVFile(filename, cache=cache) as csvfile:
+        return csvfile.iterate_until_finding(key, start_pos, max_pos)
+
+def return_rows_from(filename, key, pos, start_rows=None, cache=None):
+    with FastCSVFile(filename, cache=cache) as csvfile:
+        return csvfile.return_rows_from(key, pos, start_rows)
 
 
 def update_row(filename, query, updates):
     """
     Here we find the row, measure its encoded length and ensure the updates don't make it longer. If they don't we write the new row over the top of the old one.
+
+    Every row matching the key ``query``, as for ``find_row()``, is updated.
+    ``updates`` maps header names or column numbers to new values. The
+    columns in ``query`` can't be updated since the row might then belong
+    somewhere else. If any of the rows would be too long, none of them are
+    changed. The shorter row is padded with spaces to the original length.
+
+    Returns the number of rows updated, or raises a ``KeyError`` if there
+    aren't any. The ``.free`` file, if there is one, is updated too, and
+    any ``SecondaryIndex`` files are removed to be rebuilt.
+    Readers may see a row while it is being overwritten.
     """
-    pass
+    if not updates:
+        raise Exception('No columns to update were given for the key %r'%(query,))
+    with FastCSVFile(filename, free_space=os.path.exists(filename+'.free')) as csvfile:
+        headers = [name.decode('utf8') for name in csvfile.headers()[0]]
+        columns = {}
+        for column, value in updates.items():
+            if not isinstance(column, int):
+                if isinstance(column, str):
+                    column = column.decode('utf8')
+                if column not in headers:
+                    raise Exception('No column named %r'%(column,))
+                column = headers.index(column)
+            if column < len(query):
+                raise Exception('Column %s is part of the key so cannot be updated'%(column,))
+            columns[column] = encode_value(value)
+        with open(filename, 'r+b') as fp:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            try:
+                writes = []
+                for start, end_pos, row in csvfile.locate(query):
+                    new = row + ['']*(max(columns.keys())+1-len(row))
+                    for column, value in columns.items():
+                        new[column] = value
+                    line = encode_row(new)
+                    # Any padding before the block boundary isn't part of the row
+                    start = max(start, int(end_pos/csvfile.block_size)*csvfile.block_size)
+                    length = end_pos+1-start
+                    if len(line) > length:
+                        raise Exception('The updated row %r needs %s bytes but only %s are available'%(new, len(line), length))
+                    padding = ' '*(length-len(line))
+                    if line.endswith('"\r\n'):
+                        line = line[:-2]+padding+'\r\n'
+                    else:
+                        line = padding+line
+                    writes.append((start, end_pos, line, len(encode_row(row))-len(encode_row(new))))
+                if not writes:
+                    raise KeyError('No rows for key %r'%(query, ))
+                for start, end_pos, line, freed in writes:
+                    fp.seek(start)
+                    fp.write(line)
+                    if csvfile.free is not None:
+                        csvfile.free.shrink(int(end_pos/csvfile.block_size), freed)
+                fp.flush()
+                if csvfile.free is not None:
+                    csvfile.free.save()
+                # The updated values might be indexed
+                for path in secondary_index_paths(filename):
+                    os.remove(path)
+            finally:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+        return len(writes)
 
 def new_row(filename, row):
     """
     We read the last block of the file and check the new row comes after the last row in the file. If the new row fits in the current last block, we append the new row, otherwise we append padding and then the new row to start a new block.
+
+    To append many rows, keep an ``Appender`` open instead so that the last
+    block is only read once and the rows are written in batches.
     """
-    pass
+    with Appender(filename) as appender:
+        appender.write(row)
 
 def delete_row(filename, row):
     """
     We find the row and overwrite it with spaces unless it is the last row, in which case the file is truncated.
+
+    Every row matching ``row`` as a key, as for ``find_row()``, is deleted,
+    so pass a whole row to delete just that one. Returns the number of rows
+    deleted, or raises a ``KeyError`` if there aren't any.
+
+    The ``lex()`` functions read the spaces as padding before the next row.
+    The ``.free`` and ``.idx`` files are updated if there are any. Row
+    numbers change, so the ``.rows`` file and any ``SecondaryIndex`` files
+    are removed to be rebuilt.
+    """
+    with FastCSVFile(filename, free_space=os.path.exists(filename+'.free')) as csvfile:
+        with open(filename, 'r+b') as fp:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            try:
+                csvfile.refresh()
+                found = csvfile.locate(row)
+                if not found:
+                    raise KeyError('No rows for key %r'%(row, ))
+                size = csvfile.size
+                blocks = set()
+                for start, end_pos, deleted in reversed(found):
+                    block = int(end_pos/csvfile.block_size)
+                    blocks.add(block)
+                    if end_pos+1 == size:
+                        size = start
+                    else:
+                        fp.seek(start)
+                        fp.write(' '*(end_pos+1-start))
+                    if csvfile.free is not None:
+                        csvfile.free.remove(block, len(encode_row(deleted)))
+                if size < csvfile.size:
+                    # Don't leave the space from deleted rows at the end
+                    while size and size > csvfile.block_start(0):
+                        fp.seek(max(size-4096, 0))
+                        chunk = fp.read(size-max(size-4096, 0))
+                        stripped = chunk.rstrip(' ')
+                        size -= len(chunk)-len(stripped)
+                        if stripped:
+                            break
+                    fp.truncate(size)
+                    # Rows appended later would start before where the
+                    # filter was last extended from
+                    if os.path.exists(filename+'.bloom'):
+                        os.remove(filename+'.bloom')
+                fp.flush()
+                csvfile.refresh()
+                if csvfile.free is not None:
+                    csvfile.free.extend(csvfile)
+                    csvfile.free.save()
+                path = filename+'.idx'
+                if os.path.exists(path):
+                    index = BlockIndex.load(path, csvfile.decode)
+                    del index.keys[csvfile.last_block+1:]
+                    for block in sorted(blocks):
+                        if block < len(index.keys):
+                            key = csvfile.first_key(block, index.key_columns)
+                            if key is None:
+                                del index.keys[block:]
+                                break
+                            index.keys[block] = tuple(key)
+                    index.save(path)
+                for path in [filename+'.rows']+secondary_index_paths(filename):
+                    if os.path.exists(path):
+                        os.remove(path)
+            finally:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+        return len(found)
+
+def compact(filename, threshold=0.5, block_size=None):
+    """\
+    Reclaim the space left in a padded CSV file by deleted rows and by
+    updates that made rows shorter, without rewriting the whole file the way
+    ``repad()`` does.
+
+    Using the ``.free`` file (which is built if there isn't one), blocks with
+    no live rows are dropped and blocks where more than ``threshold`` of the
+    space is dead have their rows parsed and packed together into as few
+    blocks as possible. Every other block is copied across as it is without
+    being parsed. The new file then replaces the old one.
+
+    Block numbers and row positions change, so the ``.idx``, ``.rows``,
+    ``.bloom`` and ``SecondaryIndex`` files are removed to be rebuilt and a
+    new ``.free`` file is written.
+    The file is locked for the duration so ``Appender`` commits wait and then
+    carry on with the new file.
+
+    Returns a dictionary of statistics.
+    """
+    start_time = time.time()
+    tmp = filename+'.compact'
+    with FastCSVFile(filename, block_size, free_space=True) as csvfile:
+        fcntl.flock(csvfile.fp.fileno(), fcntl.LOCK_EX)
+        try:
+            csvfile.refresh()
+            free = csvfile.free
+            block_size = csvfile.block_size
+            stats = {'blocks': csvfile.last_block+1, 'copied': 0, 'repacked': 0, 'dropped': 0, 'bytes_before': csvfile.size}
+            # The live rows and used bytes of each block of the new file
+            live = []
+            used = []
+            def count(start, length, rows, dead=None):
+                block = int(start/block_size)
+                while len(live) <= block:
+                    live.append(0)
+                    used.append(0)
+                live[block] += rows
+                if dead is None:
+                    used[block] += length
+                else:
+                    used[block] += length-dead
+            with BlockWriter(tmp, None, block_size, key_columns=0) as writer:
+                for block in range(csvfile.last_block+1):
+                    if block and not free.is_live(block):
+                        stats['dropped'] += 1
+                        continue
+                    if free.dead[block] <= threshold*block_size:
+                        csvfile.fp.seek(block*block_size)
+                        data = csvfile.fp.read(block_size)
+                        count(writer.write_block(data), len(data), free.live[block], free.dead[block])
+                        stats['copied'] += 1
+                        continue
+                    stats['repacked'] += 1
+                    if block == 0:
+                        line = encode_row(csvfile.headers()[0])
+                        count(writer.write_line(line), len(line), 0)
+                    block_end = (block+1)*block_size
+                    def row_callback(row, end_pos):
+                        if end_pos >= block_end:
+                            return False
+                        start = writer.write(row)
+                        count(start, writer.pos-start, 1)
+                        return True
+                    csvfile.lex(csvfile.block_start(block), row_callback, rows=None)
+                stats['bytes_after'] = writer.pos
+            size = stats['bytes_after']
+            dead = []
+            for block in range(len(live)):
+                dead.append(min(block_size, size-block*block_size)-used[block])
+            os.rename(tmp, filename)
+            FreeSpaceMap(filename+'.free', live, dead).save()
+            for path in [filename+'.idx', filename+'.rows', filename+'.bloom']+secondary_index_paths(filename):
+                if os.path.exists(path):
+                    os.remove(path)
+        finally:
+            fcntl.flock(csvfile.fp.fileno(), fcntl.LOCK_UN)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    stats['seconds'] = time.time()-start_time
+    debug("Compacted %(blocks)s blocks, copying %(copied)s, repacking %(repacked)s and dropping %(dropped)s, from %(bytes_before)s to %(bytes_after)s bytes in %(seconds)0.2fs"%stats)
+    return stats
+
+class Reducer(object):
+    """\
+    Combines the rows ``scan()`` finds into its result. This one just
+    collects them into a list.
+
+    ``start()`` returns the initial value for a chunk of the file,
+    ``add(value, row)`` returns it with ``row`` included, and
+    ``merge(values)`` combines the values of all the chunks, which are given
+    in the order of the chunks in the file. To be used with more than one
+    worker, a reducer has to be picklable, so should be an instance of a
+    class defined at module level.
+    """
+    def start(self):
+        return []
+
+    def add(self, value, row):
+        value.append(row)
+        return value
+
+    def merge(self, values):
+        rows = []
+        for value in values:
+            rows.extend(value)
+        return rows
+
+class Count(Reducer):
+    """
+    Count the rows
+    """
+    def start(self):
+        return 0
+
+    def add(self, value, row):
+        return value + 1
+
+    def merge(self, values):
+        return sum(values)
+
+class Sum(Reducer):
+    """\
+    Add up the values at ``index`` in the rows, which is their position in
+    the ``columns`` passed to ``scan()``. Empty values are skipped.
+    """
+    def __init__(self, index=0):
+        self.index = index
+
+    def start(self):
+        return 0
+
+    def add(self, value, row):
+        if row[self.index] is None:
+            return value
+        return value + row[self.index]
+
+    def merge(self, values):
+        return sum(values)
+
+def scan_chunk(filename, block_size, schema, start, end, cols, predicate, reducer):
+    """\
+    Reduce the rows from the part of ``filename`` between the positions
+    ``start`` and ``end`` (or the end of the file if ``end`` is ``None``)
+    that match ``predicate``, parsing only the columns in ``cols``. Rows end
+    in the chunk they start in. Used by ``scan()``, possibly in another
+    process.
+    """
+    with FastCSVFile(filename, block_size, schema=schema) as csvfile:
+        types = csvfile.types()
+        if cols is None:
+            wanted = None
+            decoders = [column_decoders[type] for type in types]
+        else:
+            wanted = sorted(set(cols))
+            decoders = [column_decoders[i < len(types) and types[i] or 'str'] for i in wanted]
+            # Where each column asked for is in the projected row
+            order = [wanted.index(i) for i in cols]
+        value = [reducer.start()]
+        def row_callback(row, end_pos):
+            if end is not None and end_pos >= end:
+                return False
+            if len(row) < len(decoders):
+                row = row + ['']*(len(decoders)-len(row))
+            row = [decode(raw) for decode, raw in zip(decoders, row)]
+            if wanted is not None:
+                row = [row[i] for i in order]
+            if predicate is None or predicate(row):
+                value[0] = reducer.add(value[0], row)
+            return True
+        if start < csvfile.size:
+            csvfile.lex(start, row_callback, rows=None, cols=wanted)
+    return value[0]
+
+def scan(filename, predicate=None, columns=None, reducer=None, workers=1, chunk_blocks=None, block_size=None, schema=None):
+    """\
+    Parse every row of a padded CSV file, returning the rows for which
+    ``predicate(row)`` is true (or all of them) combined by ``reducer``.
+
+    ``columns`` is a list of header names or column numbers. Only those
+    columns are parsed out and decoded, and the rows are lists of their
+    values in that order. Without ``columns`` the rows are whole. Values are
+    decoded to the types of ``schema`` if there is one, otherwise to
+    ``unicode``.
+
+    ``reducer`` is a ``Reducer`` such as ``Count()`` or ``Sum(index)``.
+    Without one, the list of matching rows is returned in the order they are
+    in the file, and so in key order.
+
+    Like ``repad()``, the file is split into chunks of ``chunk_blocks``
+    blocks (by default enough for four chunks per worker) since a row always
+    starts on a block boundary. The chunks are scanned in a pool of
+    ``workers`` processes (one per CPU if ``workers`` is ``None``) and the
+    chunks' results are merged in file order. By default the file is
+    scanned in this process, as one chunk.
+
+    With more than one worker, ``predicate`` and ``reducer`` are pickled to
+    be sent to the pool, so they have to be importable at module level. A
+    lambda, a nested function or an instance of a class defined inside a
+    function can't be pickled, and an ``Exception`` saying so is raised
+    before any chunks are scanned.
+    """
+    if block_size is None:
+        block_size = parse_filename(filename)[0]
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    cols = None
+    if columns is not None:
+        cols = column_numbers(headers_from_csv(filename)[0], columns)
+    if workers < 2:
+        chunks = scan_chunks(filename, block_size)
+    else:
+        if chunk_blocks is None:
+            last_block = last_block_for_size(os.stat(filename).st_size, block_size)
+            chunk_blocks = max(int((last_block+1)/(workers*4)), 1)
+        chunks = scan_chunks(filename, block_size, chunk_blocks)
+    return run_scan(chunks, predicate, cols, reducer, workers, schema)
+
+def column_numbers(headers, columns):
+    """
+    Return the positions in ``headers`` of ``columns``, which are header
+    names or column numbers
+    """
+    headers = [name.decode('utf8') for name in headers]
+    cols = []
+    for column in columns:
+        if not isinstance(column, int):
+            if isinstance(column, str):
+                column = column.decode('utf8')
+            if column not in headers:
+                raise Exception('No column named %r'%(column,))
+            column = headers.index(column)
+        cols.append(column)
+    return cols
+
+def scan_chunks(filename, block_size, chunk_blocks=None):
+    """\
+    Split ``filename`` into chunks of ``chunk_blocks`` blocks for
+    ``run_scan()``, or just one chunk if ``chunk_blocks`` is ``None``,
+    returning a list of ``(filename, block_size, start, end)`` tuples
+    """
+    header_end_pos = headers_from_csv(filename)[1]
+    if chunk_blocks is None:
+        return [(filename, block_size, header_end_pos+1, None)]
+    last_block = last_block_for_size(os.stat(filename).st_size, block_size)
+    chunks = []
+    for block in range(0, last_block+1, chunk_blocks):
+        chunks.append((filename, block_size, block*block_size, (block+chunk_blocks)*block_size))
+    chunks[0] = chunks[0][:2]+(header_end_pos+1, chunks[0][3])
+    chunks[-1] = chunks[-1][:3]+(None,)
+    return chunks
+
+def run_scan(chunks, predicate, cols, reducer, workers, schema=None):
     """
-    pass
+    Scan the ``chunks`` from ``scan_chunks()`` in a pool of ``workers``
+    processes, merging their results in order
+    """
+    if reducer is None:
+        reducer = Reducer()
+    debug("Scanning %s chunk(s) with %s worker(s)"%(len(chunks), workers))
+    if workers < 2 or len(chunks) == 1:
+        return reducer.merge([scan_chunk(filename, block_size, schema, start, end, cols, predicate, reducer) for filename, block_size, start, end in chunks])
+    # Fail here with a clear message, rather than from the pool's thread
+    for name, value in [('predicate', predicate), ('reducer', reducer)]:
+        try:
+            cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            raise Exception('The %s %r has to be picklable to scan with %s workers, so it must be importable at module level rather than a lambda or nested function: %s'%(name, value, workers, e))
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = []
+        for filename, block_size, start, end in chunks:
+            results.append(pool.apply_async(scan_chunk, (filename, block_size, schema, start, end, cols, predicate, reducer)))
+        return reducer.merge([result.get() for result in results])
+    finally:
+        pool.terminate()
 
 def headers_from_csv(filename):
     """
@@ -258,339 +1478,2941 @@ def headers_from_csv(filename):
     return rows[0], header_length
 
 def calculate_last_block(filename, block_size):
-    size = os.stat(filename).st_size
-    if size/block_size < 1:
+    return last_block_for_size(os.stat(filename).st_size, block_size)
+
+def last_block_for_size(size, block_size):
+    """
+    Return the number of the last block containing any data in a file of
+    ``size`` bytes
+    """
+    if size <= block_size:
         return 0
-    # Remove the remainder
-    last = int(size/block_size)
-    return last
+    # Remove the remainder. A file that exactly fills its last block doesn't
+    # have any data in the block after it.
+    return int((size-1)/block_size)
 
-try:
-    raise Exception('Use pure Python')
-    from ctypes import *
-
-    make_callback_value = CFUNCTYPE(None, c_char_p)
-    make_callback_row = CFUNCTYPE(None)
-    # gcc -Wall -c -fPIC fastcsv.c -o fastcsv.o
-    # gcc -shared -Wl,-soname,libfastcsv.so.0 -o libfastcsv.so.0.0.1 fastcsv.o
-    fastcsv = cdll.LoadLibrary(os.path.join(os.path.abspath(os.path.dirname(__file__)), "libfastcsv.so.0.0.1"))
-    def lex(filename, pos=0, row_callback=None, value_callback=None, rows=1, cols=None):
-        rowsi = []
-        rowi = []
-        if value_callback:
-            def callback_value_wrapper(value):
-                #print 1,
-                if value:
-                    rowi.append(value)
-                else:
-                    rowi.append("")
-                value_callback(rowi[-1])
-                return None
-        else:
-            def callback_value_wrapper(value):
-                #print 2,
-                if value:
-                    rowi.append(value)
-                else:
-                    rowi.append("")
-                return None
-        callback_value = make_callback_value(callback_value_wrapper)
-        if row_callback:
-            def callback_row_wrapper():
-                #print 3,
-                length = 0
-                for item in rowi:
-                    length += len(item)
-                result = row_callback(rowi, pos+length)
-                rowsi.append(rowi[:])
-                while rowi:
-                    rowi.pop()
-                return result
-        else:
-            def callback_row_wrapper():
-                #print 4,
-                length = 0
-                for item in rowi:
-                    length += len(item)
-                rowsi.append(rowi[:])
-                while rowi:
-                    rowi.pop()
-                return True
-        callback_row = make_callback_row(callback_row_wrapper)
-        if rows is None:
-            rows = -1
-        end = fastcsv.lex(filename, pos, rows, callback_value, callback_row)
-        #print end, rowsi
-        return end, rowsi
-except:
-    def lex(filename, pos=0, row_callback=None, value_callback=None, rows=1, cols=None):
-        """\
-        Open a file at the specified position and start parsing the rows, calling
-        ``value_calback()`` every time a value is found and ``row_callback()``
-        every time a row is completed.
-        """
-        with open(filename, "rb") as fp:
-            row_data = []
-            fp.seek(pos)
-            row_callback_count = 0
-            state = ROW_START
-            value = ''
-            row = []
-            final = pos
-            keep_going = True
-            while True:
-                chars = fp.read(4096)
-                if not chars:
-                    if row:
-                        if value_callback:
-                            value_callback(value)
-                        row.append(value)
-                        if row_callback:
-                            keep_going = row_callback(row, final-1)
-                            if keep_going not in [True, False]:
-                                raise Exception("Row callback failed to return True or False")
-                        else:
-                            row_data.append(row)
-                    return final-1, row_data
-                for char in chars: 
-                    final+=1
-                    if state == IN_QUOTED:
-                        if char == '"':
-                            state = FIRST_QUOTE_OR_END_QUOTED
-                        else:
-                            value += char
-                    elif state == IN_UNQUOTED:
-                        if char == '"':
-                            warn('Found a %r character in an unquoted value at %s, assuming a quote was missed from the front of the value and continuing'%(char, final-1,))
-                            state = FIRST_QUOTE_OR_END_QUOTED
-                        elif char  == ',':
-                            state = COMMA
-                            row.append(value)
-                            if value_callback:
-                                value_callback(value)
-                            value = ''
-                        elif char in [' ']:
-                            warn('Found a %r character in an unquoted value at %s, assuming the quoting was accidentally forgotten and continuing, expecting to a quote was missed from the front of the value and continuing'%(char, final-1,))
-                            state = FIRST_QUOTE_OR_END_QUOTED
-                        else:
-                            value += char 
-                    elif state == ROW_START:
-                        if char == '\n':
-                            # XXX raise Exception(r'Expected \r\n at position %s, not \n'%(final-1,))
-                            warn(r'Expected \r\n at position %s, not \n'%(final-1,))
-                        elif char == '\r':
-                            state = NON_VALUE_CR
-                        elif char == ',':
-                            if value_callback:
-                                value_callback(value)
-                            value = ''
-                            state == COMMA
-                        elif char == '"':
-                            state = IN_QUOTED
-                        elif char == ' ':
-                            state = PRE_PADDING
-                        else:
-                            state = IN_UNQUOTED
-                            value += char
-                    elif state == PRE_PADDING:
-                        if char == ' ':
-                            continue
-                            # XXX Depending on the implementation, might want to add this:
-                            # value += char
-                        elif char == '\r':
-                            state = NON_VALUE_CR
-                        elif char == ',':
-                            warn('We found a %r at the end of a row at %s, assuming that it was supposed to be \'\\r\\n\' and continuing'%(char, final-1,))
-    
-                            if value_callback:
-                                value_callback(value)
-                            row.append(value)
-                            value = ''
-                            state = COMMA
-                        elif char == '\n':
-                            warn('We found a %r at the end of a row at %s, assuming that it was supposed to be \'\\r\\n\' and continuing'%(char, final-1,))
-    
-                            if value_callback:
-                                value_callback(value)
-                            row.append(value)
-                            if row_callback:
-                                keep_going = row_callback(row, final-1)
-                                if keep_going not in [True, False]:
-                                    raise Exception("Row callback failed to return True or False")
-                            else:
-                                row_data.append(row)
-                            row_callback_count += 1
-                            if not keep_going or (rows != None and row_callback_count >= rows): 
-                                return final-1, row_data
-                            row = []
-                            value = ''
-                            state = ROW_START
-                        elif char == '"':
-                            state = IN_QUOTED
-                        else:
-                            state = IN_UNQUOTED
-                            value += char
-                    elif state == FIRST_QUOTE_OR_END_QUOTED:
-                        if char == '"':
-                            value += char
-                            state = IN_QUOTED
-                        elif char == ' ':
-                            state = END_PADDING
-                        elif char == '\r':
-                            state = NON_VALUE_CR
-                        elif char == '\n':
-                            warn('We found a %r at the end of a row at %s, assuming that it was supposed to be \'\\r\\n\' and continuing'%(char, final-1,))
-    
-                            if value_callback:
-                                value_callback(value)
-                            row.append(value)
-                            if row_callback:
-                                keep_going = row_callback(row, final-1)
-                                if keep_going not in [True, False]:
-                                    raise Exception("Row callback failed to return True or False")
-                            else:
-                                row_data.append(row)
-                            row_callback_count += 1
-                            if not keep_going or (rows != None and row_callback_count >= rows):
-                                return final-1, row_data
-                            row = []
-                            value = ''
-                            state = ROW_START
-                        elif char == ',':
-                            state = COMMA
-                            if value_callback:
-                                value_callback(value)
-                            row.append(value)
-                            value = ''
-                        else:
-                            raise Exception('Expected a second %r character at %s or a comma or space, not %r'%('"', final-1, char))
-                    elif state == END_PADDING:
-                        if char == ' ':
-                            continue
-                        elif char == ',':
-                            state = COMMA
-                        elif char == '\r':
-                            state = NON_VALUE_CR
-                        elif char == '\n':
-                            warn('We found a \'\\n\' at the end of a row at %s, assuming that it was supposed to be \'\\r\\n\' and continuing'%(ifnal-1,))
-                            if value_callback:
-                                value_callback(value)
-                            row.append(value)
-                            if row_callback:
-                                keep_going = row_callback(row, final-1)
-                                if keep_going not in [True, False]:
-                                    raise Exception("Row callback failed to return True or False")
-                            else:
-                                row_data.append(row)
-                            row_callback_count += 1
-                            if not keep_going or (rows != None and row_callback_count >= rows): 
-                                return final-1, row_data
-                            row = []
-                            value = ''
-                            state = ROW_START
-                        else:
-                            raise Exception('Expected a comma, space or newline after the padding at %s, not a %r'%(final-1, char))
-                    elif state == COMMA:
-                        if char == '\n':
-                            warn('We found a \'\\n\' at the end of a row at %s, assuming that it was supposed to be \'\\r\\n\' and continuing'%(final-1,))
-                            if value_callback:
-                                value_callback(value)
-                            row.append(value)
-                            if row_callback:
-                                keep_going = row_callback(row, final-1)
-                                if keep_going not in [True, False]:
-                                    raise Exception("Row callback failed to return True or False")
-                            else:
-                                row_data.append(row)
-                            row_callback_count += 1
-                            if not keep_going or (rows != None and row_callback_count >= rows): 
-                                return final-1, row_data
-                            row = []
-                            value = ''
-                            state = ROW_START
-                        elif char == '\r':
-                            state = NON_VALUE_CR
-                        elif char == ' ':
-                            state = PRE_PADDING
-                        elif char == '"':
-                            state = IN_QUOTED
-                        elif char == ',':
-                            if value_callback:
-                                value_callback('')
-                            row.append('')
-                        else:
-                            state = IN_UNQUOTED
-                            value += char
-                    elif state == NON_VALUE_CR:
-                        if char != '\n':
-                            raise Exception('Expected \'\\r\\n\' at position %s, not \'\r%s\''%(final0, char))
-                        else:
-                            if value_callback:
-                                value_callback(value)
-                            row.append(value)
-                            if row_callback:
-                                keep_going = row_callback(row, final-1)
-                                if keep_going not in [True, False]:
-                                    raise Exception("Row callback failed to return True or False")
-                            else:
-                                row_data.append(row)
-                            row_callback_count += 1
-                            if not keep_going or (rows != None and row_callback_count >= rows):
-                                return final-1, row_data
-                            row = []
-                            value = ''
-                            state = ROW_START
-
-
-if __name__ == '__main__':
-
-    test_csv = '/home/james/fastcsv/orig/5/data.gov.uk/data.32.csv'
-    #repad(
-    #    '/home/james/fastcsv/orig/5/data.gov.uk/data.32.csv', 
-    #    '/home/james/fastcsv/orig/5/data.gov.uk/data.22.csv', 
-    #    2**22
-    #)
-    print find_row('/home/james/fastcsv/orig/5/data.gov.uk/data.22.csv', [u"518d566f-1b8d-4be4-996d-8ad984be980d"])
-
-
-
-    #header, length = headers_from_csv(test_csv)
-    #print header, length
-    ##print header.keys()
-    ##import sys
-    ##sys.exit(0)
-
-    #number = 400
-
-    #import csv 
-    ##step('Starting Python version ...', type='test')
-    #rows = []
-    #with open(test_csv, 'rb') as fp:
-    #    reader = csv.reader(fp, delimiter=',', quotechar='"', skipinitialspace=True)
-    #    counter = 0
-    #    for row in reader:
-    #        rows.append(row)
-    #        counter += 1
-    #        if counter == number:
-    #            break
-
-    #rows1 = []
-    #def row_callback(row, end_pos):
-    #    rows1.append(row)
-    #    return True
-    ##def value_callback(value):
-    ##    pass #print "Value: %r" % (value,)
-    ##print lex('page/data.csv', 0, row_callback, value_callback, rows=10)
-    ##step('Completed Python, my version ...', type='test')
-    #count, r =  lex(test_csv, 0, row_callback,  rows=number)
-    ##step('Done', type='test')
-    #print len(rows1[1]), len(rows[1])
-    ##step('Done', type='test')
-    #for i in range(len(rows)):
-    #    if i > len(rows)-1:
-    #        import pdb; pdb.set_trace()
-    #    elif i > len(rows1)-1:
-    #        import pdb; pdb.set_trace()
-    #    elif rows[i] != rows1[i]:
-    #        import pdb; pdb.set_trace()
-    #assert rows1 == rows
+class FastCSVFile(object):
+    """\
+    Keep one read handle open on a padded CSV file so that repeated lookups
+    don't have to open, stat and close the file each time.
+
+    The headers, block size and last block are worked out once and cached.
+    The file size is re-checked with an ``fstat()`` on the open handle at the
+    start of each lookup so that rows appended since the last call are seen.
+    If the file has been replaced, by ``compact()`` say, it is opened again
+    along with its sidecars, and once it has changed at all, a ``.rows`` or
+    ``SecondaryIndex`` file that has been removed or replaced, by
+    ``delete_row()`` say, is opened (or built) again.
+
+    With ``index_columns=N`` a ``BlockIndex`` of the first ``N`` values of
+    the first row of each block is loaded from the ``.idx`` file next to the
+    CSV file (or built and saved if there isn't one) and the bisection happens
+    in memory. It is extended when the file grows.
+
+    With ``row_offsets=True`` a ``RowOffsets`` index of where every row
+    starts is loaded from the ``.rows`` file next to the CSV file (or built if
+    there isn't one) so that ``read_row()``, ``read_rows()`` and ``cursor()``
+    can go straight to any row. It is extended when the file grows.
+
+    With ``use_mmap=True`` the file is memory-mapped and rows are parsed with
+    ``lex_mmap()``, slicing values directly out of the mapping. Only the pages
+    visited by the bisection and the final scan are ever read from disk.
+
+    With a ``BlockCache`` as ``cache``, the headers and the first row of each
+    block probed by the bisection are cached after being parsed, and (unless
+    the file is memory-mapped) other reads are served from whole blocks kept
+    in the cache.
+
+    With ``bloom_columns`` set, lookups for keys of that many values are
+    first checked against a ``BloomFilter`` so that most keys that aren't in
+    the file raise a ``KeyError`` without any of it being read. The filter is
+    loaded from the ``.bloom`` file next to the CSV file, or built with a
+    false positive rate of ``bloom_error_rate`` if there isn't one, on the
+    first lookup.
+
+    With ``free_space=True`` a ``FreeSpaceMap`` of the live rows in each
+    block is loaded from the ``.free`` file next to the CSV file (or built if
+    there isn't one) so that blocks whose rows have all been deleted are
+    skipped rather than parsed. It is extended when the file grows.
+
+    With a ``Schema`` as ``schema``, values are decoded to its types and
+    keys must be given as values of those types. Otherwise every value is
+    decoded to ``unicode``. ``find_batch()`` and ``range_batch()`` return the
+    rows as a ``RowBatch``, decoding only the columns asked for.
+
+    With ``secondary_columns``, a list of header names or column numbers,
+    a ``SecondaryIndex`` is opened (or built) for each column so that
+    ``find_by()`` can find rows by the value in that column. They are
+    extended when the file grows.
+
+    With a function as ``trace``, each ``find_row()`` and ``find_rows()``
+    call is measured and ``trace`` is called with its ``LookupStats``
+    afterwards, whether or not it raised an exception. The totals are also
+    added to ``counters``. Without one the only cost is checking whether
+    ``self.stats`` is set.
+
+    ::
+
+        with FastCSVFile('data.22.csv') as csvfile:
+            for key in keys:
+                rows = csvfile.find_row(key)
+    """
+    def __init__(self, filename, block_size=None, use_mmap=False, index_columns=None, cache=None, row_offsets=False, schema=None, free_space=False, bloom_columns=None, bloom_error_rate=0.01, trace=None, secondary_columns=None):
+        self.filename = filename
+        if block_size is None:
+            block_size = parse_filename(filename)[0]
+        self.block_size = block_size
+        self.fp = open(filename, 'rb')
+        self.use_mmap = use_mmap
+        self.mapped = None
+        self.cache = cache
+        if cache is not None:
+            self.cache_name = os.path.abspath(filename)
+        self.size = None
+        self.mtime = None
+        self.last_block = None
+        self._headers = None
+        self.schema = schema
+        self._types = None
+        self.index = None
+        self.offsets = None
+        self.free = None
+        self.secondary = {}
+        self.bloom = None
+        self.bloom_columns = bloom_columns
+        self.bloom_error_rate = bloom_error_rate
+        self.trace = trace
+        # The LookupStats of the lookup being traced
+        self.stats = None
+        self.refresh()
+        self.open_sidecars(free_space, index_columns, row_offsets, [self.column_number(column) for column in secondary_columns or []])
+
+    def open_sidecars(self, free_space, index_columns, row_offsets, secondary_columns):
+        if free_space:
+            self.free = FreeSpaceMap.open(self)
+        if index_columns is not None:
+            self.index = BlockIndex.open(self, index_columns)
+        if row_offsets:
+            self.offsets = RowOffsets(self.filename+'.rows')
+            self.offsets.update(self)
+        for column in secondary_columns:
+            self.secondary[column] = SecondaryIndex.open(self, column)
+
+    def replaced(self, stat):
+        """
+        Return ``True`` if ``filename`` is no longer the file that is open
+        """
+        try:
+            return os.stat(self.filename).st_ino != stat.st_ino
+        except OSError:
+            return False
+
+    def reopen(self):
+        """
+        Open the file again after it has been replaced, along with the
+        sidecars that were open, since none of them describe the new file
+        """
+        debug("The file has been replaced, by compact() say, opening it again")
+        sidecars = (
+            self.free is not None,
+            self.index is not None and self.index.key_columns or None,
+            self.offsets is not None,
+            sorted(self.secondary.keys()),
+        )
+        self.close()
+        self.fp = open(self.filename, 'rb')
+        self.size = None
+        self.mtime = None
+        self.last_block = None
+        self._headers = None
+        self.index = None
+        self.offsets = None
+        self.free = None
+        self.secondary = {}
+        self.bloom = None
+        if self.cache is not None:
+            self.cache.invalidate(self.cache_name)
+        self.refresh()
+        self.open_sidecars(*sidecars)
+
+    def reload_sidecars(self):
+        """
+        Open the ``.rows`` and ``SecondaryIndex`` files again if they have
+        been removed or replaced since they were opened
+        """
+        if self.offsets is not None and self.offsets.replaced():
+            debug("Row offsets %r have been replaced, opening them again"%(self.offsets.path,))
+            self.offsets.close()
+            self.offsets = RowOffsets(self.filename+'.rows')
+            self.offsets.update(self)
+        for column, index in self.secondary.items():
+            if sidecar_stamp(index.path) != index.stamp:
+                debug("Secondary index %r has been replaced, opening it again"%(index.path,))
+                index.close()
+                self.secondary[column] = SecondaryIndex.open(self, column, index.run_rows, index.merge_rows)
+
+    def refresh(self):
+        """
+        Check whether the file has been replaced or has changed, and update
+        the last block and the sidecars if it has
+        """
+        stat = os.fstat(self.fp.fileno())
+        if self.size is not None and self.replaced(stat):
+            self.reopen()
+            return self.size
+        size = stat.st_size
+        if self.cache is not None:
+            self.cache.validate(self.cache_name, size, stat.st_mtime)
+        resized = size != self.size
+        if resized:
+            debug("File size changed from %s to %s"%(self.size, size))
+            self.size = size
+            self.last_block = last_block_for_size(size, self.block_size)
+            if self.use_mmap:
+                self.remap()
+        if stat.st_mtime != self.mtime:
+            self.mtime = stat.st_mtime
+            self.reload_sidecars()
+        if resized:
+            # Sidecars are only extended in memory here, since saving them
+            # is left to whatever opens or changes the file
+            if self.index is not None:
+                self.index.extend(self)
+            if self.offsets is not None:
+                self.offsets.update(self)
+            if self.free is not None:
+                self.free.extend(self)
+            if self.bloom is not None:
+                self.bloom = self.bloom.update(self, save=False)
+            for index in self.secondary.values():
+                index.extend(self)
+        return size
+
+    def remap(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+        if self.size:
+            # An empty file can't be mapped, lex_blocks() copes with it instead
+            self.mapped = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+        if self.offsets is not None:
+            self.offsets.close()
+        for index in self.secondary.values():
+            index.close()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def lex(self, pos=0, row_callback=None, value_callback=None, rows=1, cols=None):
+        if self.stats is not None:
+            return self.traced_lex(pos, row_callback, value_callback, rows, cols)
+        parser, source = self.lexer()
+        return parser(source, pos, row_callback, value_callback, rows, cols)
+
+    def lexer(self):
+        """
+        Return the ``lex`` function to parse this file with and what to pass it
+        """
+        if self.mapped is not None:
+            return lex_mmap, self.mapped
+        if self.cache is not None:
+            return lex_blocks, CachedBlockReader(self)
+        return lex_blocks, self.fp
+
+    def traced_lex(self, pos, row_callback, value_callback, rows, cols):
+        """
+        Call ``lex()`` adding what it does to ``self.stats``
+        """
+        stats = self.stats
+        lexed = [0]
+        def counting_callback(row, end_pos):
+            lexed[0] += 1
+            return row_callback(row, end_pos)
+        parser, source = self.lexer()
+        start = time.time()
+        end_pos, found = parser(source, pos, row_callback and counting_callback, value_callback, rows, cols)
+        stats.lex_seconds += time.time() - start
+        stats.rows_lexed += lexed[0] + len(found)
+        self.count_read(pos, end_pos)
+        return end_pos, found
+
+    def count_read(self, pos, end_pos):
+        """
+        Add the bytes read by a ``lex()`` from ``pos`` to ``self.stats``
+        """
+        if self.mapped is not None:
+            self.stats.bytes_read += max(end_pos+1-pos, 0)
+        elif self.cache is None:
+            self.stats.bytes_read += self.fp.tell()-pos
+
+    def traced(self, method, *args):
+        """
+        Call ``method`` collecting its ``LookupStats`` for ``self.trace``
+        """
+        stats = self.stats = LookupStats(method.__name__, args[0])
+        tracing.stats = stats
+        start = time.time()
+        try:
+            result = method(*args)
+            if isinstance(result, dict):
+                stats.rows_found = sum([len(rows) for rows in result.values()])
+            else:
+                stats.rows_found = len(result)
+            return result
+        finally:
+            stats.seconds = time.time() - start
+            self.stats = None
+            tracing.stats = None
+            counters.record(stats)
+            self.trace(stats)
+
+    def read_block(self, block):
+        """
+        Return the raw bytes of ``block``, from the cache if possible
+        """
+        def load():
+            self.fp.seek(block*self.block_size)
+            data = self.fp.read(self.block_size)
+            if self.stats is not None:
+                self.stats.bytes_read += len(data)
+            return data, len(data)
+        return self.cache.load((self.cache_name, block, 'block'), load)
+
+    def first_row(self, pos, block, length=None):
+        """
+        Parse the row at ``pos``, which is the first row in ``block``,
+        returning the position of its end and the row, or ``None`` for the row
+        if there isn't one. With ``length`` only the first ``length`` values
+        are parsed out.
+        """
+        cols = None
+        if length is not None:
+            cols = range(length)
+        def load():
+            # Don't read the whole block into the cache just for one row
+            if self.mapped is not None:
+                end_pos, rows = lex_mmap(self.mapped, pos, rows=1, cols=cols)
+            else:
+                end_pos, rows = lex_blocks(self.fp, pos, rows=1, cols=cols)
+                if self.stats is not None:
+                    self.stats.bytes_read += self.fp.tell()-pos
+            if self.stats is not None:
+                self.stats.rows_lexed += len(rows)
+                if self.mapped is not None:
+                    self.stats.bytes_read += max(end_pos+1-pos, 0)
+            if not rows:
+                return (end_pos, None), None
+            return (end_pos, rows[0]), row_size(rows[0])
+        if self.cache is None:
+            return load()[0]
+        if length is None:
+            return self.cache.load((self.cache_name, block, 'row'), load)
+        return self.cache.load((self.cache_name, block, 'key', length), load)
+
+    def headers(self):
+        """
+        Return the parsed headers and file offset of the end of the headers
+        """
+        if self._headers is None:
+            header_length, row = self.first_row(0, 'headers')
+            if row is None:
+                raise Exception('No header in CSV')
+            self._headers = row, header_length
+        return self._headers
+
+    def types(self):
+        """
+        Return the type of each column, from the schema
+        """
+        if self._types is None:
+            headers = self.headers()[0]
+            if self.schema is None:
+                self._types = ['str']*len(headers)
+            else:
+                self._types = self.schema.column_types(headers)
+        return self._types
+
+    def decode(self, row, start=0, stop=None):
+        """
+        Decode the values ``row[start:stop]`` to the types of their columns
+        """
+        if self.stats is not None:
+            self.stats.values_decoded += len(row[start:stop])
+        if self.schema is None:
+            return [value.decode('utf8') for value in row[start:stop]]
+        types = self.types()
+        values = []
+        i = start
+        for value in row[start:stop]:
+            values.append(column_decoders[i < len(types) and types[i] or 'str'](value))
+            i += 1
+        return values
+
+    def compare_key(self, key):
+        """\
+        Return ``key`` as it should be compared with the keys of undecoded
+        rows, and a function returning the key of an undecoded row.
+
+        The values of ``str`` and ``bytes`` columns are compared as the UTF-8
+        encoded bytes they are in the file, which sort in the same order as
+        the decoded values, so that rows don't have to be decoded just to be
+        skipped. Only keys with values of other types are decoded.
+        """
+        length = len(key)
+        for type in self.types()[:length]:
+            if type not in ['str', 'bytes']:
+                def row_key(row):
+                    return self.decode(row, 0, length)
+                return list(key), row_key
+        def row_key(row):
+            return row[:length]
+        return [encode_value(value) for value in key], row_key
+
+    def might_contain(self, key):
+        """
+        Return ``False`` if the Bloom filter shows there are no rows for
+        ``key``, and ``True`` if there might be or there is no filter for keys
+        of its length
+        """
+        if self.bloom_columns != len(key):
+            return True
+        self.refresh()
+        if self.bloom is None:
+            self.bloom = BloomFilter.open(self, self.bloom_columns, self.bloom_error_rate)
+        # Hash the values as the column's type, since an int can be given
+        # for a float column but wouldn't encode the same as the row's value
+        return self.bloom.check([column_decoders[type](encode_value(value)) for type, value in zip(self.types(), key)])
+
+    def check_key(self, key):
+        if self.schema is None:
+            for value in key:
+                if not isinstance(value, unicode):
+                    raise Exception('Key contains non-unicode values: %r'%(key,))
+            return
+        types = self.types()
+        if len(types) < len(key):
+            raise Exception('Key being asked for is longer than the number of columns')
+        for i in range(len(key)):
+            if key[i] is not None and not isinstance(key[i], key_types[types[i]]):
+                raise Exception('Key contains a value that is not of type %r: %r'%(types[i], key))
+
+    def block_start(self, block):
+        """
+        Return the position of the first row in ``block``
+        """
+        if block == 0:
+            return self.headers()[1]+1
+        return block*self.block_size
+
+    def first_key(self, block, length):
+        """
+        Return the first ``length`` values of the first row in ``block``
+        """
+        end_pos, row = self.first_row(self.block_start(block), block, length)
+        if row is None:
+            return None
+        return self.decode(row)
+
+    def live_block(self, block):
+        """
+        Return ``block``, or if the free space map shows that it has no live
+        rows, the next block that does
+        """
+        if self.free is not None:
+            while block <= self.last_block and not self.free.is_live(block):
+                block += 1
+        return block
+
+    def find_block(self, key, lower=0):
+        """
+        Return the last block whose first row sorts before ``key``, or
+        ``lower`` if there isn't one after it.
+
+        Rows matching ``key`` can start no earlier than this block. Blocks
+        with no live rows are skipped.
+        """
+        if self.index is not None and len(key) <= self.index.key_columns:
+            return self.live_block(max(self.index.find_block(key), lower))
+        key, row_key = self.compare_key(key)
+        # The first row of block 0 is compared just like the others, there
+        # is nothing special about it other than it coming after the header.
+        upper = self.last_block + 1
+        while upper - lower > 1:
+            next_block = int((lower + upper)/2)
+            debug("Looping between %s and %s, next block is %s"%(lower, upper, next_block))
+            # The first row of a block with no live rows is the first row of
+            # the next block that has some
+            probe = self.live_block(next_block)
+            row = None
+            if probe <= self.last_block:
+                if self.stats is not None:
+                    self.stats.blocks_probed += 1
+                end_pos, row = self.first_row(self.block_start(probe), probe, len(key))
+            if row is not None and row_key(row) < key:
+                lower = next_block
+            else:
+                upper = next_block
+        return self.live_block(lower)
+
+    def find_row(self, key):
+        """\
+        Bisect the blocks to find the last one whose first row sorts before
+        ``key``, then parse forward from there collecting all the rows that
+        match ``key``, stopping at the first row that sorts after it.
+
+        Raises a ``KeyError`` if there are no matching rows.
+        """
+        if self.trace is not None and self.stats is None:
+            return self.traced(self.find_row, key)
+        counters.add('lookups')
+        self.check_key(key)
+        if not self.might_contain(key):
+            counters.add('missing')
+            raise KeyError('No rows for key %r'%(key, ))
+        headers, header_end_pos = self.headers()
+        if len(headers) < len(key):
+            raise Exception('Key being asked for is longer than the number of columns')
+        self.refresh()
+        block = self.find_block(key)
+        debug("Searching from block %s"%(block,))
+        try:
+            return self.iterate_until_finding(key, self.block_start(block))
+        except KeyError:
+            counters.add('missing')
+            raise
+
+    def find_rows(self, keys):
+        """\
+        Find the rows for many keys of the same length at once.
+
+        The keys are sorted and the blocks are then parsed in order, merging
+        the rows with the keys. After each block, the first row of the
+        following block is parsed, and if the next key still to be found
+        sorts no later than it, that block is parsed next. Otherwise the
+        blocks are bisected again, but only from the following block onwards.
+
+        Returns a dictionary mapping each key, as a tuple, to its list of
+        rows. Keys with no rows map to an empty list rather than raising a
+        ``KeyError``.
+        """
+        if self.trace is not None and self.stats is None:
+            return self.traced(self.find_rows, keys)
+        counters.add('lookups')
+        keys = sorted(set([tuple(key) for key in keys]))
+        found = dict([(key, []) for key in keys])
+        if not keys:
+            return found
+        length = len(keys[0])
+        for key in keys:
+            if len(key) != length:
+                raise Exception('All the keys must be the same length')
+            self.check_key(key)
+        keys = [key for key in keys if self.might_contain(key)]
+        if not keys:
+            return found
+        headers, header_end_pos = self.headers()
+        if len(headers) < length:
+            raise Exception('Key being asked for is longer than the number of columns')
+        # Compare the keys in the same form as the rows' keys, in that order
+        compared = sorted([(self.compare_key(key)[0], key) for key in keys])
+        row_key = self.compare_key(keys[0])[1]
+        keys = [list(key) for compare, key in compared]
+        compared = [compare for compare, key in compared]
+        self.refresh()
+        # The index of the next key to find
+        current = [0]
+        block = self.find_block(keys[0])
+        while True:
+            block_end = (block+1)*self.block_size
+            def row_callback(row, end_pos):
+                if end_pos >= block_end:
+                    # This row belongs to the next block
+                    return False
+                key = row_key(row)
+                while key > compared[current[0]]:
+                    current[0] += 1
+                    if current[0] == len(keys):
+                        return False
+                if key == compared[current[0]]:
+                    found[tuple(keys[current[0]])].append(self.decode(row))
+                return True
+            debug("Merging block %s"%(block,))
+            if block <= self.last_block:
+                self.lex(self.block_start(block), row_callback, rows=None)
+            if current[0] == len(keys) or block >= self.last_block:
+                break
+            # Parse the next block with rows straight away if the next key
+            # sorts no later than its first row, and only bisect otherwise
+            next_block = self.live_block(block+1)
+            if next_block > self.last_block:
+                break
+            if self.stats is not None:
+                self.stats.blocks_probed += 1
+            end_pos, row = self.first_row(self.block_start(next_block), next_block, length)
+            if row is not None and row_key(row) < compared[current[0]]:
+                block = self.find_block(keys[current[0]], next_block)
+            else:
+                block = next_block
+        return found
+
+    def locate(self, key):
+        """
+        Return the position of the start and end of each row matching
+        ``key``, along with the undecoded row. The start includes any padding
+        or space from deleted rows before the row.
+        """
+        self.check_key(key)
+        self.refresh()
+        compare, row_key = self.compare_key(key)
+        found = []
+        pos = [self.block_start(self.find_block(key))]
+        def row_callback(row, end_pos):
+            this_key = row_key(row)
+            if this_key == compare:
+                found.append((pos[0], end_pos, row))
+            elif found or this_key > compare:
+                return False
+            pos[0] = end_pos+1
+            return True
+        if pos[0] < self.size:
+            self.lex(pos[0], row_callback, rows=None)
+        return found
+
+    def iterate_until_finding(self, key, start_pos, max_pos=None):
+        """\
+        Return the rows matching ``key`` from ``start_pos`` onwards, raising a
+        ``KeyError`` if a row sorting after ``key`` (or ``max_pos``) is
+        reached first.
+
+        Only the key columns of the rows before the first match are parsed
+        out, and they are compared undecoded where possible. The matching
+        rows are then parsed in full.
+        """
+        compare, row_key = self.compare_key(key)
+        cols = range(len(key))
+        # The start of the row about to be parsed, and of the first match
+        pos = [start_pos]
+        match = [None]
+        def key_callback(row, end_pos):
+            if max_pos is not None and end_pos > max_pos:
+                debug("Reached %s, past the maximum of %s"%(end_pos, max_pos))
+                return False
+            row = row_key(row)
+            if row == compare:
+                debug("Found a row")
+                match[0] = pos[0]
+                return False
+            elif row > compare:
+                # We've gone past where our key would be
+                debug("Finished finding key")
+                return False
+            # Not one we want yet, keep looking
+            pos[0] = end_pos+1
+            return True
+        self.lex(start_pos, key_callback, rows=None, cols=cols)
+        if match[0] is None:
+            raise KeyError('No rows for key %r'%(key, ))
+        rows = []
+        def row_callback(row, end_pos):
+            if max_pos is not None and end_pos > max_pos:
+                debug("Reached %s, past the maximum of %s"%(end_pos, max_pos))
+                return False
+            if row_key(row) != compare:
+                debug("Finished finding key")
+                return False
+            rows.append(self.decode(row))
+            return True
+        self.lex(match[0], row_callback, rows=None)
+        return rows
+
+    def return_rows_from(self, key, pos, start_rows=None):
+        if start_rows:
+            rows = start_rows[:]
+        else:
+            rows = []
+        compare, row_key = self.compare_key(key)
+        def row_callback(row, end_pos):
+            if row_key(row) != compare:
+                return False
+            else:
+                rows.append(self.decode(row))
+                return True
+        self.lex(pos, row_callback, rows=None)
+        return rows
+
+    def iter_raw_rows(self, pos, batch=256):
+        """\
+        Generate each undecoded row from ``pos`` onwards, along with the
+        position of its end.
+
+        Rows are parsed ``batch`` at a time by ``lex()``, so however many
+        rows are read, only one batch is in memory at once. Each batch carries
+        on from the end of the last, which is the same as parsing in one go
+        since the parser always starts each row afresh.
+        """
+        self.refresh()
+        while pos < self.size:
+            if self.free is not None and not self.free.is_live(int(pos/self.block_size)):
+                pos = self.block_start(self.live_block(int(pos/self.block_size)))
+                if pos >= self.size:
+                    return
+            found = []
+            def row_callback(row, end_pos):
+                found.append((row, end_pos))
+                return True
+            self.lex(pos, row_callback, rows=batch)
+            for row, end_pos in found:
+                yield row, end_pos
+            if len(found) < batch:
+                # Reached the end of the file
+                return
+            pos = found[-1][1]+1
+
+    def iter_rows(self, start_key=None, end_key=None, prefix=None):
+        """\
+        Generate the decoded rows from the first one whose key is not less
+        than ``start_key`` up to but not including the first whose key is not
+        less than ``end_key``. Keys are compared with the first ``len(key)``
+        values of each row, so ``start_key=[a], end_key=[b]`` gives all the
+        rows whose first value is in ``[a, b)``.
+
+        ``prefix`` gives all the rows whose first ``len(prefix)`` values
+        are ``prefix``.
+
+        The blocks are bisected to find where to start, as for
+        ``find_row()``, and the rows are then parsed lazily so it is cheap to
+        stop early.
+        """
+        for row in self.iter_range(start_key, end_key, prefix):
+            yield self.decode(row)
+
+    def iter_range(self, start_key=None, end_key=None, prefix=None):
+        """
+        Generate the undecoded rows ``iter_rows()`` would, only decoding
+        their keys to compare them
+        """
+        if prefix is not None:
+            start_key = prefix
+        for key in start_key, end_key:
+            if key is not None:
+                self.check_key(key)
+        self.refresh()
+        if start_key is None:
+            pos = self.block_start(0)
+        else:
+            pos = self.block_start(self.find_block(start_key))
+            start_key, start_row_key = self.compare_key(start_key)
+        if end_key is not None:
+            end_key, end_row_key = self.compare_key(end_key)
+        for row, end_pos in self.iter_raw_rows(pos):
+            if start_key is not None:
+                row_key = start_row_key(row)
+                if row_key < start_key:
+                    continue
+                if prefix is not None and row_key != start_key:
+                    return
+            if end_key is not None and end_row_key(row) >= end_key:
+                return
+            yield row
+
+    def column_number(self, column):
+        """
+        Return the position of the column with the header name ``column``,
+        or ``column`` itself if it is already a number
+        """
+        if isinstance(column, int):
+            return column
+        headers = [name.decode('utf8') for name in self.headers()[0]]
+        if isinstance(column, str):
+            column = column.decode('utf8')
+        if column not in headers:
+            raise Exception('No column named %r'%(column,))
+        return headers.index(column)
+
+    def find_by(self, column, value):
+        """\
+        Return the rows whose value in ``column`` is ``value``, in the order
+        they are in the file, using the column's ``SecondaryIndex`` to parse
+        only those rows.
+
+        Raises a ``KeyError`` if there are no matching rows.
+        """
+        column = self.column_number(column)
+        if column not in self.secondary:
+            raise Exception('There is no secondary index on column %s'%(column,))
+        self.refresh()
+        rows = []
+        for offset in self.secondary[column].offsets(value):
+            end_pos, found = self.lex(offset, rows=1)
+            rows.append(self.decode(found[0]))
+        if not rows:
+            raise KeyError('No rows with %r in column %s'%(value, column))
+        return rows
+
+    def batch(self, columns=None):
+        """
+        Return an empty ``RowBatch`` for the named ``columns``, or all of them
+        """
+        headers = [name.decode('utf8') for name in self.headers()[0]]
+        if columns is None:
+            columns = headers
+        positions = []
+        for name in columns:
+            if isinstance(name, str):
+                name = name.decode('utf8')
+            if name not in headers:
+                raise Exception('No column named %r'%(name,))
+            positions.append(headers.index(name))
+        types = self.types()
+        return RowBatch([headers[i] for i in positions], [types[i] for i in positions], positions)
+
+    def range_batch(self, start_key=None, end_key=None, prefix=None, columns=None):
+        """\
+        Return the rows ``iter_rows()`` would as a ``RowBatch`` of just the
+        named ``columns`` (or all of them).
+        """
+        batch = self.batch(columns)
+        for row in self.iter_range(start_key, end_key, prefix):
+            batch.append(row)
+        return batch
+
+    def find_batch(self, key, columns=None):
+        """\
+        Return the rows ``find_row()`` would as a ``RowBatch`` of just the
+        named ``columns`` (or all of them).
+
+        Raises a ``KeyError`` if there are no matching rows.
+        """
+        batch = self.range_batch(prefix=key, columns=columns)
+        if not len(batch):
+            raise KeyError('No rows for key %r'%(key, ))
+        return batch
+
+    def read_rows(self, start, stop):
+        """
+        Return the rows numbered from ``start`` up to but not including
+        ``stop``, counting the first row after the headers as row 0
+        """
+        if self.offsets is None:
+            raise Exception('Open the file with row_offsets=True to read rows by number')
+        self.refresh()
+        stop = min(stop, len(self.offsets))
+        if start >= stop:
+            return []
+        end_pos, rows = self.lex(self.offsets[start], rows=stop-start)
+        return [self.decode(row) for row in rows]
+
+    def read_row(self, n):
+        rows = self.read_rows(n, n+1)
+        if not rows:
+            raise IndexError('No row %s'%(n,))
+        return rows[0]
+
+    def cursor(self, position=0, page_size=100):
+        return RowCursor(self, position, page_size)
+
+class BlockCache(object):
+    """\
+    A least recently used cache of blocks shared between lookups, and
+    between ``FastCSVFile`` objects for the same or different files.
+
+    Entries are keyed by ``(filename, block, kind)`` where ``kind`` is
+    ``'block'`` for the raw bytes of a block or ``'row'`` for the parsed first
+    row of a block. The headers are cached as the ``'row'`` of block
+    ``'headers'``. The bisection only needs the first ``length`` values of
+    the first row, which are keyed by ``(filename, block, 'key', length)``.
+
+    The least recently used entries are dropped once the entries take up
+    more than ``max_bytes``.
+
+    All the entries for a file are dropped as soon as its size or
+    modification time is seen to change.
+    """
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()
+        self.stamps = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def validate(self, filename, size, mtime):
+        if self.stamps.get(filename) != (size, mtime):
+            self.invalidate(filename)
+            self.stamps[filename] = (size, mtime)
+
+    def invalidate(self, filename=None):
+        """
+        Drop all the entries for ``filename``, or everything
+        """
+        if filename is None:
+            self.entries.clear()
+            self.stamps.clear()
+            self.bytes = 0
+            return
+        for key in [key for key in self.entries if key[0] == filename]:
+            self.bytes -= self.entries.pop(key)[1]
+        self.stamps.pop(filename, None)
+
+    def get(self, key):
+        try:
+            value, size = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Re-inserting moves the entry to the most recently used end
+        self.entries[key] = value, size
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self.entries[key] = value, size
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            old_key, (old_value, old_size) = self.entries.popitem(last=False)
+            self.bytes -= old_size
+            self.evictions += 1
+
+    def load(self, key, loader):
+        """
+        Return the value for ``key``, calling ``loader()`` for the value and
+        its size if it isn't cached. A size of ``None`` means the value
+        shouldn't be cached.
+        """
+        value = self.get(key)
+        if value is None:
+            value, size = loader()
+            if size is not None:
+                self.put(key, value, size)
+        return value
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+class SharedBlockCache(BlockCache):
+    """\
+    A ``BlockCache`` that can be shared between threads.
+
+    When several threads want the same entry at once, only the first one
+    calls its loader and the others wait for it and share the value, so
+    concurrent lookups that probe the same blocks read each of them once.
+    The number of loads saved like this is reported as ``coalesced`` by
+    ``stats()``.
+    """
+    def __init__(self, max_bytes=64*1024*1024):
+        BlockCache.__init__(self, max_bytes)
+        self.lock = threading.RLock()
+        self.loading = {}
+        self.coalesced = 0
+
+    def validate(self, filename, size, mtime):
+        with self.lock:
+            BlockCache.validate(self, filename, size, mtime)
+
+    def invalidate(self, filename=None):
+        with self.lock:
+            BlockCache.invalidate(self, filename)
+
+    def get(self, key):
+        with self.lock:
+            return BlockCache.get(self, key)
+
+    def put(self, key, value, size):
+        with self.lock:
+            BlockCache.put(self, key, value, size)
+
+    def load(self, key, loader):
+        while True:
+            with self.lock:
+                value = BlockCache.get(self, key)
+                if value is not None:
+                    return value
+                # The event and, once it is set, the value loaded
+                loading = self.loading.get(key)
+                if loading is None:
+                    loading = self.loading[key] = [threading.Event(), None]
+                    break
+                self.coalesced += 1
+            loading[0].wait()
+            if loading[1] is not None:
+                return loading[1]
+            # The loader failed in the other thread, so try again here
+        try:
+            value, size = loader()
+            with self.lock:
+                if size is not None:
+                    BlockCache.put(self, key, value, size)
+                loading[1] = value
+        finally:
+            with self.lock:
+                del self.loading[key]
+            loading[0].set()
+        return value
+
+    def stats(self):
+        with self.lock:
+            stats = BlockCache.stats(self)
+            stats['coalesced'] = self.coalesced
+            return stats
+
+class LookupPool(object):
+    """\
+    Look up rows in ``filename`` from a bounded pool of ``threads`` threads
+    so that callers such as web servers aren't blocked while the file is
+    read.
+
+    Each thread uses one of ``threads`` ``FastCSVFile`` objects opened up
+    front with the keyword ``options`` given, and they all share one
+    ``SharedBlockCache`` (``cache``, or a new one) so that concurrent lookups
+    probing the same bisection blocks read each block once.
+
+    ``afind_row()`` and ``afind_rows()`` return a
+    ``multiprocessing.pool.AsyncResult`` straight away. Call its ``get()``
+    for the answer, or pass a ``callback`` to be called with the answer from
+    the pool's thread, for example to hand it back to an event loop.
+    """
+    def __init__(self, filename, threads=4, cache=None, **options):
+        if cache is None:
+            cache = SharedBlockCache()
+        self.filename = filename
+        self.cache = cache
+        self.readers = Queue.Queue()
+        for i in range(threads):
+            self.readers.put(FastCSVFile(filename, cache=cache, **options))
+        self.threads = threads
+        self.pool = ThreadPool(threads)
+
+    def call(self, method, *args):
+        """
+        Call ``method`` on a free ``FastCSVFile`` in this thread
+        """
+        csvfile = self.readers.get()
+        try:
+            return getattr(csvfile, method)(*args)
+        finally:
+            self.readers.put(csvfile)
+
+    def find_row(self, key):
+        return self.call('find_row', key)
+
+    def find_rows(self, keys):
+        return self.call('find_rows', keys)
+
+    def afind_row(self, key, callback=None):
+        return self.pool.apply_async(self.call, ('find_row', key), callback=callback)
+
+    def afind_rows(self, keys, callback=None):
+        return self.pool.apply_async(self.call, ('find_rows', keys), callback=callback)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for i in range(self.threads):
+            self.readers.get().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class Shard(object):
+    """\
+    One file of a ``Dataset``, with the decoded keys of its first and last
+    rows, which are ``None`` if it hasn't got any rows yet
+    """
+    def __init__(self, filename, min_key=None, max_key=None):
+        self.filename = filename
+        self.min_key = min_key
+        self.max_key = max_key
+
+    def __repr__(self):
+        return '<Shard %s %r-%r>'%(self.filename, self.min_key, self.max_key)
+
+class Dataset(object):
+    """\
+    A directory of padded CSV files, the shards, each holding the rows for a
+    contiguous range of keys, so that no one file has to hold all the rows.
+
+    ``manifest.csv`` in the directory lists the shards in key order. Its
+    first row is the number of key columns followed by the headers. Each row
+    after that is a shard's filename, the key of its first row and the key of
+    its last row (just the filename for a shard with no rows yet). It is
+    replaced atomically whenever it changes and read again by other
+    ``Dataset`` instances when they notice.
+
+    ``find_row()``, ``find_rows()`` and ``iter_rows()`` work as for
+    ``FastCSVFile``, but only open the shards whose range of keys could
+    contain the rows. The last shard is treated as open ended since it is
+    appended to, and the same key can be in the last row of one shard and the
+    first of the next. ``scan()`` scans all the shards in a pool of
+    processes.
+
+    ``write()`` appends rows to the last shard with an ``Appender``. Once it
+    is bigger than ``max_shard_bytes`` a new shard is started. ``split()``
+    divides a shard into two at a block boundary and ``split_shards()``
+    splits any that are too big, such as ones made with ``ingest()``. Only
+    one process should write to a dataset at a time.
+
+    ``schema`` and any other ``options`` are passed on to each shard's
+    ``FastCSVFile``.
+
+    ::
+
+        dataset = Dataset.create('data', headers, bits=16)
+        with dataset:
+            for row in sorted_rows:
+                dataset.write(row)
+    """
+    def __init__(self, directory, schema=None, max_shard_bytes=1024**3, **options):
+        self.directory = directory
+        self.manifest = os.path.join(directory, 'manifest.csv')
+        self.schema = schema
+        self.max_shard_bytes = max_shard_bytes
+        self.options = options
+        self.files = {}
+        self.appender = None
+        self.last_key = None
+        self.mtime = None
+        self.load()
+
+    @classmethod
+    def create(cls, directory, headers, key_columns=1, bits=22, schema=None, **options):
+        """
+        Create an empty dataset in ``directory`` with one empty shard of
+        blocks of ``2**bits`` bytes
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if os.path.exists(os.path.join(directory, 'manifest.csv')):
+            raise Exception('There is already a dataset in %r'%(directory,))
+        filename = 'shard-000000.%s.csv'%(bits,)
+        BlockWriter(os.path.join(directory, filename), headers, 2**bits).close()
+        with open(os.path.join(directory, 'manifest.csv'), 'wb') as fp:
+            fp.write(encode_row([str(key_columns)]+list(headers)))
+            fp.write(encode_row([filename]))
+        return cls(directory, schema, **options)
+
+    def load(self):
+        """
+        Read the manifest again if it has changed
+        """
+        mtime = os.stat(self.manifest).st_mtime
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        end_pos, rows = lex(self.manifest, rows=None)
+        self.key_columns = int(rows[0][0])
+        self.headers = rows[0][1:]
+        types = ['str']*len(self.headers)
+        if self.schema is not None:
+            types = self.schema.column_types(self.headers)
+        self.key_decoders = [column_decoders[type] for type in types[:self.key_columns]]
+        self.shards = []
+        for row in rows[1:]:
+            shard = Shard(row[0])
+            if len(row) > 1:
+                shard.min_key = self.key(row[1:1+self.key_columns])
+                shard.max_key = self.key(row[1+self.key_columns:])
+            self.shards.append(shard)
+        # Close the files of shards that have been split
+        filenames = set([shard.filename for shard in self.shards])
+        for filename in self.files.keys():
+            if filename not in filenames:
+                self.files.pop(filename).close()
+
+    def save(self):
+        tmp = self.manifest+'.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(encode_row([str(self.key_columns)]+self.headers))
+            for shard in self.shards:
+                row = [shard.filename]
+                if shard.min_key is not None:
+                    row += [encode_value(value) for value in shard.min_key+shard.max_key]
+                fp.write(encode_row(row))
+        os.rename(tmp, self.manifest)
+        self.mtime = os.stat(self.manifest).st_mtime
+
+    def key(self, row):
+        """
+        Return the decoded key of ``row``, which may be encoded or decoded
+        """
+        return [decode(encode_value(value)) for decode, value in zip(self.key_decoders, row[:self.key_columns])]
+
+    def path(self, shard):
+        return os.path.join(self.directory, shard.filename)
+
+    def open(self, shard):
+        """
+        Return the ``FastCSVFile`` for ``shard``, opening it if need be
+        """
+        if shard.filename not in self.files:
+            self.files[shard.filename] = FastCSVFile(self.path(shard), schema=self.schema, **self.options)
+        return self.files[shard.filename]
+
+    def bounds(self, i):
+        """
+        Return the lowest and highest keys shard ``i`` can hold, or ``None``
+        where there is no limit
+        """
+        shard = self.shards[i]
+        lower = shard.min_key
+        if lower is None and i:
+            lower = self.shards[i-1].max_key
+        upper = shard.max_key
+        if i == len(self.shards)-1:
+            upper = None
+        elif upper is None:
+            upper = lower
+        return lower, upper
+
+    def route(self, key):
+        """
+        Return the shards whose range of keys includes ``key``
+        """
+        self.load()
+        length = len(key)
+        key = list(key)
+        shards = []
+        for i in range(len(self.shards)):
+            lower, upper = self.bounds(i)
+            if lower is not None and key < lower[:length]:
+                break
+            if upper is None or key <= upper[:length]:
+                shards.append(self.shards[i])
+        return shards
+
+    def find_row(self, key):
+        """
+        Return the rows matching ``key`` from whichever shards they are in,
+        raising a ``KeyError`` if there aren't any
+        """
+        rows = []
+        for shard in self.route(key):
+            try:
+                rows.extend(self.open(shard).find_row(key))
+            except KeyError:
+                pass
+        if not rows:
+            raise KeyError('No rows for key %r'%(key, ))
+        return rows
+
+    def find_rows(self, keys):
+        """
+        Find the rows for many keys at once, as for ``FastCSVFile``, looking
+        up the keys for each shard together
+        """
+        found = dict([(tuple(key), []) for key in keys])
+        by_shard = OrderedDict()
+        for key in keys:
+            for shard in self.route(key):
+                by_shard.setdefault(shard.filename, (shard, []))[1].append(key)
+        for shard, shard_keys in by_shard.values():
+            for key, rows in self.open(shard).find_rows(shard_keys).items():
+                found[key].extend(rows)
+        return found
+
+    def iter_rows(self, start_key=None, end_key=None, prefix=None):
+        """
+        Generate the rows in a range of keys, as for ``FastCSVFile``, from
+        each shard the range overlaps in turn
+        """
+        if prefix is not None:
+            shards = self.route(prefix)
+        else:
+            self.load()
+            shards = []
+            for i in range(len(self.shards)):
+                lower, upper = self.bounds(i)
+                if end_key is not None and lower is not None and lower[:len(end_key)] >= list(end_key):
+                    break
+                if start_key is None or upper is None or upper[:len(start_key)] >= list(start_key):
+                    shards.append(self.shards[i])
+        for shard in shards:
+            for row in self.open(shard).iter_rows(start_key, end_key, prefix):
+                yield row
+
+    def scan(self, predicate=None, columns=None, reducer=None, workers=1, chunk_blocks=None):
+        """
+        Scan every shard, in a pool of ``workers`` processes if there is more
+        than one, as for the ``scan()`` function, splitting big shards into
+        chunks too
+        """
+        self.load()
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        cols = None
+        if columns is not None:
+            cols = column_numbers(self.headers, columns)
+        chunks = []
+        for shard in self.shards:
+            path = self.path(shard)
+            block_size = parse_filename(path)[0]
+            if workers > 1 and chunk_blocks is None:
+                # Enough for four chunks per worker if there were only one shard
+                last_block = last_block_for_size(os.stat(path).st_size, block_size)
+                chunks.extend(scan_chunks(path, block_size, max(int((last_block+1)/(workers*4)), 1)))
+            elif workers > 1:
+                chunks.extend(scan_chunks(path, block_size, chunk_blocks))
+            else:
+                chunks.extend(scan_chunks(path, block_size))
+        return run_scan(chunks, predicate, cols, reducer, workers, self.schema)
+
+    def write(self, row, **appender_options):
+        """\
+        Append a row, which must not sort before the last one, to the last
+        shard, starting a new shard first if it has grown bigger than
+        ``max_shard_bytes``. ``appender_options`` are passed on to the
+        ``Appender`` when it is opened.
+        """
+        self.load()
+        key = self.key(row)
+        if self.appender is None:
+            shard = self.shards[-1]
+            self.appender = Appender(self.path(shard), self.headers, key_columns=self.key_columns, schema=self.schema, **appender_options)
+            if self.appender.last_key is not None:
+                self.last_key = self.key(self.appender.last_key)
+        if self.last_key is not None and key < self.last_key:
+            raise Exception('Row %r sorts before the previous row %r'%(row, self.last_key))
+        # Rows waiting to be committed count too, or a shard could grow by
+        # up to commit_rows rows past the limit
+        if self.appender.pos + self.appender.pending_bytes >= self.max_shard_bytes:
+            self.add_shard()
+        shard = self.shards[-1]
+        if shard.min_key is None:
+            # Readers need to know where the new shard starts
+            shard.min_key = shard.max_key = key
+            self.save()
+        self.appender.write(row)
+        self.last_key = key
+
+    def add_shard(self):
+        """
+        Finish the last shard and start a new, empty one after it
+        """
+        self.appender.close()
+        self.shards[-1].max_key = self.last_key
+        bits = parse_filename(self.shards[-1].filename)[2]
+        filename = 'shard-%06d.%s.csv'%(self.next_number(), bits)
+        self.appender = Appender(os.path.join(self.directory, filename), self.headers, key_columns=self.key_columns, schema=self.schema, commit_rows=self.appender.commit_rows, commit_interval=self.appender.commit_interval, sync=self.appender.sync)
+        self.shards.append(Shard(filename))
+        self.save()
+        debug("Started shard %s"%(filename,))
+
+    def next_number(self):
+        return max([int(shard.filename.split('.')[0].split('-')[1]) for shard in self.shards])+1
+
+    def commit(self):
+        """
+        Write the rows waiting in the last shard's ``Appender`` and record
+        its last key in the manifest
+        """
+        if self.appender is not None:
+            self.appender.commit()
+            if self.shards[-1].max_key != self.last_key:
+                self.shards[-1].max_key = self.last_key
+                self.save()
+
+    def split(self, shard):
+        """\
+        Split ``shard`` into two new shards at the block boundary nearest its
+        middle. The first shard's blocks are copied as they are. The rows in
+        the first block of the second half are written after its header and
+        the blocks after that are copied as they are.
+        """
+        self.load()
+        if self.appender is not None and shard is self.shards[-1]:
+            self.commit()
+            self.appender.close()
+            self.appender = None
+        i = self.shards.index(shard)
+        number = self.next_number()
+        bits = parse_filename(shard.filename)[2]
+        halves = [Shard('shard-%06d.%s.csv'%(number+j, bits)) for j in range(2)]
+        with FastCSVFile(self.path(shard), schema=self.schema) as csvfile:
+            block_size = csvfile.block_size
+            if csvfile.last_block < 1:
+                raise Exception('Shard %s only has one block so cannot be split'%(shard.filename,))
+            middle = int((csvfile.last_block+1)/2)
+            with BlockWriter(self.path(halves[0]), None, block_size, key_columns=0) as writer:
+                for block in range(middle):
+                    csvfile.fp.seek(block*block_size)
+                    writer.write_block(csvfile.fp.read(block_size))
+            # The last row of the first half, from the last block that has any
+            last = [None]
+            block = middle
+            while last[0] is None and block > 0:
+                block -= 1
+                block_end = (block+1)*block_size
+                def row_callback(row, end_pos):
+                    if end_pos >= block_end:
+                        return False
+                    last[0] = row
+                    return True
+                csvfile.lex(csvfile.block_start(block), row_callback, rows=None, cols=range(self.key_columns))
+            halves[0].min_key = shard.min_key
+            halves[0].max_key = self.key(csvfile.decode(last[0]))
+            with BlockWriter(self.path(halves[1]), csvfile.headers()[0], block_size, key_columns=0) as writer:
+                block_end = (middle+1)*block_size
+                def row_callback(row, end_pos):
+                    if end_pos >= block_end:
+                        return False
+                    writer.write(row)
+                    return True
+                csvfile.lex(csvfile.block_start(middle), row_callback, rows=None)
+                for block in range(middle+1, csvfile.last_block+1):
+                    csvfile.fp.seek(block*block_size)
+                    writer.write_block(csvfile.fp.read(block_size))
+            halves[1].min_key = self.key(csvfile.first_key(middle, self.key_columns))
+            halves[1].max_key = shard.max_key
+        self.shards[i:i+1] = halves
+        self.save()
+        if shard.filename in self.files:
+            self.files.pop(shard.filename).close()
+        os.remove(self.path(shard))
+        for path in sidecar_paths(self.path(shard)):
+            os.remove(path)
+        debug("Split %s into %s and %s"%(shard.filename, halves[0].filename, halves[1].filename))
+        return halves
+
+    def split_shards(self):
+        """
+        Split every shard bigger than ``max_shard_bytes`` until none are,
+        returning the number of splits
+        """
+        self.load()
+        splits = 0
+        i = 0
+        while i < len(self.shards):
+            shard = self.shards[i]
+            path = self.path(shard)
+            size = os.stat(path).st_size
+            if size > self.max_shard_bytes and size > parse_filename(path)[0]:
+                self.split(shard)
+                splits += 1
+            else:
+                i += 1
+        return splits
+
+    def close(self):
+        if self.appender is not None:
+            self.commit()
+            self.appender.close()
+            self.appender = None
+        for csvfile in self.files.values():
+            csvfile.close()
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class CachedBlockReader(object):
+    """\
+    A file-like object for ``lex_file()`` that serves reads from whole blocks
+    held in the ``FastCSVFile``'s ``BlockCache``
+    """
+    def __init__(self, csvfile):
+        self.csvfile = csvfile
+        self.pos = 0
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def read(self, size):
+        block = int(self.pos/self.csvfile.block_size)
+        offset = self.pos - block*self.csvfile.block_size
+        chunk = self.csvfile.read_block(block)[offset:offset+size]
+        self.pos += len(chunk)
+        return chunk
+
+def row_size(row):
+    """
+    Roughly how many bytes a parsed row takes up, for the ``BlockCache``
+    """
+    size = 64
+    for value in row:
+        size += len(value) + 40
+    return size
+
+def save_sidecar(path, data):
+    """\
+    Replace the file ``path`` next to a CSV file with ``data``.
+
+    The data is written to a temporary file with a unique name in the same
+    directory, which is then renamed over ``path``, all while holding an
+    exclusive ``flock()`` on ``path+'.lock'``. Readers never see a partly
+    written file and readers in other threads or processes saving the same
+    sidecar at the same time don't interfere with each other.
+    """
+    lock = os.open(path+'.lock', os.O_RDWR | os.O_CREAT, 0666)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path)+'.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+    finally:
+        # Closing the file releases the lock
+        os.close(lock)
+
+def sidecar_stamp(path):
+    """
+    Return the inode and modification time of ``path``, or ``None`` if it
+    doesn't exist, to tell when a sidecar has been replaced or removed
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime
+
+class BlockIndex(object):
+    """\
+    An in-memory list of the first row key of every block, in block order,
+    so that a lookup can bisect in memory and then read just one block.
+
+    Because the rows are sorted, the keys are sorted too. Only the first
+    ``key_columns`` values of each row are kept and only lookups for keys
+    that long or shorter can use the index.
+
+    The index is saved next to the CSV file with an ``.idx`` extension as a
+    CSV file of its own. The first row holds the block size and number of
+    key columns, then there is one row per block holding that block's first
+    key.
+    """
+    def __init__(self, block_size, key_columns, keys=None):
+        self.block_size = block_size
+        self.key_columns = key_columns
+        if keys is None:
+            keys = []
+        self.keys = keys
+
+    def extend(self, csvfile):
+        """
+        Add the first keys of any blocks appended since the index was built.
+
+        The last block already in the index is read again in case its first
+        row was still being written when it was indexed. Returns the number
+        of blocks whose keys were added or changed.
+        """
+        if csvfile.last_block < len(self.keys)-1:
+            # The file has been rewritten, start again
+            del self.keys[:]
+        start = max(len(self.keys)-1, 0)
+        changed = 0
+        for block in range(start, csvfile.last_block+1):
+            key = csvfile.first_key(block, self.key_columns)
+            if key is None:
+                break
+            key = tuple(key)
+            if block < len(self.keys):
+                if self.keys[block] == key:
+                    continue
+                self.keys[block] = key
+            else:
+                self.keys.append(key)
+            changed += 1
+        debug("Indexed %s block(s)"%(changed,))
+        return changed
+
+    def find_block(self, key):
+        """
+        Return the last block whose first row sorts before ``key``, or 0
+        """
+        length = len(key)
+        key = tuple(key)
+        lower = 0
+        upper = len(self.keys)
+        while lower < upper:
+            middle = int((lower + upper)/2)
+            if self.keys[middle][:length] < key:
+                lower = middle + 1
+            else:
+                upper = middle
+        return max(lower-1, 0)
+
+    def save(self, path):
+        lines = [encode_row([str(self.block_size), str(self.key_columns)])]
+        for key in self.keys:
+            lines.append(encode_row([encode_value(value) for value in key]))
+        save_sidecar(path, ''.join(lines))
+
+    @classmethod
+    def load(cls, path, decode=None):
+        """
+        Load an index, decoding its keys with ``decode(row)``, which is the
+        ``FastCSVFile``'s ``decode()`` when opened by ``open()``
+        """
+        end_pos, rows = lex(path, rows=None)
+        if not rows:
+            raise Exception('No header in index %r'%(path,))
+        block_size, key_columns = [int(value) for value in rows[0]]
+        if decode is None:
+            keys = [tuple([value.decode('utf8') for value in row]) for row in rows[1:]]
+        else:
+            keys = [tuple(decode(row)) for row in rows[1:]]
+        return cls(block_size, key_columns, keys)
+
+    @classmethod
+    def open(cls, csvfile, key_columns):
+        """\
+        Load the index saved next to ``csvfile``, bringing it up to date, or
+        build and save a new one if there isn't a usable one.
+        """
+        path = csvfile.filename+'.idx'
+        index = None
+        if os.path.exists(path):
+            index = cls.load(path, csvfile.decode)
+            if index.block_size != csvfile.block_size or index.key_columns != key_columns:
+                debug("Index %r doesn't match, rebuilding it"%(path,))
+                index = None
+        if index is None:
+            index = cls(csvfile.block_size, key_columns)
+        if index.extend(csvfile):
+            index.save(path)
+        return index
+
+class RowOffsets(object):
+    """\
+    The start position of every row, so that row ``n`` can be read without
+    parsing any of the rows before it.
+
+    The positions are kept in a ``.rows`` file next to the CSV file as 8-byte
+    little-endian integers. The file is memory-mapped rather than loaded so
+    even an index of hundreds of millions of rows costs nothing to open.
+    """
+    item = struct.Struct('<Q')
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        self.fp = open(path, 'r+b')
+        self.mapped = None
+        self.count = 0
+        self.remap()
+
+    def remap(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+        self.count = int(os.fstat(self.fp.fileno()).st_size/self.item.size)
+        if self.count:
+            self.mapped = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += self.count
+        if n < 0 or n >= self.count:
+            raise IndexError('No row %s'%(n,))
+        return self.item.unpack_from(self.mapped, n*self.item.size)[0]
+
+    def append(self, positions):
+        self.fp.seek(self.count*self.item.size)
+        self.fp.write(pack_offsets(positions))
+        self.fp.flush()
+        self.remap()
+
+    def truncate(self):
+        self.fp.truncate(0)
+        self.remap()
+
+    def replaced(self):
+        """
+        Return ``True`` if the ``.rows`` file has been removed or replaced
+        since it was opened
+        """
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.fp.fileno()).st_ino
+        except OSError:
+            return True
+
+    def update(self, csvfile):
+        """\
+        Add the start positions of any rows after the last one recorded,
+        returning the number added.
+
+        Other handles on the file may be adding the same rows, so this
+        happens under an exclusive ``flock()`` on the ``.rows`` file, after
+        taking in any positions they have added.
+        """
+        fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+        try:
+            self.remap()
+            return self.extend(csvfile)
+        finally:
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+
+    def extend(self, csvfile):
+        if self.count and self[-1] >= csvfile.size:
+            debug("Row offsets %r are for a different file, rebuilding them"%(self.path,))
+            self.truncate()
+        if self.count:
+            # Parse the last row recorded again to find where the next starts
+            start = self[-1]
+        else:
+            start = csvfile.block_start(0)
+        skip = [bool(self.count)]
+        positions = []
+        added = [0]
+        next_start = [start]
+        def row_callback(row, end_pos):
+            if skip[0]:
+                skip[0] = False
+            else:
+                positions.append(next_start[0])
+            next_start[0] = end_pos+1
+            if len(positions) >= 65536:
+                self.append(positions)
+                added[0] += len(positions)
+                del positions[:]
+            return True
+        if start < csvfile.size:
+            csvfile.lex(start, row_callback, rows=None)
+        if positions:
+            self.append(positions)
+            added[0] += len(positions)
+        return added[0]
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+        self.fp.close()
+
+def pack_offsets(positions):
+    return struct.pack('<%dQ'%(len(positions),), *positions)
+
+class FreeSpaceMap(object):
+    """\
+    The number of live rows in each block of a padded CSV file and how many
+    of its bytes they don't use, so that blocks whose rows have all been
+    deleted can be skipped and ``compact()`` can tell which blocks are worth
+    repacking.
+
+    A row belongs to the block its ``\\r\\n`` is in. The dead bytes of a
+    block are its size less the encoded length of each of its live rows, so
+    they include padding as well as the space left by deleted rows and by
+    updates that made rows shorter.
+
+    The counts are kept in a ``.free`` file next to the CSV file as pairs of
+    4-byte little-endian integers, one pair per block.
+    """
+    item = struct.Struct('<II')
+
+    def __init__(self, path, live=None, dead=None):
+        self.path = path
+        if live is None:
+            live = []
+            dead = []
+        self.live = live
+        self.dead = dead
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        live = []
+        dead = []
+        for offset in range(0, len(data)-len(data)%cls.item.size, cls.item.size):
+            rows, unused = cls.item.unpack_from(data, offset)
+            live.append(rows)
+            dead.append(unused)
+        return cls(path, live, dead)
+
+    @classmethod
+    def open(cls, csvfile):
+        """\
+        Load the map saved next to ``csvfile``, bringing it up to date, or
+        build and save a new one if there isn't one.
+        """
+        path = csvfile.filename+'.free'
+        if os.path.exists(path):
+            free = cls.load(path)
+        else:
+            free = cls(path)
+        if free.extend(csvfile):
+            free.save()
+        return free
+
+    def extend(self, csvfile):
+        """
+        Count the rows in any blocks appended since the map was made.
+
+        The last block already in the map is counted again since rows may
+        have been appended to it, and blocks no longer in the file are
+        dropped. Returns the number of blocks whose counts changed.
+        """
+        del self.live[csvfile.last_block+1:]
+        del self.dead[csvfile.last_block+1:]
+        start = max(len(self.live)-1, 0)
+        live = [0]*(csvfile.last_block+1-start)
+        used = [0]*(csvfile.last_block+1-start)
+        if start == 0:
+            used[0] = csvfile.block_start(0)
+        def row_callback(row, end_pos):
+            block = int(end_pos/csvfile.block_size)-start
+            live[block] += 1
+            used[block] += len(encode_row(row))
+            return True
+        pos = csvfile.block_start(start)
+        if pos < csvfile.size:
+            csvfile.lex(pos, row_callback, rows=None)
+        changed = 0
+        for i in range(len(live)):
+            block = start+i
+            dead = min(csvfile.block_size, csvfile.size-block*csvfile.block_size)-used[i]
+            if block < len(self.live):
+                if (self.live[block], self.dead[block]) == (live[i], dead):
+                    continue
+                self.live[block] = live[i]
+                self.dead[block] = dead
+            else:
+                self.live.append(live[i])
+                self.dead.append(dead)
+            changed += 1
+        debug("Counted the free space in %s block(s)"%(changed,))
+        return changed
+
+    def is_live(self, block):
+        return block >= len(self.live) or self.live[block] > 0
+
+    def remove(self, block, length):
+        """
+        Record that a row of ``length`` encoded bytes in ``block`` has been
+        deleted
+        """
+        if block < len(self.live):
+            self.live[block] -= 1
+            self.dead[block] += length
+
+    def shrink(self, block, length):
+        """
+        Record that a row in ``block`` has been made ``length`` bytes shorter
+        """
+        if block < len(self.live):
+            self.dead[block] += length
+
+    def save(self):
+        save_sidecar(self.path, ''.join([self.item.pack(rows, unused) for rows, unused in zip(self.live, self.dead)]))
+
+class BloomFilter(object):
+    """\
+    A Bloom filter of the keys of the rows in a padded CSV file, so that
+    lookups for keys that aren't in the file can usually be answered without
+    reading any of it.
+
+    The keys are the first ``key_columns`` values of each row, hashed as the
+    bytes ``encode_value()`` gives for their decoded values, so a row and a
+    key give the same hashes whether or not they were decoded. A key that was
+    added is always found, and one that wasn't is found too with a
+    probability of about ``error_rate`` as long as no more than ``capacity``
+    keys are added.
+
+    The filter is kept in a ``.bloom`` file next to the CSV file, with the
+    position up to which rows have been added so that rows appended since
+    can be added when it is next opened. It is rebuilt once it holds twice
+    the keys it was sized for, or if the file has shrunk. Deleted rows stay
+    in the filter until then, which only makes false positives more likely.
+
+    ``delete_row()`` removes the ``.bloom`` file when it truncates the file,
+    since rows appended afterwards can start before ``end``. A filter held
+    in memory keeps the inode and modification time of the file it was
+    loaded from or saved to as ``stamp``, and is loaded again (or rebuilt,
+    if the file has gone) when they change, before any rows are added.
+
+    ``stats`` counts the keys checked and how many were rejected.
+    """
+    header = struct.Struct('<QQQIId')
+
+    def __init__(self, path, key_columns, capacity, error_rate=0.01):
+        self.path = path
+        self.key_columns = key_columns
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # See https://en.wikipedia.org/wiki/Bloom_filter#Optimal_number_of_hash_functions
+        bits = int(-max(capacity, 1)*math.log(error_rate)/math.log(2)**2)
+        self.bits = max(64, bits+(-bits)%8)
+        self.hashes = max(1, int(round(float(self.bits)/max(capacity, 1)*math.log(2))))
+        self.data = bytearray(self.bits/8)
+        self.count = 0
+        self.end = 0
+        self.stamp = None
+        self.stats = {'checks': 0, 'rejected': 0}
+
+    @staticmethod
+    def key_hashes(values):
+        """
+        Return the two 32-bit hashes the bit positions of ``values`` are
+        derived from
+        """
+        digest = hashlib.md5('\0'.join([encode_value(value) for value in values])).digest()
+        return struct.unpack_from('<II', digest)
+
+    def add_hashes(self, h1, h2):
+        data = self.data
+        for i in range(self.hashes):
+            bit = (h1+i*h2) % self.bits
+            data[bit >> 3] |= 1 << (bit & 7)
+
+    def add(self, values):
+        self.add_hashes(*self.key_hashes(values))
+        self.count += 1
+
+    def check(self, values):
+        """
+        Return ``False`` if ``values`` were definitely never added
+        """
+        self.stats['checks'] += 1
+        h1, h2 = self.key_hashes(values)
+        data = self.data
+        for i in range(self.hashes):
+            bit = (h1+i*h2) % self.bits
+            if not data[bit >> 3] & (1 << (bit & 7)):
+                self.stats['rejected'] += 1
+                return False
+        return True
+
+    def scan(self, csvfile, pos):
+        """
+        Return the hashes of the keys of the rows from ``pos`` to the end of
+        the file
+        """
+        row_key = csvfile.compare_key([None]*self.key_columns)[1]
+        hashes = (array.array('I'), array.array('I'))
+        def row_callback(row, end_pos):
+            h1, h2 = self.key_hashes(row_key(row))
+            hashes[0].append(h1)
+            hashes[1].append(h2)
+            return True
+        if pos < csvfile.size:
+            csvfile.lex(pos, row_callback, rows=None, cols=range(self.key_columns))
+        return hashes
+
+    @classmethod
+    def build(cls, csvfile, key_columns, error_rate=0.01):
+        """
+        Build a filter of all the rows of ``csvfile`` with one pass over it
+        """
+        bloom = cls(csvfile.filename+'.bloom', key_columns, 0, error_rate)
+        hashes = bloom.scan(csvfile, csvfile.block_start(0))
+        bloom = cls(bloom.path, key_columns, len(hashes[0]), error_rate)
+        for h1, h2 in zip(*hashes):
+            bloom.add_hashes(h1, h2)
+        bloom.count = len(hashes[0])
+        bloom.end = csvfile.size
+        debug("Built a Bloom filter of %s keys with %s bits and %s hashes"%(bloom.count, bloom.bits, bloom.hashes))
+        return bloom
+
+    def update(self, csvfile, save=True):
+        """\
+        Add the rows appended since the filter was last saved and save it
+        unless ``save`` is false, returning the filter to use from now on,
+        which is a new one if it had to be loaded again or rebuilt
+        """
+        stamp = sidecar_stamp(self.path)
+        if stamp != self.stamp:
+            if stamp is not None:
+                debug("Bloom filter %r has been replaced, loading it again"%(self.path,))
+                bloom = self.load(self.path)
+                if bloom.key_columns == self.key_columns:
+                    bloom.stats = self.stats
+                    return bloom.update(csvfile, save)
+            bloom = self.build(csvfile, self.key_columns, self.error_rate)
+            bloom.stats = self.stats
+            if save:
+                bloom.save()
+            return bloom
+        if csvfile.size == self.end:
+            return self
+        if csvfile.size > self.end:
+            hashes = self.scan(csvfile, self.end)
+            if self.count+len(hashes[0]) <= 2*max(self.capacity, 1):
+                for h1, h2 in zip(*hashes):
+                    self.add_hashes(h1, h2)
+                self.count += len(hashes[0])
+                self.end = csvfile.size
+                if save:
+                    self.save()
+                return self
+        bloom = self.build(csvfile, self.key_columns, self.error_rate)
+        bloom.stats = self.stats
+        if save:
+            bloom.save()
+        return bloom
+
+    @classmethod
+    def open(cls, csvfile, key_columns, error_rate=0.01):
+        """\
+        Load the filter saved next to ``csvfile``, bringing it up to date, or
+        build and save a new one if there isn't a usable one.
+        """
+        path = csvfile.filename+'.bloom'
+        if os.path.exists(path):
+            bloom = cls.load(path)
+            if bloom.key_columns == key_columns:
+                return bloom.update(csvfile)
+            debug("Bloom filter %r doesn't match, rebuilding it"%(path,))
+        bloom = cls.build(csvfile, key_columns, error_rate)
+        bloom.save()
+        return bloom
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fp:
+            data = fp.read()
+            stat = os.fstat(fp.fileno())
+        end, count, capacity, key_columns, hashes, error_rate = cls.header.unpack_from(data)
+        bloom = cls(path, key_columns, 0, error_rate)
+        bloom.end = end
+        bloom.count = count
+        bloom.capacity = capacity
+        bloom.hashes = hashes
+        bloom.data = bytearray(data[cls.header.size:])
+        bloom.bits = len(bloom.data)*8
+        bloom.stamp = stat.st_ino, stat.st_mtime
+        return bloom
+
+    def save(self):
+        save_sidecar(self.path, self.header.pack(self.end, self.count, self.capacity, self.key_columns, self.hashes, self.error_rate)+str(self.data))
+        self.stamp = sidecar_stamp(self.path)
+
+def sidecar_paths(filename):
+    """
+    Return the paths of all the files kept next to ``filename`` for it, such
+    as its ``.idx``, ``.bloom`` and ``SecondaryIndex`` files and their
+    ``.lock`` files
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    prefix = os.path.basename(filename)+'.'
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.startswith(prefix)]
+
+def secondary_index_paths(filename):
+    """
+    Return the paths of the ``SecondaryIndex`` files of ``filename``
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    prefix = os.path.basename(filename)+'.'
+    return [
+        os.path.join(directory, name) for name in sorted(os.listdir(directory))
+        if name.startswith(prefix) and (name.endswith('.sidx') or name.endswith('.sidx.log'))
+    ]
+
+class SecondaryIndex(object):
+    """\
+    The value in one column of every row of a padded CSV file, with the
+    position the row starts at, so that rows can be found by a column that
+    isn't part of the key.
+
+    The pairs are kept sorted by value, then position, in a padded CSV file
+    named after the column number, such as ``data.22.csv.3.sidx``, and are
+    found by bisecting it with ``find_row()``. It is built with one pass
+    over the column, sorting runs of ``run_rows`` pairs in temporary files
+    and merging them as ``ingest()`` does, so memory use is bounded.
+
+    Rows appended since are added to a ``.sidx.log`` file next to it and
+    held in memory. The log's first line is the position the sorted file
+    covers up to, and each line after it is a value, the position of the row
+    and the position of its end. Once more than ``merge_rows`` rows are in
+    the log they are merged into the sorted file.
+
+    Values are indexed as the bytes ``encode_value()`` gives for their
+    decoded values, so that lookups work whether or not values were decoded.
+    """
+    block_size = 2**16
+    schema = Schema({'value': 'bytes', 'offset': 'int'})
+
+    def __init__(self, csvfile, column, run_rows=100000, merge_rows=10000):
+        self.path = '%s.%s.sidx'%(csvfile.filename, column)
+        self.column = column
+        self.run_rows = run_rows
+        self.merge_rows = merge_rows
+        types = csvfile.types()
+        self.type = column < len(types) and types[column] or 'str'
+        self.sorted = None
+        # The end of the last row indexed
+        self.end = None
+        self.delta = {}
+        self.delta_rows = 0
+        # The inode and mtime of the sorted file this was loaded from
+        self.stamp = None
+
+    @classmethod
+    def open(cls, csvfile, column, run_rows=100000, merge_rows=10000):
+        """\
+        Load the index of ``column`` saved next to ``csvfile``, bringing it
+        up to date, or build and save a new one if there isn't one.
+        """
+        index = cls(csvfile, column, run_rows, merge_rows)
+        index.extend(csvfile)
+        return index
+
+    def encode(self, raw):
+        """
+        Return the bytes a value from the file is indexed as
+        """
+        if self.type in ['str', 'bytes']:
+            return raw
+        return encode_value(column_decoders[self.type](raw))
+
+    def scan(self, csvfile, pos, row_callback):
+        """
+        Call ``row_callback(value, start, end_pos)`` for every row from
+        ``pos`` onwards
+        """
+        start = [pos]
+        def callback(row, end_pos):
+            row_callback(self.encode(row and row[0] or ''), start[0], end_pos)
+            start[0] = end_pos+1
+            return True
+        if pos < csvfile.size:
+            csvfile.lex(pos, callback, rows=None, cols=[self.column])
+        return start[0]
+
+    def build(self, csvfile):
+        run_dir = tempfile.mkdtemp(prefix='fastcsv-', dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            paths = []
+            pairs = []
+            def row_callback(value, start, end_pos):
+                pairs.append((value, start))
+                if len(pairs) >= self.run_rows:
+                    paths.append(sort_run(pairs[:], os.path.join(run_dir, 'run-%06d'%(len(paths),))))
+                    del pairs[:]
+            end = self.scan(csvfile, csvfile.block_start(0), row_callback)
+            if pairs:
+                paths.append(sort_run(pairs, os.path.join(run_dir, 'run-%06d'%(len(paths),))))
+            self.write(merge_runs(paths), end)
+        finally:
+            shutil.rmtree(run_dir)
+        debug("Built the secondary index %r"%(self.path,))
+
+    def write(self, pairs, end):
+        """
+        Replace the sorted file with ``pairs`` covering the rows up to ``end``
+        and start a new, empty log
+        """
+        if self.sorted is not None:
+            self.sorted.close()
+            self.sorted = None
+        with BlockWriter(self.path+'.tmp', ['value', 'offset'], self.block_size, schema=self.schema) as writer:
+            for value, offset in pairs:
+                writer.write([value, offset])
+        with open(self.path+'.log.tmp', 'wb') as fp:
+            fp.write(encode_row([str(end)]))
+        os.rename(self.path+'.tmp', self.path)
+        os.rename(self.path+'.log.tmp', self.path+'.log')
+        self.stamp = sidecar_stamp(self.path)
+        self.end = end
+        self.delta = {}
+        self.delta_rows = 0
+
+    def load(self):
+        """\
+        Read the log, skipping any row logged more than once, and close the
+        sorted file in case it has been replaced since it was opened
+        """
+        if self.sorted is not None:
+            self.sorted.close()
+            self.sorted = None
+        self.stamp = sidecar_stamp(self.path)
+        end_pos, rows = lex(self.path+'.log', rows=None)
+        self.end = int(rows[0][0])
+        self.delta = {}
+        self.delta_rows = 0
+        seen = set()
+        for value, offset, end_pos in rows[1:]:
+            if (value, offset) in seen:
+                continue
+            seen.add((value, offset))
+            self.delta.setdefault(value, []).append(int(offset))
+            self.delta_rows += 1
+            self.end = max(self.end, int(end_pos)+1)
+
+    def extend(self, csvfile):
+        """\
+        Add the rows appended since the index was last brought up to date,
+        building it if there isn't one and rebuilding it if the file has
+        shrunk.
+
+        Other handles on the file may have logged the same rows already, so
+        the log is read again under an exclusive lock on a ``.lock`` file
+        next to the index and only rows past its end are added.
+        """
+        if csvfile.size == self.end:
+            return
+        lock = os.open(self.path+'.lock', os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self.path) and os.path.exists(self.path+'.log'):
+                self.load()
+            else:
+                self.build(csvfile)
+            if csvfile.size < self.end:
+                debug("The file has shrunk, rebuilding the secondary index")
+                self.build(csvfile)
+                return
+            if csvfile.size == self.end:
+                return
+            lines = []
+            def row_callback(value, start, end_pos):
+                self.delta.setdefault(value, []).append(start)
+                self.delta_rows += 1
+                lines.append(encode_row([value, str(start), str(end_pos)]))
+            self.end = self.scan(csvfile, self.end, row_callback)
+            if self.delta_rows > self.merge_rows:
+                self.merge()
+            elif lines:
+                with open(self.path+'.log', 'ab') as fp:
+                    fp.write(''.join(lines))
+        finally:
+            os.close(lock)
+
+    def merge(self):
+        """
+        Merge the rows in the log into the sorted file
+        """
+        debug("Merging %s rows into the secondary index"%(self.delta_rows,))
+        delta = sorted([(value, offset) for value, offsets in self.delta.items() for offset in offsets])
+        old = self.path+'.old'
+        os.rename(self.path, old)
+        try:
+            with FastCSVFile(old, self.block_size, schema=self.schema) as existing:
+                self.write(heapq.merge((tuple(row) for row in existing.iter_rows()), delta), self.end)
+        finally:
+            os.remove(old)
+
+    def offsets(self, value):
+        """
+        Return the positions of the rows whose value is ``value``, in order
+        """
+        value = encode_value(value)
+        if self.sorted is None:
+            self.sorted = FastCSVFile(self.path, self.block_size, schema=self.schema)
+        try:
+            offsets = [offset for value, offset in self.sorted.find_row([value])]
+        except KeyError:
+            offsets = []
+        return offsets + self.delta.get(value, [])
+
+    def close(self):
+        if self.sorted is not None:
+            self.sorted.close()
+            self.sorted = None
+
+class RowCursor(object):
+    """\
+    Read through the rows of a ``FastCSVFile`` a page at a time.
+
+    ``position`` is the number of the next row to read. It can be saved (in a
+    paginated API's "next page" link, say) and passed back to
+    ``FastCSVFile.cursor()`` later to carry on from the same place.
+    """
+    def __init__(self, csvfile, position=0, page_size=100):
+        self.csvfile = csvfile
+        self.position = position
+        self.page_size = page_size
+
+    def fetch(self, count=None):
+        if count is None:
+            count = self.page_size
+        rows = self.csvfile.read_rows(self.position, self.position+count)
+        self.position += len(rows)
+        return rows
+
+    def __iter__(self):
+        while True:
+            rows = self.fetch()
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+class ArrayColumn(object):
+    """\
+    The values of an ``int``, ``float`` or ``date`` column in an ``array``,
+    with dates stored as their ordinals and the positions of any empty values
+    kept in ``nulls``
+    """
+    def __init__(self, type):
+        self.type = type
+        self.values = array.array(type == 'float' and 'd' or 'l')
+        self.nulls = set()
+
+    def append(self, value):
+        if not value:
+            self.nulls.add(len(self.values))
+            self.values.append(0)
+        elif self.type == 'date':
+            self.values.append(decode_date(value).toordinal())
+        elif self.type == 'int':
+            self.values.append(int(value))
+        else:
+            self.values.append(float(value))
+
+    def __getitem__(self, i):
+        if i in self.nulls:
+            return None
+        if self.type == 'date':
+            return datetime.date.fromordinal(self.values[i])
+        return self.values[i]
+
+class BytesColumn(object):
+    """\
+    The values of a ``str`` or ``bytes`` column kept undecoded, one after
+    another in a single ``bytearray``, with an ``array`` of where each ends
+    """
+    def __init__(self, type):
+        self.type = type
+        self.data = bytearray()
+        self.ends = array.array('L')
+
+    def append(self, value):
+        self.data.extend(value)
+        self.ends.append(len(self.data))
+
+    def __getitem__(self, i):
+        start = i and self.ends[i-1] or 0
+        value = str(self.data[start:self.ends[i]])
+        if self.type == 'str':
+            return value.decode('utf8')
+        return value
+
+class RowBatch(object):
+    """\
+    Rows stored column by column rather than as a list of values per row.
+
+    Only the columns asked for are kept, and their values are kept compactly
+    rather than as a Python object each: numbers and dates in an ``array``
+    and text as bytes in one buffer, only decoded when read.
+
+    ``batch[i]`` is the ``i``-th row as a list of decoded values and
+    ``batch.column(name)`` is all the decoded values of one column. The
+    underlying storage is in ``batch.columns``.
+    """
+    def __init__(self, names, types, positions):
+        self.names = names
+        self.types = types
+        self.positions = positions
+        self.columns = []
+        for type in types:
+            if type in ['int', 'float', 'date']:
+                self.columns.append(ArrayColumn(type))
+            else:
+                self.columns.append(BytesColumn(type))
+        self.length = 0
+
+    def append(self, row):
+        """
+        Add an undecoded row, as parsed by ``lex()``
+        """
+        for column, position in zip(self.columns, self.positions):
+            if position < len(row):
+                column.append(row[position])
+            else:
+                column.append('')
+        self.length += 1
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('No row %s'%(i,))
+        return [column[i] for column in self.columns]
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self[i]
+
+    def column(self, name):
+        column = self.columns[self.names.index(name)]
+        return [column[i] for i in range(self.length)]
+
+def lex_file(fp, pos=0, row_callback=None, value_callback=None, rows=1, cols=None):
+    """\
+    Start parsing the rows of an already open file at the specified position,
+    calling ``value_calback()`` every time a value is found and
+    ``row_callback()`` every time a row is completed.
+
+    If ``cols`` is a list of column numbers, each row only has the values of
+    those columns, in the order they are in the row.
+    """
+    if cols is not None:
+        # Parse whole rows and pick out the columns afterwards
+        keep = column_mask(cols)
+        projected = []
+        def projected_row_callback(row, end_pos):
+            row = project(row, keep)
+            if value_callback:
+                for value in row:
+                    value_callback(value)
+            if row_callback:
+                return row_callback(row, end_pos)
+            projected.append(row)
+            return True
+        end_pos, unused = lex_file(fp, pos, projected_row_callback, None, rows)
+        return end_pos, projected
+    row_data = []
+    fp.seek(pos)
+    row_callback_count = 0
+    state = ROW_START
+    value = ''
+    row = []
+    final = pos
+    keep_going = True
+    while True:
+        chars = fp.read(4096)
+        if not chars:
+            if row:
+                if value_callback:
+                    value_callback(value)
+                row.append(value)
+                if row_callback:
+                    keep_going = row_callback(row, final-1)
+                    if keep_going not in [True, False]:
+                        raise Exception("Row callback failed to return True or False")
+                else:
+                    row_data.append(row)
+            return final-1, row_data
+        for char in chars: 
+            final+=1
+            if state == IN_QUOTED:
+                if char == '"':
+                    state = FIRST_QUOTE_OR_END_QUOTED
+                else:
+                    value += char
+            elif state == IN_UNQUOTED:
+                if char == '"':
+                    warn('Found a %r character in an unquoted value at %s, assuming a quote was missed from the front of the value and continuing'%(char, final-1,))
+                    state = FIRST_QUOTE_OR_END_QUOTED
+                elif char  == ',':
+                    state = COMMA
+                    row.append(value)
+                    if value_callback:
+                        value_callback(value)
+                    value = ''
+                elif char in [' ']:
+                    warn('Found a %r character in an unquoted value at %s, assuming the quoting was accidentally forgotten and continuing, expecting to a quote was missed from the front of the value and continuing'%(char, final-1,))
+                    state = FIRST_QUOTE_OR_END_QUOTED
+                else:
+                    value += char 
+            elif state == ROW_START:
+                if char == '\n':
+                    # XXX raise Exception(r'Expected \r\n at position %s, not \n'%(final-1,))
+                    warn(r'Expected \r\n at position %s, not \n'%(final-1,))
+                elif char == '\r':
+                    state = NON_VALUE_CR
+                elif char == ',':
+                    if value_callback:
+                        value_callback(value)
+                    value = ''
+                    state == COMMA
+                elif char == '"':
+                    state = IN_QUOTED
+                elif char == ' ':
+                    state = PRE_PADDING
+                else:
+                    state = IN_UNQUOTED
+                    value += char
+            elif state == PRE_PADDING:
+                if char == ' ':
+                    continue
+                    # XXX Depending on the implementation, might want to add this:
+                    # value += char
+                elif char == '\r':
+                    state = NON_VALUE_CR
+                elif char == ',':
+                    warn('We found a %r at the end of a row at %s, assuming that it was supposed to be \'\\r\\n\' and continuing'%(char, final-1,))
+
+                    if value_callback:
+                        value_callback(value)
+                    row.append(value)
+                    value = ''
+                    state = COMMA
+                elif char == '\n':
+                    warn('We found a %r at the end of a row at %s, assuming that it was supposed to be \'\\r\\n\' and continuing'%(char, final-1,))
+
+                    if value_callback:
+                        value_callback(value)
+                    row.append(value)
+                    if row_callback:
+                        keep_going = row_callback(row, final-1)
+                        if keep_going not in [True, False]:
+                            raise Exception("Row callback failed to return True or False")
+                    else:
+                        row_data.append(row)
+                    row_callback_count += 1
+                    if not keep_going or (rows != None and row_callback_count >= rows): 
+                        return final-1, row_data
+                    row = []
+                    value = ''
+                    state = ROW_START
+                elif char == '"':
+                    state = IN_QUOTED
+                else:
+                    state = IN_UNQUOTED
+                    value += char
+            elif state == FIRST_QUOTE_OR_END_QUOTED:
+                if char == '"':
+                    value += char
+                    state = IN_QUOTED
+                elif char == ' ':
+                    state = END_PADDING
+                elif char == '\r':
+                    state = NON_VALUE_CR
+                elif char == '\n':
+                    warn('We found a %r at the end of a row at %s, assuming that it was supposed to be \'\\r\\n\' and continuing'%(char, final-1,))
+
+                    if value_callback:
+                        value_callback(value)
+                    row.append(value)
+                    if row_callback:
+                        keep_going = row_callback(row, final-1)
+                        if keep_going not in [True, False]:
+                            raise Exception("Row callback failed to return True or False")
+                    else:
+                        row_data.append(row)
+                    row_callback_count += 1
+                    if not keep_going or (rows != None and row_callback_count >= rows):
+                        return final-1, row_data
+                    row = []
+                    value = ''
+                    state = ROW_START
+                elif char == ',':
+                    state = COMMA
+                    if value_callback:
+                        value_callback(value)
+                    row.append(value)
+                    value = ''
+                else:
+                    raise Exception('Expected a second %r character at %s or a comma or space, not %r'%('"', final-1, char))
+            elif state == END_PADDING:
+                if char == ' ':
+                    continue
+                elif char == ',':
+                    state = COMMA
+                elif char == '\r':
+                    state = NON_VALUE_CR
+                elif char == '\n':
+                    warn('We found a \'\\n\' at the end of a row at %s, assuming that it was supposed to be \'\\r\\n\' and continuing'%(ifnal-1,))
+                    if value_callback:
+                        value_callback(value)
+                    row.append(value)
+                    if row_callback:
+                        keep_going = row_callback(row, final-1)
+                        if keep_going not in [True, False]:
+                            raise Exception("Row callback failed to return True or False")
+                    else:
+                        row_data.append(row)
+                    row_callback_count += 1
+                    if not keep_going or (rows != None and row_callback_count >= rows): 
+                        return final-1, row_data
+                    row = []
+                    value = ''
+                    state = ROW_START
+                else:
+                    raise Exception('Expected a comma, space or newline after the padding at %s, not a %r'%(final-1, char))
+            elif state == COMMA:
+                if char == '\n':
+                    warn('We found a \'\\n\' at the end of a row at %s, assuming that it was supposed to be \'\\r\\n\' and continuing'%(final-1,))
+                    if value_callback:
+                        value_callback(value)
+                    row.append(value)
+                    if row_callback:
+                        keep_going = row_callback(row, final-1)
+                        if keep_going not in [True, False]:
+                            raise Exception("Row callback failed to return True or False")
+                    else:
+                        row_data.append(row)
+                    row_callback_count += 1
+                    if not keep_going or (rows != None and row_callback_count >= rows): 
+                        return final-1, row_data
+                    row = []
+                    value = ''
+                    state = ROW_START
+                elif char == '\r':
+                    state = NON_VALUE_CR
+                elif char == ' ':
+                    state = PRE_PADDING
+                elif char == '"':
+                    state = IN_QUOTED
+                elif char == ',':
+                    if value_callback:
+                        value_callback('')
+                    row.append('')
+                else:
+                    state = IN_UNQUOTED
+                    value += char
+            elif state == NON_VALUE_CR:
+                if char != '\n':
+                    raise Exception('Expected \'\\r\\n\' at position %s, not \'\r%s\''%(final0, char))
+                else:
+                    if value_callback:
+                        value_callback(value)
+                    row.append(value)
+                    if row_callback:
+                        keep_going = row_callback(row, final-1)
+                        if keep_going not in [True, False]:
+                            raise Exception("Row callback failed to return True or False")
+                    else:
+                        row_data.append(row)
+                    row_callback_count += 1
+                    if not keep_going or (rows != None and row_callback_count >= rows):
+                        return final-1, row_data
+                    row = []
+                    value = ''
+                    state = ROW_START
+
+# An unquoted value, which has to end at a comma
+unquoted_value = re.compile('[^", \r\n]*').match
+# The values from some point in a row to its end, for checking the values
+# after the last column wanted without slicing them out
+rest_of_row = re.compile(
+    r'(?:"[^"]*(?:""[^"]*)*"|[^", \r\n]+(?=,)|)'
+    r'(?:,(?:"[^"]*(?:""[^"]*)*"|[^", \r\n]+(?=,)|))*'
+    # Spaces are only allowed between a quoted last value and the \r\n
+    r'(?:(?<=") +)?\r\n'
+).match
+
+def parse_row(buf, pos, size, keep=None):
+    """\
+    Parse the row starting at ``pos`` in ``buf`` (a ``mmap`` or string) by
+    slicing values straight out of it rather than looking at each character.
+
+    Returns the list of values and the position of the ``\\n`` ending the row,
+    or ``None`` if the row contains anything other than plain quoted or
+    unquoted values separated by commas and optionally padded before the
+    ``\\r\\n``, or runs up against ``size``. Those rows should be handed to
+    ``lex_file()`` which knows how to recover from the unusual cases.
+
+    If ``keep`` is a mask from ``column_mask()`` only the values of the
+    columns it marks are returned, the others are skipped without being
+    sliced out. The values after the last column marked are checked in one
+    go with ``rest_of_row``.
+    """
+    row = []
+    i = pos
+    col = 0
+    char = buf[i:i+1]
+    if char == ' ':
+        # Padding left by an append or a delete before the row starts
+        while char == ' ':
+            i += 1
+            char = buf[i:i+1]
+        if char != '"':
+            return None
+    elif char == ',':
+        return None
+    while i < size:
+        if keep is not None and col and col >= len(keep):
+            # None of the rest of the values are wanted
+            match = rest_of_row(buf, i, size)
+            if match is None:
+                return None
+            return row, match.end()-1
+        wanted = keep is None or keep[col:col+1] == '\x01'
+        col += 1
+        if char == '"':
+            end = buf.find('"', i+1, size)
+            if end == -1:
+                return None
+            if wanted:
+                value = buf[i+1:end]
+            while buf[end+1:end+2] == '"':
+                # An escaped quote inside the value
+                i = end+1
+                end = buf.find('"', i+1, size)
+                if end == -1:
+                    return None
+                if wanted:
+                    value += buf[i:end]
+            i = end+1
+            char = buf[i:i+1]
+            if char == ' ':
+                while char == ' ':
+                    i += 1
+                    char = buf[i:i+1]
+                if char != '\r':
+                    return None
+        elif char == '\r' or char == ',':
+            # An empty value
+            value = ''
+        elif char == ' ' or char == '\n' or char == '':
+            return None
+        else:
+            end = unquoted_value(buf, i, size).end()
+            if buf[end:end+1] != ',':
+                return None
+            if wanted:
+                value = buf[i:end]
+            i = end
+            char = ','
+        if wanted:
+            row.append(value)
+        if char == ',':
+            i += 1
+            char = buf[i:i+1]
+        elif char == '\r' and i+1 < size and buf[i+1] == '\n':
+            return row, i+1
+        else:
+            return None
+    return None
+
+def python_scan_rows(buf, pos, max_rows, keep=None):
+    """\
+    Parse up to ``max_rows`` rows (all of them if it is negative) from
+    ``buf`` starting at ``pos`` with ``parse_row()``, stopping early at the
+    first row it can't parse or at the end of the buffer.
+
+    Returns the rows, the position of the ``\\n`` ending each row and the
+    position of the first row not parsed. The ``_fastcsv`` C extension
+    provides a faster ``scan_rows()`` that behaves identically.
+
+    This still does some work in the interpreter for every value, so it is
+    only somewhat faster than ``lex_file()``, around 8MB/s rather than 6MB/s
+    with ``python benchmark.py throughput``. Only the C extension gets lexing
+    up to tens of MB/s. Parsing just the first few columns with ``keep`` is
+    the exception, since the rest of each row is checked without leaving
+    the ``re`` module.
+    """
+    size = len(buf)
+    rows = []
+    ends = []
+    while pos < size and (max_rows < 0 or len(rows) < max_rows):
+        parsed = parse_row(buf, pos, size, keep)
+        if parsed is None:
+            break
+        rows.append(parsed[0])
+        ends.append(parsed[1])
+        pos = parsed[1]+1
+    return rows, ends, pos
+
+def column_mask(cols):
+    """\
+    Turn a list of column numbers into the ``keep`` mask ``scan_rows()``
+    takes, a string with a ``\\x01`` byte for each column wanted
+    """
+    if not cols:
+        return ''
+    cols = set(cols)
+    return ''.join([i in cols and '\x01' or '\x00' for i in range(max(cols)+1)])
+
+def project(row, keep):
+    """
+    Pick the values of the columns marked in ``keep`` out of a whole row
+    """
+    return [row[i] for i in range(min(len(row), len(keep))) if keep[i] == '\x01']
+
+try:
+    import _fastcsv
+except ImportError:
+    _fastcsv = None
+
+def use_backend(name):
+    """\
+    Choose whether ``scan_rows()`` is the ``'c'`` extension or the pure
+    ``'python'`` version. The C extension is used automatically if it can be
+    imported.
+    """
+    global backend, scan_rows
+    if name == 'c':
+        if _fastcsv is None:
+            raise Exception('The _fastcsv C extension is not available, run setup.py build_ext first')
+        scan_rows = _fastcsv.scan_rows
+    elif name == 'python':
+        scan_rows = python_scan_rows
+    else:
+        raise Exception('Unknown backend %r'%(name,))
+    backend = name
+
+use_backend(_fastcsv is None and 'python' or 'c')
+
+def lex_blocks(fp, pos=0, row_callback=None, value_callback=None, rows=1, cols=None, chunk_size=64*1024):
+    """\
+    Parse rows from an already open file (or ``CachedBlockReader``) a chunk
+    at a time, taking the same arguments and returning the same result as
+    ``lex_file()``.
+
+    Rather than looking at each character in turn, well-formed rows are sliced
+    whole out of each chunk by ``scan_rows()``. A row cut off by the end of a
+    chunk is parsed again once more has been read, and any row
+    ``scan_rows()`` can't parse is handed to ``lex_file()`` so that the
+    rows, end positions and warnings are exactly the same as its.
+
+    The first read is small in case only a row or two is wanted, with each
+    read after that twice the size of the last, up to ``chunk_size``.
+    """
+    return lex_buffer(fp, '', pos, False, pos, row_callback, value_callback, rows, cols, chunk_size)
+
+def lex_mmap(mapped, pos=0, row_callback=None, value_callback=None, rows=1, cols=None):
+    """\
+    Parse rows from a memory-mapped file, taking the same arguments and
+    returning the same result as ``lex()``.
+
+    Well-formed rows are sliced directly out of the mapping in batches by
+    ``scan_rows()`` so only the pages containing the rows parsed are
+    touched. Any other row is parsed by ``lex_file()`` which can read from
+    the mapping as if it were a file.
+    """
+    return lex_buffer(mapped, mapped, 0, True, pos, row_callback, value_callback, rows, cols)
+
+def lex_buffer(fp, buf, offset, eof, pos, row_callback, value_callback, rows, cols, chunk_size=None):
+    """\
+    Parse rows with ``scan_rows()`` from ``buf``, which holds the contents
+    of ``fp`` from ``offset`` onwards, reading more from ``fp`` as it is
+    needed until ``eof`` is reached. Used by ``lex_blocks()`` and
+    ``lex_mmap()``.
+    """
+    row_data = []
+    row_callback_count = 0
+    keep = None
+    if cols is not None:
+        keep = column_mask(cols)
+    # Start with small batches in case the row callback soon stops the parsing
+    batch = 16
+    read_size = min(4096, chunk_size or 4096)
+    i = pos - offset
+    while True:
+        if rows is None:
+            max_rows = batch
+        else:
+            max_rows = max(min(rows-row_callback_count, batch), 1)
+        parsed_rows, ends, next_i = scan_rows(buf, i, max_rows, keep)
+        if parsed_rows:
+            batch = min(batch*2, 1024)
+        if not row_callback and not value_callback:
+            row_data.extend(parsed_rows)
+            row_callback_count += len(parsed_rows)
+            if rows != None and row_callback_count >= rows:
+                return offset+ends[-1], row_data
+        else:
+            for j in range(len(parsed_rows)):
+                row = parsed_rows[j]
+                end_pos = offset+ends[j]
+                if value_callback:
+                    for value in row:
+                        value_callback(value)
+                if row_callback:
+                    keep_going = row_callback(row, end_pos)
+                    if keep_going not in [True, False]:
+                        raise Exception("Row callback failed to return True or False")
+                else:
+                    keep_going = True
+                    row_data.append(row)
+                row_callback_count += 1
+                if not keep_going or (rows != None and row_callback_count >= rows):
+                    return end_pos, row_data
+        i = next_i
+        if len(parsed_rows) == max_rows:
+            continue
+        if buf[i:i+1] == ' ':
+            # Padding, or the space left by deleted rows, before the next row.
+            # Skipping it is the same as what lex_file() does unless it isn't
+            # followed by a value.
+            j = match_spaces(buf, i).end()
+            if j == len(buf) and eof:
+                i = j
+            elif j == len(buf):
+                # Keep a space for when what follows has been read
+                i = j-1
+            elif buf[j:j+1] not in ['\r', '\n', ',']:
+                i = j
+                continue
+        if not eof and len(buf)-i < read_size:
+            # The next row might just be cut off by the end of the buffer
+            fp.seek(offset+len(buf))
+            chars = fp.read(read_size)
+            if chars:
+                buf = buf[i:] + chars
+                offset += i
+                i = 0
+                read_size = min(read_size*2, chunk_size)
+            else:
+                eof = True
+            continue
+        if i >= len(buf):
+            return offset+i-1, row_data
+        # The next row isn't one scan_rows() can parse
+        keep_going = [True]
+        def slow_row_callback(row, end_pos):
+            if row_callback:
+                keep_going[0] = row_callback(row, end_pos)
+            else:
+                row_data.append(row)
+            return keep_going[0]
+        end_pos, unused = lex_file(fp, offset+i, slow_row_callback, value_callback, rows=1, cols=cols)
+        if eof and end_pos >= offset+len(buf)-1:
+            # The slow parser reached the end of the file
+            return end_pos, row_data
+        row_callback_count += 1
+        if not keep_going[0] or (rows != None and row_callback_count >= rows):
+            return end_pos, row_data
+        i = end_pos+1-offset
+        if i > len(buf):
+            buf = ''
+            offset = end_pos+1
+            i = 0
+
+def lex(filename, pos=0, row_callback=None, value_callback=None, rows=1, cols=None, cache=None):
+    """\
+    Open a file at the specified position and start parsing the rows, calling
+    ``value_calback()`` every time a value is found and ``row_callback()``
+    every time a row is completed.
+
+    If ``cols`` is a list of column numbers, only the values of those
+    columns are returned, in the order they are in the row, and the other
+    values aren't copied out of the file.
+
+    If a ``BlockCache`` is passed as ``cache`` the blocks are read through
+    it. The file must then be named with its block size.
+
+    When the ``_fastcsv`` C extension is in use the file is memory-mapped and
+    parsed by ``lex_mmap()`` so that the rows are returned from C in batches,
+    otherwise it is read a chunk at a time by ``lex_blocks()``.
+    """
+    if cache is not None:
+        with FastCSVFile(filename, cache=cache) as csvfile:
+            return csvfile.lex(pos, row_callback, value_callback, rows, cols)
+    with open(filename, "rb") as fp:
+        if backend == 'c' and os.fstat(fp.fileno()).st_size:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return lex_mmap(mapped, pos, row_callback, value_callback, rows, cols)
+            finally:
+                mapped.close()
+        return lex_blocks(fp, pos, row_callback, value_callback, rows, cols)
@@ -0,0 +1,17 @@
+from distutils.core import setup, Extension
+
+setup(
+    name='fastcsv',
+    version='0.1.0',
+    description='Create padded CSV files with sorted rows that can be quickly read',
+    url='https://github.com/thejimmyg/fastcsv',
+    license='AGPL3',
+    py_modules=['fastcsv'],
+    ext_modules=[
+        Extension(
+            '_fastcsv',
+            ['fastcsv.c'],
+            define_macros=[('FASTCSV_EXTENSION', '1')],
+        ),
+    ],
+)
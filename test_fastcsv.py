@@ -0,0 +1,651 @@
+"""
+Tests for the fastcsv parsers, write, delete, compaction and sidecar code
+
+Run with::
+
+    python -m unittest test_fastcsv
+"""
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import benchmark
+import fastcsv
+
+def make_rows(count, start=0):
+    return [[u'k%06d'%(i,), u'value %s'%(i,) + u'x'*(i % 37)] for i in range(start, start+count)]
+
+def write_file(filename, rows, headers=('key', 'value'), **options):
+    with fastcsv.BlockWriter(filename, list(headers), **options) as writer:
+        for row in rows:
+            writer.write(row)
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='fastcsv-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def all_rows(self, filename, **options):
+        with fastcsv.FastCSVFile(filename, **options) as csvfile:
+            return list(csvfile.iter_rows())
+
+class TestParity(unittest.TestCase):
+    """
+    The same checks as ``python benchmark.py parity``, for each backend
+    """
+    def test_python_backend(self):
+        self.assertEqual(benchmark.parity(200, ['python']), 0)
+
+    @unittest.skipIf(fastcsv._fastcsv is None, 'the _fastcsv C extension is not built')
+    def test_c_backend(self):
+        self.assertEqual(benchmark.parity(200, ['c']), 0)
+
+class TestAppender(TempDirTestCase):
+    def test_rows_are_readable_and_block_aligned(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(500)
+        with fastcsv.Appender(filename, headers=['key', 'value'], commit_rows=50, sync=False) as appender:
+            for row in rows:
+                appender.write(row)
+        self.assertEqual(self.all_rows(filename), rows)
+        data = open(filename, 'rb').read()
+        for boundary in range(512, len(data), 512):
+            self.assertTrue(data[boundary-1] in ' \n')
+        for options in [{}, {'use_mmap': True}, {'index_columns': 1}]:
+            with fastcsv.FastCSVFile(filename, **options) as csvfile:
+                for row in rows[::23]:
+                    self.assertEqual(csvfile.find_row(row[:1]), [row])
+
+    def test_rows_out_of_order_are_refused(self):
+        filename = self.path('data.9.csv')
+        write_file(filename, make_rows(20))
+        self.assertRaises(Exception, fastcsv.new_row, filename, [u'k000000', u'a'])
+
+    def test_two_appenders_on_the_same_file(self):
+        filename = self.path('data.9.csv')
+        write_file(filename, make_rows(10))
+        first = fastcsv.Appender(filename, sync=False, commit_rows=10**6, commit_interval=10**6)
+        second = fastcsv.Appender(filename, sync=False)
+        first.write([u'l000001', u'a'])
+        second.write([u'l000000', u'b'])
+        second.close()
+        first.close()
+        self.assertEqual(list(fastcsv.iter_rows(filename, [u'l'])), [[u'l000000', u'b'], [u'l000001', u'a']])
+        first = fastcsv.Appender(filename, sync=False, commit_rows=10**6, commit_interval=10**6)
+        second = fastcsv.Appender(filename, sync=False)
+        first.write([u'm000000', u'a'])
+        second.write([u'm000001', u'b'])
+        second.close()
+        self.assertRaises(Exception, first.close)
+
+    def test_reader_sees_rows_appended_after_it_opened(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(100)
+        write_file(filename, rows)
+        with fastcsv.FastCSVFile(filename, index_columns=1) as csvfile:
+            self.assertRaises(KeyError, csvfile.find_row, [u'k000150'])
+            more = make_rows(100, 100)
+            with fastcsv.Appender(filename, sync=False) as appender:
+                for row in more:
+                    appender.write(row)
+            self.assertEqual(csvfile.find_row([u'k000150']), [more[50]])
+            self.assertEqual(list(csvfile.iter_rows()), rows+more)
+
+    def test_rows_are_committed_after_the_interval(self):
+        filename = self.path('data.9.csv')
+        write_file(filename, make_rows(10))
+        with fastcsv.Appender(filename, sync=False, commit_interval=0.05) as appender:
+            appender.write([u'z', u'timed'])
+            self.assertEqual(appender.commits, 0)
+            for i in range(100):
+                if appender.commits:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(appender.commits, 1)
+            self.assertEqual(fastcsv.find_row(filename, [u'z']), [[u'z', u'timed']])
+
+    def test_lookups_from_many_threads_while_appending(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(300)
+        write_file(filename, rows)
+        pool = fastcsv.LookupPool(filename, threads=8, bloom_columns=1, index_columns=1, free_space=True)
+        try:
+            with fastcsv.Appender(filename, sync=False, commit_rows=10) as appender:
+                for i, row in enumerate(make_rows(300, 300)):
+                    appender.write(row)
+                    results = [pool.afind_row(rows[j][:1]) for j in range(i % 7, 300, 37)]
+                    for j, result in zip(range(i % 7, 300, 37), results):
+                        self.assertEqual(result.get(), [rows[j]])
+        finally:
+            pool.close()
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.directory) if name.endswith('.tmp')),
+            [],
+        )
+        self.assertEqual(self.all_rows(filename, bloom_columns=1, index_columns=1, free_space=True), rows+make_rows(300, 300))
+
+class TestDeleteAndUpdate(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.filename = self.path('data.9.csv')
+        self.rows = make_rows(1000)
+        write_file(self.filename, self.rows)
+
+    def test_delete_rows(self):
+        deleted = set([row[0] for row in self.rows[100:300]+self.rows[::7]])
+        for key in sorted(deleted):
+            self.assertEqual(fastcsv.delete_row(self.filename, [key]), 1)
+        expected = [row for row in self.rows if row[0] not in deleted]
+        self.assertRaises(KeyError, fastcsv.delete_row, self.filename, [u'k000150'])
+        for options in [{}, {'use_mmap': True}, {'index_columns': 1}, {'free_space': True}]:
+            self.assertEqual(self.all_rows(self.filename, **options), expected)
+            with fastcsv.FastCSVFile(self.filename, **options) as csvfile:
+                for row in expected[::17]:
+                    self.assertEqual(csvfile.find_row(row[:1]), [row])
+                self.assertRaises(KeyError, csvfile.find_row, [u'k000200'])
+
+    def test_deleting_the_last_rows_truncates(self):
+        size = os.path.getsize(self.filename)
+        fastcsv.delete_row(self.filename, self.rows[-1][:1])
+        self.assertTrue(os.path.getsize(self.filename) < size)
+        self.assertTrue(open(self.filename, 'rb').read().endswith('\r\n'))
+        self.assertEqual(self.all_rows(self.filename), self.rows[:-1])
+        fastcsv.new_row(self.filename, [u'z', u'appended'])
+        self.assertEqual(self.all_rows(self.filename), self.rows[:-1]+[[u'z', u'appended']])
+
+    def test_update_rows(self):
+        self.assertEqual(fastcsv.update_row(self.filename, [u'k000036'], {'value': u'short'}), 1)
+        self.assertEqual(fastcsv.update_row(self.filename, [u'k000035'], {1: u'"quoted, now"'}), 1)
+        expected = [row[:] for row in self.rows]
+        expected[36][1] = u'short'
+        expected[35][1] = u'"quoted, now"'
+        self.assertEqual(self.all_rows(self.filename), expected)
+        self.assertRaises(Exception, fastcsv.update_row, self.filename, [u'k000001'], {'value': u'x'*1000})
+        self.assertRaises(Exception, fastcsv.update_row, self.filename, [u'k000001'], {'key': u'x'})
+        self.assertRaises(KeyError, fastcsv.update_row, self.filename, [u'missing'], {'value': u'x'})
+        self.assertRaises(Exception, fastcsv.update_row, self.filename, [u'k000001'], {})
+        self.assertEqual(self.all_rows(self.filename), expected)
+
+    def test_reader_with_row_offsets_open_during_delete(self):
+        with fastcsv.FastCSVFile(self.filename, row_offsets=True, secondary_columns=[1]) as csvfile:
+            self.assertEqual(len(csvfile.offsets), 1000)
+            for row in self.rows[-20:]:
+                fastcsv.delete_row(self.filename, row[:1])
+            more = [[u'n%06d'%(i,), u'appended %s '%(i,) + u'y'*40] for i in range(40)]
+            with fastcsv.Appender(self.filename, sync=False) as appender:
+                for row in more:
+                    appender.write(row)
+            expected = self.rows[:-20]+more
+            self.assertEqual(csvfile.read_rows(0, 2000), expected)
+            self.assertEqual(len(csvfile.offsets), len(expected))
+            self.assertEqual(csvfile.read_row(len(expected)-1), more[-1])
+            self.assertRaises(KeyError, csvfile.find_by, 1, self.rows[-1][1])
+            self.assertEqual(csvfile.find_by(1, more[5][1]), [more[5]])
+
+    def test_reader_open_during_delete(self):
+        with fastcsv.FastCSVFile(self.filename) as csvfile:
+            self.assertEqual(csvfile.find_row([u'k000500']), [self.rows[500]])
+            fastcsv.delete_row(self.filename, [u'k000500'])
+            self.assertRaises(KeyError, csvfile.find_row, [u'k000500'])
+            self.assertEqual(csvfile.find_row([u'k000501']), [self.rows[501]])
+
+class TestBlockIndex(TempDirTestCase):
+    def test_index_sidecar_round_trip(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(1000)
+        write_file(filename, rows)
+        with fastcsv.FastCSVFile(filename, index_columns=1) as csvfile:
+            keys = [tuple(csvfile.first_key(block, 1)) for block in range(csvfile.last_block+1)]
+            self.assertEqual(csvfile.index.keys, keys)
+        index = fastcsv.BlockIndex.load(filename+'.idx')
+        self.assertEqual((index.block_size, index.key_columns, index.keys), (2**9, 1, keys))
+        self.assertEqual(index.find_block([u'a']), 0)
+        self.assertEqual(index.find_block([u'z']), len(keys)-1)
+        with fastcsv.Appender(filename, sync=False) as appender:
+            for row in make_rows(200, 1000):
+                appender.write(row)
+        with fastcsv.FastCSVFile(filename, index_columns=1) as csvfile:
+            for row in rows[::37] + make_rows(200, 1000)[::11]:
+                self.assertEqual(csvfile.find_row(row[:1]), [row])
+            self.assertRaises(KeyError, csvfile.find_row, [u'k000100x'])
+            self.assertEqual(fastcsv.BlockIndex.load(filename+'.idx').keys, csvfile.index.keys)
+            self.assertTrue(len(csvfile.index.keys) > len(keys))
+
+class TestBlockCache(TempDirTestCase):
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = fastcsv.BlockCache(max_bytes=30)
+        for name in 'abc':
+            cache.put(('f', name), name, 10)
+        self.assertEqual(cache.get(('f', 'a')), 'a')
+        cache.put(('f', 'd'), 'd', 10)
+        self.assertEqual(cache.get(('f', 'b')), None)
+        self.assertEqual([cache.get(('f', name)) for name in 'acd'], ['a', 'c', 'd'])
+        cache.put(('f', 'e'), 'e', 31)
+        self.assertEqual(cache.get(('f', 'e')), None)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (4, 2, 1))
+        self.assertEqual((stats['entries'], stats['bytes']), (3, 30))
+        cache.invalidate('f')
+        self.assertEqual((cache.stats()['entries'], cache.bytes), (0, 0))
+
+    def test_lookups_share_a_cache_until_the_file_changes(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(1000)
+        write_file(filename, rows)
+        cache = fastcsv.BlockCache()
+        for row in rows[::50]:
+            self.assertEqual(fastcsv.find_row(filename, row[:1], cache=cache), [row])
+        misses = cache.misses
+        for row in rows[::50]:
+            self.assertEqual(fastcsv.find_row(filename, row[:1], cache=cache), [row])
+        self.assertEqual(cache.misses, misses)
+        self.assertTrue(cache.hits > 0)
+        fastcsv.delete_row(filename, rows[100][:1])
+        self.assertRaises(KeyError, fastcsv.find_row, filename, rows[100][:1], cache=cache)
+        self.assertEqual(fastcsv.find_row(filename, rows[101][:1], cache=cache), [rows[101]])
+        small = fastcsv.BlockCache(max_bytes=2000)
+        for row in rows[1::10]:
+            self.assertEqual(fastcsv.find_row(filename, row[:1], cache=small), [row])
+        self.assertTrue(small.evictions > 0)
+        self.assertTrue(small.bytes <= 2000)
+
+class TestIngest(TempDirTestCase):
+    def test_unsorted_csv_is_sorted_and_padded(self):
+        source = self.path('source.csv')
+        numbers = list(range(-300, 300))
+        numbers = numbers[1::2] + numbers[-2::-2]
+        with open(source, 'wb') as fp:
+            fp.write('value,n,word\r\n')
+            for n in numbers:
+                fp.write('v%s,%s,"w,%s"\r\n'%(n, n, n % 7))
+        schema = fastcsv.Schema({'n': 'int'})
+        expected = sorted([[n, u'v%s'%(n,), u'w,%s'%(n % 7,)] for n in numbers])
+        for processes in [None, 2]:
+            name = self.path('typed-%s'%(processes,))
+            filename = fastcsv.ingest(source, name, ['n'], 9, run_rows=100, processes=processes, tmp_dir=self.directory, schema=schema)
+            self.assertEqual(filename, name+'.9.csv')
+            with fastcsv.FastCSVFile(filename, schema=schema) as csvfile:
+                self.assertEqual(csvfile.headers()[0], [u'n', u'value', u'word'])
+                self.assertEqual(list(csvfile.iter_rows()), expected)
+                self.assertEqual(csvfile.find_row([-299]), [[-299, u'v-299', u'w,%s'%(-299 % 7,)]])
+        filename = fastcsv.ingest(source, self.path('text'), [2, 'value'], 9, run_rows=50)
+        rows = self.all_rows(filename)
+        self.assertEqual(rows, sorted(rows))
+        self.assertEqual(len(rows), len(numbers))
+        self.assertEqual(fastcsv.find_row(filename, [u'w,0', u'v0']), [[u'w,0', u'v0', u'0']])
+        self.assertEqual(sorted(os.listdir(self.directory)), ['source.csv', 'text.9.csv', 'typed-2.9.csv', 'typed-None.9.csv'])
+
+class TestRowOffsets(TempDirTestCase):
+    def test_read_rows_by_number(self):
+        for row_offsets in [True, False]:
+            filename = self.path('data-%s.9.csv'%(row_offsets,))
+            rows = make_rows(700)
+            write_file(filename, rows, row_offsets=row_offsets)
+            self.assertEqual(os.path.exists(filename+'.rows'), row_offsets)
+            with fastcsv.FastCSVFile(filename, row_offsets=True) as csvfile:
+                self.assertEqual(csvfile.read_row(0), rows[0])
+                self.assertEqual(csvfile.read_row(699), rows[699])
+                self.assertRaises(IndexError, csvfile.read_row, 700)
+                self.assertEqual(csvfile.read_rows(250, 320), rows[250:320])
+                self.assertEqual(csvfile.read_rows(690, 800), rows[690:])
+                self.assertEqual(csvfile.read_rows(800, 900), [])
+                fastcsv.new_row(filename, [u'z', u'appended'])
+                self.assertEqual(csvfile.read_row(700), [u'z', u'appended'])
+            with fastcsv.FastCSVFile(filename) as csvfile:
+                self.assertRaises(Exception, csvfile.read_row, 0)
+
+    def test_cursor_pages(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(250)
+        write_file(filename, rows, row_offsets=True)
+        with fastcsv.FastCSVFile(filename, row_offsets=True) as csvfile:
+            cursor = csvfile.cursor(page_size=100)
+            self.assertEqual(cursor.fetch(), rows[:100])
+            self.assertEqual(cursor.fetch(30), rows[100:130])
+            # A saved position carries on where the last page stopped
+            cursor = csvfile.cursor(cursor.position, page_size=100)
+            self.assertEqual(cursor.fetch(), rows[130:230])
+            self.assertEqual(cursor.fetch(), rows[230:])
+            self.assertEqual(cursor.fetch(), [])
+            self.assertEqual(list(csvfile.cursor(page_size=7)), rows)
+            self.assertEqual(list(csvfile.cursor(240)), rows[240:])
+
+class TestLookupPool(TempDirTestCase):
+    def test_lookups_from_the_pool(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(1000)
+        write_file(filename, rows)
+        answers = []
+        with fastcsv.LookupPool(filename, threads=3, index_columns=1) as pool:
+            results = [pool.afind_row(row[:1], answers.append) for row in rows[::10]]
+            self.assertEqual([result.get(10) for result in results], [[row] for row in rows[::10]])
+            self.assertEqual(sorted(answers), [[row] for row in rows[::10]])
+            self.assertRaises(KeyError, pool.afind_row([u'k000100x']).get, 10)
+            found = pool.afind_rows([[u'k000005'], [u'z']]).get(10)
+            self.assertEqual(found, {(u'k000005',): [rows[5]], (u'z',): []})
+            self.assertTrue(pool.cache.stats()['hits'] > 0)
+        try:
+            self.assertEqual(fastcsv.afind_row(filename, rows[7][:1]).get(10), [rows[7]])
+            self.assertEqual(fastcsv.afind_rows(filename, [rows[8][:1]]).get(10), {(rows[8][0],): [rows[8]]})
+        finally:
+            fastcsv.close_lookup_pools()
+
+    def test_concurrent_loads_are_coalesced(self):
+        cache = fastcsv.SharedBlockCache()
+        release = threading.Event()
+        loads = []
+        def loader():
+            loads.append(1)
+            release.wait(10)
+            return 'value', 5
+        values = []
+        threads = [threading.Thread(target=lambda: values.append(cache.load(('f', 0, 'block'), loader))) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        deadline = time.time() + 10
+        while cache.stats()['coalesced'] < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(values, ['value']*3)
+        self.assertEqual(len(loads), 1)
+        stats = cache.stats()
+        self.assertEqual((stats['coalesced'], stats['misses'], stats['entries']), (2, 3, 1))
+        self.assertEqual(cache.load(('f', 0, 'block'), loader), 'value')
+        self.assertEqual(len(loads), 1)
+
+class TestSchema(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.filename = self.path('typed.9.csv')
+        self.schema = fastcsv.Schema({'n': 'int', 'when': 'date', 'price': 'float', 'raw': 'bytes'})
+        self.rows = []
+        for i in range(-200, 400):
+            when = i % 5 and datetime.date(2020, 1, 1) + datetime.timedelta(days=i) or None
+            price = i % 7 and i/4.0 or None
+            self.rows.append([i, when, price, u'caf\xe9 %s'%(i,), 'raw %s'%(i,)])
+        write_file(self.filename, self.rows, headers=('n', 'when', 'price', 'name', 'raw'), schema=self.schema)
+
+    def test_rows_are_decoded(self):
+        self.assertRaises(Exception, fastcsv.Schema, {'n': 'integer'})
+        with fastcsv.FastCSVFile(self.filename, schema=self.schema) as csvfile:
+            self.assertEqual(list(csvfile.iter_rows()), self.rows)
+            self.assertEqual(csvfile.find_row([-3]), [self.rows[197]])
+            self.assertEqual(csvfile.find_row([0]), [[0, None, None, u'caf\xe9 0', 'raw 0']])
+            self.assertEqual(list(csvfile.iter_rows([-2], [3])), self.rows[198:203])
+            self.assertRaises(KeyError, csvfile.find_row, [1000])
+        with fastcsv.FastCSVFile(self.filename) as csvfile:
+            self.assertEqual(list(csvfile.iter_rows())[197], [u'-3', u'2019-12-29', u'-0.75', u'caf\xe9 -3', u'raw -3'])
+
+    def test_row_batches(self):
+        with fastcsv.FastCSVFile(self.filename, schema=self.schema) as csvfile:
+            batch = csvfile.range_batch([-10], [50])
+            self.assertEqual(len(batch), 60)
+            self.assertEqual(list(batch), self.rows[190:250])
+            self.assertEqual(batch[-1], self.rows[249])
+            self.assertRaises(IndexError, batch.__getitem__, 60)
+            batch = csvfile.range_batch(columns=['price', 'name'])
+            self.assertEqual(batch.names, [u'price', u'name'])
+            self.assertEqual(batch.column('price'), [row[2] for row in self.rows])
+            self.assertEqual(batch.column('name'), [row[3] for row in self.rows])
+            batch = csvfile.find_batch([7], columns=['when', 'raw'])
+            self.assertEqual(list(batch), [[self.rows[207][1], 'raw 7']])
+            self.assertRaises(KeyError, csvfile.find_batch, [1000])
+            self.assertRaises(Exception, csvfile.find_batch, [7], columns=['missing'])
+
+class TestTracing(TempDirTestCase):
+    def test_traced_lookups_and_counters(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(1000)
+        write_file(filename, rows)
+        for options in [{}, {'use_mmap': True}, {'index_columns': 1}]:
+            fastcsv.counters.reset()
+            traces = []
+            with fastcsv.FastCSVFile(filename, trace=traces.append, **options) as csvfile:
+                self.assertEqual(csvfile.find_row(rows[500][:1]), [rows[500]])
+                self.assertRaises(KeyError, csvfile.find_row, [u'k000500x'])
+                csvfile.find_rows([rows[1][:1], rows[999][:1], [u'z']])
+            self.assertEqual([(stats.method, stats.rows_found) for stats in traces], [('find_row', 1), ('find_row', 0), ('find_rows', 2)])
+            stats = traces[0]
+            self.assertEqual(stats.key, rows[500][:1])
+            self.assertTrue(stats.rows_lexed >= 1)
+            self.assertTrue(stats.values_decoded >= 2)
+            self.assertTrue(stats.bytes_read >= 512)
+            self.assertTrue(stats.seconds >= stats.lex_seconds >= 0)
+            self.assertEqual(stats.blocks_probed > 0, 'index_columns' not in options)
+            self.assertTrue('find_row' in repr(stats))
+            totals = fastcsv.counters.snapshot()
+            self.assertEqual((totals['lookups'], totals['missing'], totals['traced_lookups']), (3, 1, 3))
+            for name in ['blocks_probed', 'bytes_read', 'rows_lexed', 'values_decoded']:
+                self.assertEqual(totals[name], sum([getattr(stats, name) for stats in traces]))
+        fastcsv.counters.reset()
+        with fastcsv.FastCSVFile(filename) as csvfile:
+            csvfile.find_row(rows[3][:1])
+            self.assertEqual(csvfile.stats, None)
+        self.assertEqual(fastcsv.counters.snapshot(), {'lookups': 1})
+
+class TestFindRows(TempDirTestCase):
+    def test_find_rows_matches_find_row(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(2000)
+        write_file(filename, rows)
+        for row in rows[600:900]:
+            fastcsv.delete_row(filename, row[:1])
+        remaining = dict((row[0], row) for row in rows[:600]+rows[900:])
+        keys = [row[:1] for row in rows[::3]+rows[1::50]] + [[u'k000650x'], [u'a'], [u'z']]
+        for options in [{}, {'index_columns': 1}, {'free_space': True}]:
+            with fastcsv.FastCSVFile(filename, **options) as csvfile:
+                found = csvfile.find_rows(keys)
+                for key in keys:
+                    expected = key[0] in remaining and [remaining[key[0]]] or []
+                    self.assertEqual(found[tuple(key)], expected)
+
+class TestSecondaryIndex(TempDirTestCase):
+    def test_two_handles_log_an_append_once(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(200)
+        write_file(filename, rows)
+        first = fastcsv.FastCSVFile(filename, secondary_columns=[1])
+        second = fastcsv.FastCSVFile(filename, secondary_columns=[1])
+        try:
+            fastcsv.new_row(filename, [u'z', u'appended'])
+            self.assertEqual(first.find_by(1, u'appended'), [[u'z', u'appended']])
+            self.assertEqual(second.find_by(1, u'appended'), [[u'z', u'appended']])
+        finally:
+            first.close()
+            second.close()
+        self.assertEqual(fastcsv.find_by(filename, 1, u'appended'), [[u'z', u'appended']])
+        self.assertEqual(fastcsv.find_by(filename, 1, rows[20][1]), [rows[20]])
+
+class TestRepad(TempDirTestCase):
+    def test_repad_a_typed_file(self):
+        filename = self.path('typed.9.csv')
+        schema = fastcsv.Schema({'key': 'int'})
+        rows = [[i, u'value %s'%(i,) + u'x'*(i % 37)] for i in range(-500, 500)]
+        write_file(filename, rows, schema=schema)
+        self.assertRaises(Exception, fastcsv.repad, filename, self.path('untyped.tmp'), 2**10)
+        for processes in [None, 3]:
+            tmp = self.path('typed.10.csv.tmp')
+            stats = fastcsv.repad(filename, tmp, 2**10, processes=processes, chunk_blocks=5, schema=schema)
+            self.assertEqual(stats['rows'], len(rows))
+            self.assertEqual(stats['chunks'] > 1, processes is not None)
+            os.rename(tmp, self.path('typed.10.csv'))
+            with fastcsv.FastCSVFile(self.path('typed.10.csv'), schema=schema) as csvfile:
+                self.assertEqual(list(csvfile.iter_rows()), rows)
+                self.assertEqual(csvfile.find_row([-499]), [rows[1]])
+
+def has_seven(row):
+    return u'7' in row[0]
+
+def has_seven_hundred(row):
+    return row[0] // 100 == 7
+
+class TestScan(TempDirTestCase):
+    def test_scan_with_one_worker_and_with_a_pool(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(1000)
+        write_file(filename, rows)
+        expected = len([row for row in rows if has_seven(row)])
+        self.assertEqual(fastcsv.scan(filename, lambda row: u'7' in row[0], reducer=fastcsv.Count()), expected)
+        self.assertEqual(fastcsv.scan(filename, has_seven, reducer=fastcsv.Count(), workers=2, chunk_blocks=10), expected)
+        self.assertRaises(Exception, fastcsv.scan, filename, lambda row: True, workers=2, chunk_blocks=10)
+
+class TestBloomFilter(TempDirTestCase):
+    def test_reader_after_truncation_and_appends(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(300)
+        write_file(filename, rows)
+        with fastcsv.FastCSVFile(filename, bloom_columns=1) as csvfile:
+            self.assertEqual(csvfile.find_row(rows[10][:1]), [rows[10]])
+            for row in rows[-20:]:
+                fastcsv.delete_row(filename, row[:1])
+            more = [[u'n%06d'%(i,), u'appended %s '%(i,) + u'y'*40] for i in range(40)]
+            with fastcsv.Appender(filename, sync=False) as appender:
+                for row in more:
+                    appender.write(row)
+            for row in more:
+                self.assertEqual(csvfile.find_row(row[:1]), [row])
+            for row in rows[:-20:7]:
+                self.assertEqual(csvfile.find_row(row[:1]), [row])
+            self.assertRaises(KeyError, csvfile.find_row, rows[-1][:1])
+
+    def test_int_key_for_a_float_column(self):
+        filename = self.path('data.9.csv')
+        schema = fastcsv.Schema({'key': 'float'})
+        rows = [[i/2.0, u'value %s'%(i,)] for i in range(-50, 50)]
+        write_file(filename, rows, schema=schema)
+        for options in [{}, {'bloom_columns': 1}]:
+            with fastcsv.FastCSVFile(filename, schema=schema, **options) as csvfile:
+                self.assertEqual(csvfile.find_row([5]), [[5.0, u'value 10']])
+                self.assertEqual(csvfile.find_row([-2.5]), [[-2.5, u'value -5']])
+                self.assertRaises(KeyError, csvfile.find_row, [7.25])
+
+class TestDataset(TempDirTestCase):
+    def test_rows_are_routed_to_shards(self):
+        directory = self.path('dataset')
+        rows = [[u'k%06d'%(i//2,), u'value %s'%(i,), unicode(i)] for i in range(3000)]
+        with fastcsv.Dataset.create(directory, ['key', 'value', 'n'], bits=10, max_shard_bytes=20000) as dataset:
+            for row in rows:
+                dataset.write(row, sync=False)
+            self.assertRaises(Exception, dataset.write, [u'a', u'', u''])
+        dataset = fastcsv.Dataset(directory)
+        self.assertTrue(len(dataset.shards) > 3)
+        for shard in dataset.shards:
+            self.assertTrue(os.path.getsize(dataset.path(shard)) <= 20000+1024)
+        self.assertEqual(list(dataset.iter_rows()), rows)
+        for row in rows[::97]:
+            self.assertEqual(dataset.find_row(row[:1]), [r for r in rows if r[0] == row[0]])
+        self.assertRaises(KeyError, dataset.find_row, [u'k000100x'])
+        self.assertEqual(list(dataset.iter_rows([u'k000300'], [u'k000400'])), rows[600:800])
+        found = dataset.find_rows([[u'k000010'], [u'k001200'], [u'z']])
+        self.assertEqual(found[(u'k001200',)], rows[2400:2402])
+        self.assertEqual(found[(u'z',)], [])
+
+    def test_split_removes_the_shard_and_its_sidecars(self):
+        directory = self.path('dataset')
+        rows = make_rows(2000)
+        with fastcsv.Dataset.create(directory, ['key', 'value'], bits=10, index_columns=1, bloom_columns=1, free_space=True) as dataset:
+            for row in rows:
+                dataset.write(row, sync=False)
+            shard = dataset.shards[0]
+            self.assertEqual(dataset.find_row([u'k001000']), [rows[1000]])
+            self.assertNotEqual(fastcsv.sidecar_paths(dataset.path(shard)), [])
+            self.assertTrue(dataset.split(shard))
+            self.assertFalse(os.path.exists(dataset.path(shard)))
+            self.assertEqual(fastcsv.sidecar_paths(dataset.path(shard)), [])
+        with fastcsv.Dataset(directory, max_shard_bytes=8000) as dataset:
+            self.assertTrue(dataset.split_shards() > 0)
+            self.assertEqual(list(dataset.iter_rows()), rows)
+            for row in rows[::101]:
+                self.assertEqual(dataset.find_row(row[:1]), [row])
+        names = set(name.split('.csv')[0] for name in os.listdir(directory))
+        self.assertEqual(names, set(shard.filename.split('.csv')[0] for shard in dataset.shards) | set(['manifest']))
+
+    def test_typed_dataset_read_while_it_grows(self):
+        directory = self.path('dataset')
+        schema = fastcsv.Schema({'n': 'int'})
+        rows = [[i, u'value %s'%(i,)] for i in range(-500, 1500)]
+        dataset = fastcsv.Dataset.create(directory, ['n', 'value'], bits=9, schema=schema, max_shard_bytes=3000)
+        reader = fastcsv.Dataset(directory, schema=schema)
+        with dataset:
+            for row in rows[:1000]:
+                dataset.write(row, sync=False, commit_rows=50)
+        shards = len(reader.shards)
+        self.assertEqual(reader.find_row([-9]), [[-9, u'value -9']])
+        self.assertTrue(len(reader.shards) > shards)
+        with fastcsv.Dataset(directory, schema=schema, max_shard_bytes=3000) as dataset:
+            for row in rows[1000:]:
+                dataset.write(row, sync=False)
+        self.assertEqual(reader.find_row([1499]), [[1499, u'value 1499']])
+        self.assertEqual(list(reader.iter_rows([95], [1005])), rows[595:1505])
+        self.assertEqual(reader.scan(lambda row: row[0] % 10 == 0, columns=['n'], reducer=fastcsv.Count()), 200)
+        self.assertEqual(reader.scan(has_seven_hundred, workers=2), [row for row in rows if row[0] // 100 == 7])
+        self.assertRaises(KeyError, reader.find_row, [1500])
+
+class TestCompact(TempDirTestCase):
+    def test_compact(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(2000)
+        write_file(filename, rows)
+        deleted = set([row[0] for row in rows[500:900]+rows[::5]])
+        for key in sorted(deleted):
+            fastcsv.delete_row(filename, [key])
+        expected = [row for row in rows if row[0] not in deleted]
+        with fastcsv.FastCSVFile(filename, free_space=True) as csvfile:
+            pass
+        before = os.path.getsize(filename)
+        stats = fastcsv.compact(filename, threshold=0.3)
+        self.assertEqual(stats['bytes_after'], os.path.getsize(filename))
+        self.assertTrue(stats['bytes_after'] < before)
+        self.assertTrue(stats['dropped'] > 0)
+        for options in [{}, {'index_columns': 1}, {'free_space': True}]:
+            self.assertEqual(self.all_rows(filename, **options), expected)
+        # The saved map is the same as one built from scratch
+        saved = fastcsv.FreeSpaceMap.load(filename+'.free')
+        os.remove(filename+'.free')
+        with fastcsv.FastCSVFile(filename, free_space=True) as csvfile:
+            self.assertEqual((csvfile.free.live, csvfile.free.dead), (saved.live, saved.dead))
+
+    def test_reader_open_during_compact(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(500)
+        write_file(filename, rows)
+        for row in rows[100:300]:
+            fastcsv.delete_row(filename, row[:1])
+        expected = rows[:100]+rows[300:]+[[u'z', u'after']]
+        for options in [{}, {'use_mmap': True}, {'index_columns': 1, 'free_space': True, 'row_offsets': True}, {'cache': fastcsv.BlockCache()}]:
+            with fastcsv.FastCSVFile(filename, **options) as csvfile:
+                self.assertEqual(csvfile.find_row([u'k000400']), [rows[400]])
+                fastcsv.compact(filename, threshold=0.0)
+                fastcsv.new_row(filename, [u'z', u'after'])
+                self.assertEqual(csvfile.find_row([u'z']), [[u'z', u'after']])
+                self.assertEqual(list(csvfile.iter_rows()), expected)
+                if options.get('row_offsets'):
+                    self.assertEqual(csvfile.read_row(len(expected)-1), expected[-1])
+            fastcsv.delete_row(filename, [u'z'])
+            expected.pop()
+            expected.append([u'z', u'after'])
+
+    def test_appender_carries_on_after_compact(self):
+        filename = self.path('data.9.csv')
+        rows = make_rows(500)
+        write_file(filename, rows)
+        appender = fastcsv.Appender(filename, sync=False, commit_rows=10**6, commit_interval=10**6)
+        appender.write([u'z', u'after'])
+        fastcsv.delete_row(filename, [u'k000100'])
+        fastcsv.compact(filename, threshold=0.0)
+        appender.close()
+        self.assertEqual(self.all_rows(filename), rows[:100]+rows[101:]+[[u'z', u'after']])
+
+if __name__ == '__main__':
+    unittest.main()